@@ -0,0 +1,39 @@
+import io
+import logging
+import threading
+
+from opentelemetry_wrapper.utils.batching_handler import BatchingQueueHandler
+from opentelemetry_wrapper.utils.batching_handler import OVERFLOW_BLOCK
+
+
+class LoggingFormatter(logging.Formatter):
+    """
+    logs (once per record) while formatting, i.e. from the writer thread, back to the same handler
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        if not record.getMessage().startswith('from formatter'):
+            logging.getLogger('experiment_batching_handler').info('from formatter: %s', record.getMessage())
+        return super().format(record)
+
+
+if __name__ == '__main__':
+    # a full queue with `OVERFLOW_BLOCK` must not deadlock when the writer thread logs to the same handler
+    stream = io.StringIO()
+    handler = BatchingQueueHandler(stream=stream, queue_size=2, batch_size=1, overflow_policy=OVERFLOW_BLOCK)
+    handler.setFormatter(LoggingFormatter('%(message)s'))
+    logger = logging.getLogger('experiment_batching_handler')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+
+    n = 1000
+    producer = threading.Thread(target=lambda: [logger.info('record %d', i) for i in range(n)], daemon=True)
+    producer.start()
+    producer.join(timeout=30)
+    assert not producer.is_alive(), f'producer deadlocked after {handler.written} records'
+
+    handler.close()
+    lines = stream.getvalue().splitlines()
+    assert [line for line in lines if line.startswith('record')] == [f'record {i}' for i in range(n)]
+    print('records:', n, 'written:', handler.written, 'dropped from the writer thread:', handler.dropped)
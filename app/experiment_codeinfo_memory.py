@@ -0,0 +1,65 @@
+import gc
+import sys
+import time
+import tracemalloc
+
+from opentelemetry_wrapper.utils.introspect import CodeInfo
+
+
+def collect_callables():
+    """
+    every function, method, and class defined in every module that's already been imported
+    """
+    out = []
+    for module in list(sys.modules.values()):
+        for obj in list(vars(module).values()):
+            if isinstance(obj, type):
+                out.append(obj)
+                out.extend(v for v in vars(obj).values() if callable(v) and hasattr(v, '__code__'))
+            elif callable(obj) and hasattr(obj, '__code__'):
+                out.append(obj)
+    return out
+
+
+if __name__ == '__main__':
+    # import a few big packages to have something to introspect
+    import asyncio  # noqa: F401
+    import email.mime.multipart  # noqa: F401
+    import http.server  # noqa: F401
+    import json  # noqa: F401
+    import logging.handlers  # noqa: F401
+    import unittest  # noqa: F401
+
+    callables = collect_callables()[:5000]
+
+    # first pass warms up `linecache`, the source index, etc, so the second pass only measures the instances
+    for c in callables:
+        # noinspection PyBroadException
+        try:
+            CodeInfo(c).json  # noqa: B018
+        except Exception:
+            pass
+    CodeInfo.cache_clear()
+    gc.collect()
+
+    tracemalloc.start()
+    t = time.perf_counter()
+    code_infos = []
+    for c in callables:
+        # noinspection PyBroadException
+        try:
+            code_info = CodeInfo(c)
+            code_info.json  # noqa: B018, touch every public property
+            code_infos.append(code_info)
+        except Exception:
+            pass
+    elapsed = time.perf_counter() - t
+    CodeInfo.cache_clear()  # only count memory held by `code_infos`
+    gc.collect()
+    size, _peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print('instances:      ', len(code_infos))
+    print('elapsed time:   ', round(elapsed, 3), 'seconds')
+    print('memory:         ', round(size / 1024), 'KiB')
+    print('bytes/instance: ', round(size / max(1, len(code_infos))))
@@ -0,0 +1,53 @@
+import logging
+import time
+
+from opentelemetry_wrapper.instrument_logging import JsonFormatter
+
+KEYS = {
+    'time':      'asctime',
+    'tz':        'tz_name',
+    'level':     'levelname',
+    'logger':    'name',
+    'file':      'filename',
+    'function':  'funcName',
+    'line':      'lineno',
+    'trace_id':  'otelTraceID',
+    'span_id':   'otelSpanID',
+    'service':   'otelServiceName',
+    'message':   'message',
+    'user':      'user',  # from `extra={...}`
+}
+
+
+def make_record(i: int) -> logging.LogRecord:
+    record = logging.LogRecord('benchmark', logging.INFO, __file__, 10, 'request %d took %.3f seconds', (i, 0.5), None)
+    record.otelTraceID = f'0x{i:032x}'
+    record.otelSpanID = f'0x{i:016x}'
+    record.otelServiceName = 'experiment_json_formatter'
+    record.user = {'id': i, 'roles': ['admin', 'user']}
+    return record
+
+
+def records_per_second(formatter: logging.Formatter, records, repeat: int = 5) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        for record in records:
+            formatter.format(record)
+        best = min(best, time.perf_counter() - t)
+    return len(records) / best
+
+
+if __name__ == '__main__':
+    records = [make_record(i) for i in range(20000)]
+
+    compiled_formatter = JsonFormatter(KEYS)
+    generic_formatter = JsonFormatter(KEYS)
+    generic_formatter._format_compiled = None  # force the generic path, i.e. how it worked before compiling
+    assert compiled_formatter.format(records[0]) == generic_formatter.format(records[0])
+
+    generic = records_per_second(generic_formatter, records)
+    compiled = records_per_second(compiled_formatter, records)
+    print('generic:  ', round(generic), 'records/second')
+    print('compiled: ', round(compiled), 'records/second')
+    print('speedup:  ', round(compiled / generic, 2), 'x')
@@ -1,6 +1,7 @@
 import asyncio
 import logging
 import time
+from functools import partial
 
 from asgiref.sync import async_to_sync
 from asgiref.sync import sync_to_async
@@ -11,11 +12,12 @@ from opentelemetry_wrapper.instrument_logging import instrument_logging
 instrument_logging()
 
 
-@instrument_decorate
+@partial(instrument_decorate, aggregate=True)
 async def bitshift(x: int, shift_by: int):
     """
     shifts left if positive, right if negative
     uses async in order to test that logging works normally
+    called many times per trace, so calls are aggregated into one summary span per parent
     """
     await asyncio.sleep(0.01)
 
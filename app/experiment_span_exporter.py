@@ -0,0 +1,95 @@
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List
+
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import ReadableSpan
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import ConsoleSpanExporter
+from opentelemetry.sdk.trace.export import SpanExporter
+from opentelemetry.trace import Link
+from opentelemetry.trace import Status
+from opentelemetry.trace import StatusCode
+
+from opentelemetry_wrapper.utils.span_exporter import BatchSpanWriter
+from opentelemetry_wrapper.utils.span_exporter import ENV_SPAN_EXPORT_PATH
+from opentelemetry_wrapper.utils.span_exporter import FORMAT_OTLP_PROTOBUF
+from opentelemetry_wrapper.utils.span_exporter import encode_spans
+
+
+def make_spans(n: int) -> List[ReadableSpan]:
+    # a provider that isn't set globally, without any processors, so spans are only collected here
+    tracer = TracerProvider(resource=Resource.create({'service.name': 'experiment_span_exporter'})).get_tracer(__name__)
+    spans = []
+    for i in range(n):
+        with tracer.start_as_current_span('request', attributes={'http.method': 'GET', 'http.route': '/items/{id}'}) \
+                as parent:
+            with tracer.start_as_current_span(f'query {i % 10}', links=[Link(parent.get_span_context())]) as child:
+                child.set_attribute('db.rows', i)
+                child.add_event('cache miss', {'key': f'item:{i}'})
+                if i % 7 == 0:
+                    child.set_status(Status(StatusCode.ERROR, 'timeout'))
+        spans.extend([child, parent])
+    return spans
+
+
+# a short-lived process that exits without flushing, so its spans are only written by the atexit hooks
+EXIT_WITHOUT_FLUSH = '''
+from opentelemetry_wrapper.utils.tracers import get_tracer
+tracer = get_tracer(__name__)
+for i in range(100):
+    with tracer.start_as_current_span(f'span {i}'):
+        pass
+'''
+
+
+def spans_written_at_exit(path: str) -> int:
+    subprocess.run([sys.executable, '-c', EXIT_WITHOUT_FLUSH],
+                   env={**os.environ, ENV_SPAN_EXPORT_PATH: path, 'PYTHONPATH': os.path.dirname(__file__) or '.'},
+                   check=True)
+    with open(path, encoding='utf8') as f:
+        return len(f.read().splitlines())
+
+
+def spans_per_second(exporter: SpanExporter, spans: List[ReadableSpan], repeat: int = 5) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        for start in range(0, len(spans), 512):  # the default `BatchSpanProcessor` batch size
+            exporter.export(spans[start:start + 512])
+        best = min(best, time.perf_counter() - t)
+    return len(spans) / best
+
+
+if __name__ == '__main__':
+    spans = make_spans(5000)
+
+    # same formatter as `init_tracer` used before
+    console_stream = io.StringIO()
+    console_exporter = ConsoleSpanExporter(out=console_stream, formatter=lambda span: f'{span.to_json(indent=None)}\n')
+    batch_stream = io.StringIO()
+    batch_exporter = BatchSpanWriter(stream=batch_stream, tag_pid=False)
+
+    console_exporter.export(spans)
+    batch_exporter.export(spans)
+    assert [json.loads(line) for line in console_stream.getvalue().splitlines()] == \
+           [json.loads(line) for line in batch_stream.getvalue().splitlines()]
+
+    console = spans_per_second(console_exporter, spans)
+    batch = spans_per_second(batch_exporter, spans)
+    print('console + to_json:', round(console), 'spans/second')
+    print('batch json lines: ', round(batch), 'spans/second', f'({round(batch / console, 2)}x)')
+
+    if encode_spans is not None:
+        protobuf = spans_per_second(BatchSpanWriter(stream=io.BytesIO(), output_format=FORMAT_OTLP_PROTOBUF), spans)
+        print('batch protobuf:   ', round(protobuf), 'spans/second', f'({round(protobuf / console, 2)}x)')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        written = spans_written_at_exit(os.path.join(tmp, 'spans.jsonl'))
+        print('written at exit:  ', written, 'of 100 spans')
+        assert written == 100
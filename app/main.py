@@ -1,6 +1,7 @@
 import datetime
 import inspect
 import logging
+import os
 from typing import Callable
 
 import requests
@@ -66,12 +67,15 @@ def hello_hello() -> str:
 
 
 if __name__ == '__main__':
+    # e.g. `WEB_CONCURRENCY=4 python main.py` to use 4 cores
+    # uvicorn spawns its workers, but the wrapper also works in forked workers (e.g. gunicorn), see `utils/fork_safety.py`
+    workers = int(os.getenv('WEB_CONCURRENCY', '1'))
     uvicorn.run(f'{inspect.getmodulename(__file__)}:app',
                 host='localhost',
                 port=8000,
-                reload=True,
+                reload=workers == 1,  # not valid with multiple workers
                 access_log=True,
-                # workers=2,  # not valid with reload=True
+                workers=workers,
                 # proxy_headers=True,  # github.com/encode/uvicorn/blob/master/uvicorn/middleware/proxy_headers.py
                 limit_concurrency=128,
                 )
@@ -1,4 +1,5 @@
 from opentelemetry_wrapper.instrument_dataclasses import instrument_dataclasses
+from opentelemetry_wrapper.instrument_decorator import do_not_instrument
 from opentelemetry_wrapper.instrument_decorator import instrument_decorate
 from opentelemetry_wrapper.instrument_fastapi import instrument_fastapi
 from opentelemetry_wrapper.instrument_logging import instrument_logging
@@ -16,6 +17,7 @@ def instrument_all():
 
 __all__ = (
     instrument_decorate,
+    do_not_instrument,
     instrument_dataclasses,
     instrument_logging,
     instrument_fastapi,
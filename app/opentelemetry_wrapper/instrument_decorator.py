@@ -1,28 +1,96 @@
 import asyncio
 import inspect
+import time
 from functools import cached_property
 from functools import wraps
+from types import BuiltinFunctionType
+from types import FunctionType
+from types import MethodType
 from typing import Callable
 from typing import Coroutine
+from typing import Dict
 from typing import Optional
 from typing import Union
 
 from opentelemetry.semconv.trace import SpanAttributes
 from opentelemetry.trace import Status
 from opentelemetry.trace import StatusCode
+from opentelemetry.trace import get_current_span
 
 from opentelemetry_wrapper.config import __version__
+from opentelemetry_wrapper.utils.aggregation import SpanAggregator
+from opentelemetry_wrapper.utils.aggregation import get_span_aggregator
+from opentelemetry_wrapper.utils.caches import CacheInfo
+from opentelemetry_wrapper.utils.caches import WeakCache
 from opentelemetry_wrapper.utils.introspect import CodeInfo
+from opentelemetry_wrapper.utils.sampling import Sampler
+from opentelemetry_wrapper.utils.sampling import get_sampler
+from opentelemetry_wrapper.utils.sampling import is_do_not_instrument
+from opentelemetry_wrapper.utils.sampling import qualified_name_of
+from opentelemetry_wrapper.utils.sampling import should_aggregate
+from opentelemetry_wrapper.utils.span_info import SpanInfo
+from opentelemetry_wrapper.utils.span_info import cache_info as span_info_cache_info
 from opentelemetry_wrapper.utils.tracers import get_tracer
 
 _TRACER = get_tracer(__name__, __version__)
-_CACHE_INSTRUMENTED = dict()
-_CACHE_GETATTRIBUTE = dict()
+
+# func -> wrapped func (or None if it must not be wrapped)
+# values are weak because a wrapper references the original func, which would otherwise keep both alive forever
+_CACHE_INSTRUMENTED = WeakCache(weak_values=True)
+
+# instrumented getattribute -> original getattribute
+_CACHE_GETATTRIBUTE = WeakCache()
+
+_DO_NOT_INSTRUMENT_ATTRIBUTE = '__opentelemetry_wrapper_do_not_instrument__'
+_MISSING = object()
+
+
+def cache_info() -> Dict[str, CacheInfo]:
+    """
+    hit/miss/eviction stats for the instrumentation caches, to check that memory stays flat in long-running processes
+    """
+    return {
+        'instrumented': _CACHE_INSTRUMENTED.cache_info(),
+        'getattribute': _CACHE_GETATTRIBUTE.cache_info(),
+        'code_info':    CodeInfo.cache_info(),
+        'span_info':    span_info_cache_info(),
+    }
+
+
+def do_not_instrument(func: Callable) -> Callable:
+    """
+    use as a decorator to mark a function, method, property getter, or class as never-to-be-instrumented
+    this takes precedence over everything else, including `instrument_dataclasses` and class instrumentation
+    it must be applied before (i.e. below) `instrument_decorate` or `dataclass`, since it can't undo instrumentation
+
+    :param func: function or class
+    :return: the same function or class, unmodified
+    """
+    # noinspection PyBroadException
+    try:
+        setattr(func, _DO_NOT_INSTRUMENT_ATTRIBUTE, True)
+    except Exception:
+        pass  # builtins can't be marked, but the cache below still works for them
+
+    _CACHE_INSTRUMENTED[func] = None
+    return func
+
+
+def _is_marked_do_not_instrument(func: Callable) -> bool:
+    # don't let a marked base class stop a subclass from being instrumented
+    if inspect.isclass(func):
+        return func.__dict__.get(_DO_NOT_INSTRUMENT_ATTRIBUTE, False) is True
+
+    # a bound method forwards attribute lookups to the underlying function
+    return getattr(func, _DO_NOT_INSTRUMENT_ATTRIBUTE, False) is True
 
 
 def instrument_decorate(func: Callable,
                         /, *,
                         func_name: Optional[str] = None,
+                        sample_ratio: Optional[float] = None,
+                        rate_limit: Optional[float] = None,
+                        aggregate: Optional[bool] = None,
                         ) -> Union[Callable, Coroutine, type]:
     """
     use as a decorator to start a new trace with any class, function, or async function
@@ -36,45 +104,57 @@ def instrument_decorate(func: Callable,
 
     alternatively, use it as a function to wrap something and optionally set a function name
 
+    to reduce overhead for extremely spammy functions, set a sampling ratio and/or rate limit
+    calls that are not sampled skip the tracer entirely
+        @partial(instrument_decorate, sample_ratio=0.01, rate_limit=100)
+        def f():
+            pass
+    alternatively, for functions that are called many times within a single parent span, set `aggregate=True`
+    to collapse those calls into a single summary span, see `opentelemetry_wrapper.utils.aggregation`
+    these can also be set by module glob or env var, see `opentelemetry_wrapper.utils.sampling`
+    for a class, they apply to all the methods and properties of that class
+    to never instrument a function or class, decorate it with `do_not_instrument`
+
     this function is idempotent; calling it multiple times has no additional side effects
 
     todo: don't recurse into pydantic dataclasses, those get re-initialized too often
 
     :param func: function or class
     :param func_name: if not set, makes an intelligent guess
+    :param sample_ratio: fraction of calls to record as spans, between 0 and 1
+    :param rate_limit: max number of calls per second to record as spans
+    :param aggregate: collapse calls under the same parent span into one summary span; if not set, check the rules
     :return:
     """
     # avoid re-instrumenting (or double-instrumenting) things
     # this requires slightly more complex logic than lru_cache provides
-    if func in _CACHE_INSTRUMENTED:
-        if _CACHE_INSTRUMENTED[func] is None:
+    _cached = _CACHE_INSTRUMENTED.get(func, _MISSING)
+    if _cached is not _MISSING:
+        if _cached is None:
             return func
-        return _CACHE_INSTRUMENTED[func]
-
-    # if not provided, try to find the function name
-    code_info = CodeInfo(func)
-    func_name = func_name or code_info.name
-
-    # build span attributes for this class / function / method / builtin / etc
-    span_attributes = dict()
-    if code_info.function_name:
-        span_attributes[SpanAttributes.CODE_FUNCTION] = code_info.function_name
-    if code_info.module_name:
-        span_attributes[SpanAttributes.CODE_NAMESPACE] = code_info.module_name
-    if code_info.path:
-        span_attributes[SpanAttributes.CODE_FILEPATH] = str(code_info.path)
-    if code_info.lineno:
-        span_attributes[SpanAttributes.CODE_LINENO] = code_info.lineno
+        return _cached
+
+    # skip anything marked as do-not-instrument
+    qualified_name = qualified_name_of(func)
+    if _is_marked_do_not_instrument(func) or is_do_not_instrument(qualified_name):
+        _CACHE_INSTRUMENTED[func] = None
+        return func
 
+    # the span name (if not provided) and span attributes are only resolved when the first span is recorded
     if inspect.isclass(func):
         # noinspection PyTypeChecker
-        wrapped = _instrument_class(func, func_name, span_attributes)
+        wrapped = _instrument_class(func, SpanInfo(func, func_name),
+                                    dict(sample_ratio=sample_ratio, rate_limit=rate_limit, aggregate=aggregate))
 
     elif asyncio.iscoroutinefunction(func):  # coroutine functions are also functions, so this must be checked first
-        wrapped = _instrument_coroutine(func, func_name, span_attributes)
+        wrapped = _instrument_coroutine(func, SpanInfo(func, func_name, 'async '),
+                                        get_sampler(qualified_name, sample_ratio, rate_limit),
+                                        _get_aggregator(qualified_name, aggregate))
 
     elif inspect.isroutine(func):
-        wrapped = _instrument_routine(func, func_name, span_attributes)
+        wrapped = _instrument_routine(func, SpanInfo(func, func_name),
+                                      get_sampler(qualified_name, sample_ratio, rate_limit),
+                                      _get_aggregator(qualified_name, aggregate))
 
     # what is this?
     else:
@@ -86,16 +166,28 @@ def instrument_decorate(func: Callable,
     return wrapped
 
 
+def _get_aggregator(qualified_name: Optional[str], aggregate: Optional[bool]) -> Optional[SpanAggregator]:
+    if aggregate is None:
+        aggregate = should_aggregate(qualified_name)
+
+    # if someone else set up the tracer provider, the aggregator never sees the parent spans end
+    _aggregator = get_span_aggregator()
+    if aggregate and _aggregator.enabled:
+        return _aggregator
+
+
 def _instrument_coroutine(coro: Callable,
-                          coro_name: str,
-                          span_attributes: dict,
+                          span_info: SpanInfo,
+                          sampler: Optional[Sampler] = None,
+                          aggregator: Optional[SpanAggregator] = None,
                           ) -> Callable:
     """
     coroutines need an async decorator
 
     :param coro:
-    :param coro_name:
-    :param span_attributes:
+    :param span_info: span name and attributes
+    :param sampler: if set, calls that are not sampled skip the tracer entirely
+    :param aggregator: if set, calls within a parent span are aggregated instead of creating a span each
     :return:
     """
 
@@ -106,7 +198,24 @@ def _instrument_coroutine(coro: Callable,
 
     @wraps(coro)
     async def wrapped(*args, **kwargs):
-        with _TRACER.start_as_current_span(f'async {coro_name}', attributes=span_attributes) as span:
+        if sampler is not None and not sampler():
+            return await coro(*args, **kwargs)
+
+        span_name, span_attributes = span_info.get()
+
+        if aggregator is not None:
+            parent = get_current_span()
+            if parent.is_recording():
+                start_ns = time.time_ns()
+                try:
+                    ret = await coro(*args, **kwargs)
+                except BaseException as e:
+                    aggregator.record(_TRACER, span_name, span_attributes, parent, start_ns, time.time_ns(), e)
+                    raise
+                aggregator.record(_TRACER, span_name, span_attributes, parent, start_ns, time.time_ns())
+                return ret
+
+        with _TRACER.start_as_current_span(span_name, attributes=span_attributes) as span:
             ret = await coro(*args, **kwargs)
             if span.is_recording():
                 # span.set_attribute(SpanAttributes.HTTP_STATUS_CODE, result.status_code)
@@ -117,15 +226,17 @@ def _instrument_coroutine(coro: Callable,
 
 
 def _instrument_routine(func: Callable,
-                        func_name: str,
-                        span_attributes: dict,
+                        span_info: SpanInfo,
+                        sampler: Optional[Sampler] = None,
+                        aggregator: Optional[SpanAggregator] = None,
                         ) -> Callable:
     """
     normal routines (functions, class methods, builtins) just use a normal decorator
 
     :param func:
-    :param func_name:
-    :param span_attributes:
+    :param span_info: span name and attributes
+    :param sampler: if set, calls that are not sampled skip the tracer entirely
+    :param aggregator: if set, calls within a parent span are aggregated instead of creating a span each
     :return:
     """
 
@@ -137,7 +248,24 @@ def _instrument_routine(func: Callable,
 
     @wraps(func)
     def wrapped(*args, **kwargs):
-        with _TRACER.start_as_current_span(func_name, attributes=span_attributes) as span:
+        if sampler is not None and not sampler():
+            return func(*args, **kwargs)
+
+        span_name, span_attributes = span_info.get()
+
+        if aggregator is not None:
+            parent = get_current_span()
+            if parent.is_recording():
+                start_ns = time.time_ns()
+                try:
+                    ret = func(*args, **kwargs)
+                except BaseException as e:
+                    aggregator.record(_TRACER, span_name, span_attributes, parent, start_ns, time.time_ns(), e)
+                    raise
+                aggregator.record(_TRACER, span_name, span_attributes, parent, start_ns, time.time_ns())
+                return ret
+
+        with _TRACER.start_as_current_span(span_name, attributes=span_attributes) as span:
             ret = func(*args, **kwargs)
             if span.is_recording():
                 span.set_status(Status(StatusCode.OK))
@@ -146,19 +274,128 @@ def _instrument_routine(func: Callable,
     return wrapped
 
 
+_DISPATCH_PLAIN = object()  # anything that isn't a property or method; can be overridden per-instance
+_DISPATCH_AS_IS = object()  # already instrumented, or marked as do-not-instrument
+_DISPATCH_DYNAMIC = object()  # some other descriptor, so we can't know what it returns until it's read
+_DISPATCH_PROPERTY = object()
+_DISPATCH_ROUTINE = object()
+
+# a cheap check for things that `inspect.isclass` or `inspect.isroutine` would accept
+_MAYBE_ROUTINE_TYPES = (type, FunctionType, MethodType, BuiltinFunctionType)
+
+# set on classes defined in python; the others (e.g. `object`) can't be modified, so they never need rechecking
+_Py_TPFLAGS_HEAPTYPE = 1 << 9
+
+
+class _AttributeDispatch:
+    """
+    precomputed info about how to get an attribute from an instrumented class
+    also remembers where the attribute was found, so the entry can be rebuilt if the class is modified
+    """
+    __slots__ = ('kind', 'owner', 'raw', 'owner_dict', 'shadowing_dicts',
+                 'func', 'wrapped', 'span_name', 'span_attributes', 'sampler')
+
+    def __init__(self, kind, cls, owner, raw, *,
+                 func=None, wrapped=None, span_name=None, span_attributes=None, sampler=None):
+        self.kind = kind
+        self.owner: Optional[type] = owner  # the class in the mro that defines the attribute, or None
+        self.raw = raw  # the attribute as defined in the class, or `_MISSING`
+
+        # the namespaces to recheck on each read: the owner's (if it can change), and those that could shadow it
+        _mro = cls.__mro__
+        _mutable = [_cls for _cls in _mro[:_mro.index(owner) if owner is not None else len(_mro)]
+                    if _cls.__flags__ & _Py_TPFLAGS_HEAPTYPE]
+        self.owner_dict = owner.__dict__ if owner is not None and owner.__flags__ & _Py_TPFLAGS_HEAPTYPE else None
+        self.shadowing_dicts = tuple(_cls.__dict__ for _cls in _mutable)
+
+        self.func: Optional[Callable] = func
+        self.wrapped: Optional[Callable] = wrapped
+        self.span_name: Optional[str] = span_name
+        self.span_attributes: Optional[dict] = span_attributes
+        self.sampler: Optional[Sampler] = sampler
+
+
+def _instrument_attribute(obj, decorate_kwargs: dict):
+    """
+    wrap if the retrieved object is a method, coroutine, or nested class
+    """
+    if inspect.isclass(obj) or inspect.isroutine(obj):
+        return instrument_decorate(obj, **decorate_kwargs)
+
+    # no clue what this is, just return it
+    return obj
+
+
+def _build_dispatch_entry(cls: type,
+                          name: str,
+                          span_info: SpanInfo,
+                          decorate_kwargs: dict,
+                          ) -> Union[object, _AttributeDispatch]:
+    """
+    figure out what kind of class attribute this is, and do all the expensive work up front
+
+    :return: a `_AttributeDispatch`, whose kind is one of the `_DISPATCH_*` sentinels
+    """
+    # find the attribute without triggering any descriptors
+    for owner in cls.__mro__:
+        if name in owner.__dict__:
+            raw = owner.__dict__[name]
+            break
+    else:
+        return _AttributeDispatch(_DISPATCH_PLAIN, cls, None, _MISSING)  # must be an instance attribute
+
+    if isinstance(raw, (property, cached_property)):
+        fget = raw.fget if isinstance(raw, property) else raw.func
+        if _is_marked_do_not_instrument(fget):
+            return _AttributeDispatch(_DISPATCH_AS_IS, cls, owner, raw)
+
+        # get line of code for the property if possible
+        _attribs = dict()
+        _attribs.update(span_info.get()[1])
+        _lineno = getattr(getattr(fget, '__code__', None), 'co_firstlineno', None)
+        if _lineno:
+            _attribs[SpanAttributes.CODE_LINENO] = _lineno
+
+        return _AttributeDispatch(_DISPATCH_PROPERTY, cls, owner, raw,
+                                  span_name=f'property {span_info.name}.{name}',
+                                  span_attributes=_attribs,
+                                  sampler=get_sampler(f'{qualified_name_of(cls)}.{name}',
+                                                      decorate_kwargs['sample_ratio'],
+                                                      decorate_kwargs['rate_limit']))
+
+    if isinstance(raw, (staticmethod, classmethod)):
+        func = raw.__func__
+    elif isinstance(raw, FunctionType):
+        func = raw
+    elif hasattr(raw, '__get__') or inspect.isclass(raw):
+        # builtin methods, slot wrappers, nested classes, other descriptors
+        return _AttributeDispatch(_DISPATCH_DYNAMIC, cls, owner, raw)
+    else:
+        # e.g. a class variable or the default value of a dataclass field
+        return _AttributeDispatch(_DISPATCH_PLAIN, cls, owner, raw)
+
+    wrapped = instrument_decorate(func, **decorate_kwargs)
+    if wrapped is func:
+        return _AttributeDispatch(_DISPATCH_AS_IS, cls, owner, raw)
+    return _AttributeDispatch(_DISPATCH_ROUTINE, cls, owner, raw, func=func, wrapped=wrapped)
+
+
 def _instrument_class(cls: type,
-                      class_name: str,
-                      span_attributes: dict,
+                      span_info: SpanInfo,
+                      decorate_kwargs: dict,
                       ) -> type:
     """
     somewhat complex logic to wrap all methods and properties in a class
     actually wraps the getattribute dunder (magic method) so it can cover as much ground as possible
+    each attribute name is looked up in the class once, and the result is cached in a per-class dispatch table
+    so reading a plain field costs only a few dict lookups more than it would on an uninstrumented class
+    each read rechecks where the attribute was found, so entries are rebuilt if the class (or a base) is modified
     to uninstrument, replace cls.func with cls.dunder.__wrapped__ for dunder in new, init, call, and getattribute
     this function is idempotent; calling it multiple times has no additional side effects
 
     :param cls:
-    :param class_name:
-    :param span_attributes:
+    :param span_info: class name and span attributes
+    :param decorate_kwargs: sampling and aggregation kwargs to pass through to `instrument_decorate` for each method
     :return:
     """
 
@@ -167,54 +404,87 @@ def _instrument_class(cls: type,
     assert inspect.isclass(cls)
     assert not inspect.isroutine(cls)
 
+    class_name = span_info.name
+
     # wrap the constructors if they exist
     if cls.__new__ is not object.__new__:
-        cls.__new__ = instrument_decorate(cls.__new__, func_name=f'{class_name}.__new__')
+        cls.__new__ = instrument_decorate(cls.__new__, func_name=f'{class_name}.__new__', **decorate_kwargs)
     if cls.__init__ is not object.__init__:
-        cls.__init__ = instrument_decorate(cls.__init__, func_name=f'{class_name}.__init__')
+        cls.__init__ = instrument_decorate(cls.__init__, func_name=f'{class_name}.__init__', **decorate_kwargs)
     # todo: also wrap __post_init__
 
     # also wrap the call method, if it exists
     if not isinstance(cls.__call__, type(object.__call__)):
-        cls.__call__ = instrument_decorate(cls.__call__, func_name=f'{class_name}.__call__')
+        cls.__call__ = instrument_decorate(cls.__call__, func_name=f'{class_name}.__call__', **decorate_kwargs)
 
     # wrap the generic attribute getter to auto-wrap all methods
+    # if this class inherited an instrumented getter, wrap the original getter instead to avoid double spans
     _original_getattribute = cls.__getattribute__
-    if _original_getattribute not in _CACHE_GETATTRIBUTE:
-
-        @wraps(cls.__getattribute__)
-        def wrapped_getattribute(*args, **kwargs):
-
-            # if it's a property, start a trace before getting it
-            if isinstance(getattr(cls, args[1], None), (property, cached_property)):
-
-                # get line of code for the property if possible
-                if hasattr(getattr(cls, args[1]), 'fget'):
-                    _attribs = dict()
-                    _attribs.update(span_attributes)
-                    _attribs[SpanAttributes.CODE_LINENO] = inspect.getsourcelines(getattr(cls, args[1]).fget)[1]
-                else:
-                    _attribs = span_attributes
-
-                # instrument the property call
-                with _TRACER.start_as_current_span(f'property {class_name}.{args[1]}', attributes=_attribs) as span:
-                    ret = _original_getattribute(*args, **kwargs)
-                    if span.is_recording():
-                        span.set_status(Status(StatusCode.OK))
-                    return ret
-
-            # otherwise just get it
-            obj = _original_getattribute(*args, **kwargs)
-
-            # wrap if the retrieved object is a method, coroutine, or nested class
-            if inspect.isclass(obj) or inspect.isroutine(obj):
-                return instrument_decorate(obj)
-
-            # no clue what this is, just return it
-            else:
-                return obj
-
-        cls.__getattribute__ = wrapped_getattribute
-        _CACHE_GETATTRIBUTE[_original_getattribute] = wrapped_getattribute
+    _inherited_original = _CACHE_GETATTRIBUTE.get(_original_getattribute, _MISSING)
+    if _inherited_original is not _MISSING:
+        if '__getattribute__' in cls.__dict__:
+            return cls  # already instrumented
+        _original_getattribute = _inherited_original
+
+    # maps attribute name -> how to get it, built lazily on first access of each attribute
+    dispatch_table: Dict[str, _AttributeDispatch] = dict()
+
+    @wraps(_original_getattribute)
+    def wrapped_getattribute(self, name):
+        entry = dispatch_table.get(name)
+        if entry is None:
+            entry = dispatch_table[name] = _build_dispatch_entry(cls, name, span_info, decorate_kwargs)
+        else:
+            # rebuild the entry if the class was modified since (inlined, since this runs on every read)
+            owner_dict = entry.owner_dict
+            stale = owner_dict is not None and owner_dict.get(name, _MISSING) is not entry.raw
+            if not stale:
+                for namespace in entry.shadowing_dicts:
+                    if name in namespace:
+                        stale = True
+                        break
+            if stale:
+                entry = dispatch_table[name] = _build_dispatch_entry(cls, name, span_info, decorate_kwargs)
+        kind = entry.kind
+
+        # fast path for plain fields, which are the most common thing to read
+        if kind is _DISPATCH_PLAIN:
+            obj = _original_getattribute(self, name)
+            if isinstance(obj, _MAYBE_ROUTINE_TYPES):
+                return _instrument_attribute(obj, decorate_kwargs)
+            return obj
+
+        if kind is _DISPATCH_AS_IS:
+            return _original_getattribute(self, name)
+
+        if kind is _DISPATCH_DYNAMIC:
+            return _instrument_attribute(_original_getattribute(self, name), decorate_kwargs)
+
+        if kind is _DISPATCH_ROUTINE:
+            obj = _original_getattribute(self, name)
+
+            # use the pre-wrapped function, but only if it's still the same function
+            if type(obj) is MethodType and obj.__func__ is entry.func:
+                return MethodType(entry.wrapped, obj.__self__)
+            if obj is entry.func:
+                return entry.wrapped
+            return _instrument_attribute(obj, decorate_kwargs)
+
+        # it's a property; skip the tracer entirely if this call isn't sampled
+        if entry.sampler is not None and not entry.sampler():
+            return _original_getattribute(self, name)
+
+        # instrument the property call
+        with _TRACER.start_as_current_span(entry.span_name, attributes=entry.span_attributes) as span:
+            ret = _original_getattribute(self, name)
+            if span.is_recording():
+                span.set_status(Status(StatusCode.OK))
+            return ret
+
+    # in case the class is modified in a way that isn't auto-detected (e.g. assigning to `__bases__`)
+    wrapped_getattribute.cache_clear = dispatch_table.clear
+
+    cls.__getattribute__ = wrapped_getattribute
+    _CACHE_GETATTRIBUTE[wrapped_getattribute] = _original_getattribute
 
     return cls
@@ -1,10 +1,18 @@
+import time
+from typing import List
+from typing import Optional
+
 import fastapi
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
 from opentelemetry.sdk.trace import Span
+from opentelemetry.sdk.util import ns_to_iso_str
 from starlette.datastructures import Headers
 from starlette.types import Scope
 
 from opentelemetry_wrapper.instrument_decorator import instrument_decorate
+from opentelemetry_wrapper.utils.span_store import SpanStore
+from opentelemetry_wrapper.utils.span_store import enable_span_store
+from opentelemetry_wrapper.utils.span_store import get_span_store
 
 _HEADER_ATTRIBUTES = (
     # 'user-agent',
@@ -45,12 +53,91 @@ def request_hook(span: Span, scope: Scope) -> None:
             span.set_attribute(header_name, header_value)
 
 
+def _json_list_response(items: List[str]) -> fastapi.Response:
+    """
+    the stored spans are already json, so don't decode and re-encode them
+    """
+    return fastapi.Response(content=f'[{",".join(items)}]', media_type='application/json')
+
+
+def _get_store() -> SpanStore:
+    _store = get_span_store()
+    if _store is None:
+        raise fastapi.HTTPException(status_code=503, detail='span store is not enabled')
+    return _store
+
+
+def get_span_store_router() -> fastapi.APIRouter:
+    """
+    read-only endpoints for the span store (see `utils/span_store.py`)
+    """
+    router = fastapi.APIRouter(tags=['span store'])
+
+    # before `/traces/{trace_id}`, which would otherwise match it
+    @router.get('/traces/errors')
+    def error_traces(minutes: float = 15, limit: int = 100) -> List[dict]:
+        """
+        traces with an error in the last `minutes`, most recent first
+        """
+        _since_ns = time.time_ns() - int(minutes * 60 * 1e9)
+        return [{'trace_id':        f'0x{_trace_id:032x}',
+                 'span_count':      _span_count,
+                 'error_count':     _error_count,
+                 'last_error_time': ns_to_iso_str(_last_ns)}
+                for _trace_id, _span_count, _error_count, _last_ns in _get_store().error_traces(_since_ns, limit)]
+
+    @router.get('/traces/{trace_id}')
+    def trace_by_id(trace_id: str) -> fastapi.Response:
+        """
+        all stored spans of a trace, by start time; the id is hex, with or without `0x`
+        """
+        try:
+            _trace_id = int(trace_id[2:] if trace_id.lower().startswith('0x') else trace_id, 16)
+        except ValueError:
+            raise fastapi.HTTPException(status_code=400, detail=f'invalid trace id: {trace_id!r}')
+        _spans = _get_store().trace(_trace_id)
+        if not _spans:
+            raise fastapi.HTTPException(status_code=404, detail=f'trace not found: {trace_id!r}')
+        return _json_list_response(_spans)
+
+    @router.get('/spans/slowest')
+    def slowest_spans(name: Optional[str] = None, service: Optional[str] = None, limit: int = 20) -> fastapi.Response:
+        """
+        the slowest stored spans, optionally only those with this span name and / or service name
+        """
+        return _json_list_response(_get_store().slowest(name=name, service=service, limit=limit))
+
+    @router.get('/spans/recent')
+    def recent_spans(service: Optional[str] = None, limit: int = 20) -> fastapi.Response:
+        """
+        the most recently ended spans, optionally only from this service
+        """
+        return _json_list_response(_get_store().recent(service=service, limit=limit))
+
+    @router.get('/services')
+    def services() -> dict:
+        """
+        service name -> number of stored spans
+        """
+        return _get_store().services()
+
+    return router
+
+
+# set on apps that already have the span store router, so it's only mounted once
+_SPAN_STORE_PREFIX_ATTRIBUTE = '_opentelemetry_wrapper_span_store_prefix'
+
+
 @instrument_decorate
-def instrument_fastapi_app(app: fastapi.FastAPI) -> fastapi.FastAPI:
+def instrument_fastapi_app(app: fastapi.FastAPI, span_store_prefix: Optional[str] = None) -> fastapi.FastAPI:
     """
     instrument a FastAPI app
     also instruments logging and requests (if requests exists)
     this function is idempotent; calling it multiple times has no additional side effects
+
+    :param span_store_prefix: if set (e.g. `/debug/spans`), mount endpoints to query recent spans under this path,
+                              and keep recent spans in memory if the span store isn't already enabled
+                              (only for dev / staging, since anyone who can reach the app can read them)
     """
 
     if not getattr(app, '_is_instrumented_by_opentelemetry', None):
@@ -58,6 +145,12 @@ def instrument_fastapi_app(app: fastapi.FastAPI) -> fastapi.FastAPI:
                                            server_request_hook=request_hook,
                                            client_request_hook=request_hook,
                                            )
+
+    if span_store_prefix is not None and getattr(app, _SPAN_STORE_PREFIX_ATTRIBUTE, None) is None:
+        if get_span_store() is None:
+            enable_span_store()
+        app.include_router(get_span_store_router(), prefix=span_store_prefix.rstrip('/'))
+        setattr(app, _SPAN_STORE_PREFIX_ATTRIBUTE, span_store_prefix)
     return app
 
 
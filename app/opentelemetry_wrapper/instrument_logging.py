@@ -1,11 +1,13 @@
-import datetime
 import json
 import logging
+import math
 import sys
 from functools import lru_cache
-from functools import update_wrapper
-from functools import wraps
+from json.encoder import encode_basestring
+from json.encoder import encode_basestring_ascii
 from pathlib import Path
+from typing import Any
+from typing import Callable
 from typing import Dict
 from typing import Iterable
 from typing import List
@@ -17,15 +19,27 @@ from typing import Union
 from opentelemetry.instrumentation.logging import LoggingInstrumentor
 
 from opentelemetry_wrapper.instrument_decorator import instrument_decorate
+from opentelemetry_wrapper.utils.batching_handler import BatchingQueueHandler
+from opentelemetry_wrapper.utils.batching_handler import OVERFLOW_DROP_OLDEST
+from opentelemetry_wrapper.utils.file_sink import COMPRESSION_GZIP
+from opentelemetry_wrapper.utils.file_sink import RotatingFileSink
+from opentelemetry_wrapper.utils.json_encoder import EncodingBudget
 from opentelemetry_wrapper.utils.json_encoder import jsonable_encoder
-
-# write IDs as 0xBEEF instead of BEEF so it matches the trace json exactly
+from opentelemetry_wrapper.utils.json_encoder import truncate_string
+from opentelemetry_wrapper.utils.log_context import make_record_factory
+from opentelemetry_wrapper.utils.loki_handler import LokiHandler
+from opentelemetry_wrapper.utils.rate_limit_filter import CallsiteRateLimitFilter
+from opentelemetry_wrapper.utils.tail_buffer import TailBufferHandler
+from opentelemetry_wrapper.utils.timestamps import TimestampRenderer
+
+# IDs are written as 0xBEEF instead of BEEF (see `utils/log_context.py`) so it matches the trace json exactly
 LOGGING_FORMAT_VERBOSE = (
     '%(asctime)s '
     '%(levelname)-8s '
     '[%(name)s] '
     '[%(filename)s:%(funcName)s:%(lineno)d] '
-    '[trace_id=0x%(otelTraceID)s span_id=0x%(otelSpanID)s resource.service.name=%(otelServiceName)s] '
+    '[trace_id=%(otelTraceID)s span_id=%(otelSpanID)s '
+    'resource.service.name=%(otelServiceName)s process.pid=%(process)d] '
     '- %(message)s'
 )
 
@@ -38,6 +52,41 @@ LOGGING_FORMAT_MINIMAL = (
     '%(message)s'
 )
 
+# LogRecord attributes that are (almost) always this type, so they can be written to json directly
+# if the type is different (e.g. someone set `record.lineno = None`), they go through the generic encoder instead
+_STRING_RECORD_ATTRIBUTES = frozenset({
+    'asctime',
+    'exc_text',
+    'filename',
+    'funcName',
+    'levelname',
+    'message',
+    'module',
+    'name',
+    'otelServiceName',
+    'otelSpanID',
+    'otelTraceID',
+    'pathname',
+    'processName',
+    'stack_info',
+    'taskName',
+    'threadName',
+    'tz_name',
+})
+_NUMBER_RECORD_ATTRIBUTES = frozenset({
+    'created',
+    'levelno',
+    'lineno',
+    'msecs',
+    'process',
+    'relativeCreated',
+    'thread',
+    'tz_utc_offset_seconds',
+})
+
+# set by the formatter if `usesTime()`
+_TIME_RECORD_ATTRIBUTES = ('asctime', 'tz_name', 'tz_utc_offset_seconds')
+
 
 class JsonFormatter(logging.Formatter):
     """
@@ -53,21 +102,23 @@ class JsonFormatter(logging.Formatter):
                  indent: Optional[int] = None,
                  separators: Optional[Tuple[str, str]] = None,
                  sort_keys: bool = False,
+                 budget: Optional[EncodingBudget] = EncodingBudget(),
                  ) -> None:
         """
         see https://docs.python.org/3/library/logging.html#logrecord-attributes for record keys
         (opentelemetry also adds `otelSpanID`, `otelTraceID`, and `otelServiceName`)
 
-        :param keys: list of LogRecord attributes, or mapper from LogRecord attribute name -> output json key name
-        :param datefmt: date format string; if not set, defaults to ISO8601
+        :param keys: list of LogRecord attributes, or mapper from output json key name -> LogRecord attribute name
+        :param datefmt: `time.strftime` format string; if not set, defaults to ISO8601 with microseconds
         :param ensure_ascii: see `json.dumps` docs
         :param allow_nan: see `json.dumps` docs
         :param indent: see `json.dumps` docs
         :param separators: see `json.dumps` docs
         :param sort_keys: see `json.dumps` docs
+        :param budget: limits how deep / long / large the encoded record can be; None for unlimited
         """
 
-        super().__init__(datefmt)
+        super().__init__(datefmt=datefmt)
 
         self._keys: Optional[Dict[str, str]]
         if isinstance(keys, dict):
@@ -88,12 +139,100 @@ class JsonFormatter(logging.Formatter):
         self.indent = indent
         self.separators = separators
         self.sort_keys = sort_keys
+        self.budget = budget
+
+        # caches the rendered date and time (and timezone) per second
+        self._timestamps = TimestampRenderer(datefmt, converter=self.converter)
+
+        # a fixed set of keys means the output layout is known, so build a specialized format function for it
+        self._format_compiled: Optional[Callable[[logging.LogRecord], str]] = None
+        if self._keys is not None and self.indent is None:
+            self._format_compiled = self._compile()
 
-        # noinspection PyTypeChecker
-        self.tz = datetime.datetime.now(datetime.timezone.utc).astimezone().tzinfo
+    def _encode_string(self, value: str) -> str:
+        value = truncate_string(value, self.budget.max_string_length if self.budget is not None else None)
+        return encode_basestring_ascii(value) if self.ensure_ascii else encode_basestring(value)
+
+    def _encode_value(self, value: Any) -> str:
+        """
+        the generic (slow) path, used for values of unknown type, e.g. `extra={...}`
+        """
+        if value is None:
+            return 'null'
+
+        # noinspection PyBroadException
+        try:
+            return json.dumps(jsonable_encoder(value, budget=self.budget),
+                              ensure_ascii=self.ensure_ascii,
+                              allow_nan=self.allow_nan,
+                              separators=self.separators,
+                              sort_keys=self.sort_keys)
+
+        # failsafe: stringify using `repr()`
+        except Exception:
+            # noinspection PyBroadException
+            try:
+                return self._encode_string(repr(value))
+            except Exception:
+                return 'null'
+
+    def _compile(self) -> Callable[[logging.LogRecord], str]:
+        """
+        builds a format function for `self._keys`, equivalent to (but much faster than) the generic path in `format`
+        * keys and separators are encoded once
+        * strings and numbers from the LogRecord are written directly
+        * only everything else (e.g. `msg`, `args`, or `extra={...}`) goes through `jsonable_encoder`
+
+        note that the budget is applied to each value separately rather than to the record as a whole
+        """
+        assert self._keys is not None
+        _item_separator, _key_separator = self.separators or (', ', ': ')
+        _encode_string = encode_basestring_ascii if self.ensure_ascii else encode_basestring
+        _max_string_length = self.budget.max_string_length if self.budget is not None else None
+        _encode_value = self._encode_value
+
+        def encode_string_attribute(value: Any) -> str:
+            if type(value) is str:
+                return _encode_string(truncate_string(value, _max_string_length))
+            return _encode_value(value)
+
+        def encode_number_attribute(value: Any) -> str:
+            if type(value) is int:
+                return int.__repr__(value)
+            if type(value) is float and math.isfinite(value):
+                return float.__repr__(value)
+            return _encode_value(value)
+
+        # (literal json text before the value, record attribute name, value encoder)
+        _fields: List[Tuple[str, str, Callable[[Any], str]]] = []
+        _literal = '{'
+        _items = sorted(self._keys.items(), key=lambda item: item[0]) if self.sort_keys else self._keys.items()
+        for _index, (_json_key, _attribute_name) in enumerate(_items):
+            if _index:
+                _literal += _item_separator
+            _literal += _encode_string(_json_key) + _key_separator
+            if _attribute_name in _STRING_RECORD_ATTRIBUTES:
+                _fields.append((_literal, _attribute_name, encode_string_attribute))
+            elif _attribute_name in _NUMBER_RECORD_ATTRIBUTES:
+                _fields.append((_literal, _attribute_name, encode_number_attribute))
+            else:
+                _fields.append((_literal, _attribute_name, _encode_value))
+            _literal = ''
+        _suffix = _literal + '}'
+        _fields_tuple = tuple(_fields)
+
+        def format_compiled(record: logging.LogRecord) -> str:
+            _parts = [_literal + _encoder(getattr(record, _attribute_name, None))
+                      for _literal, _attribute_name, _encoder in _fields_tuple]
+            _parts.append(_suffix)
+            return ''.join(_parts)
+
+        return format_compiled
 
     def usesTime(self):
-        return self._keys is None or 'asctime' in self._keys
+        if self._keys is None:
+            return True
+        return any(_attribute_name in self._keys.values() for _attribute_name in _TIME_RECORD_ATTRIBUTES)
 
     def formatMessage(self, record: logging.LogRecord):
         raise DeprecationWarning
@@ -120,17 +259,18 @@ class JsonFormatter(logging.Formatter):
 
         # add `asctime`, `tz_name`, and `tz_utc_offset_seconds`
         if self.usesTime():
-            record.tz_name = self.tz.tzname(None)
-            record.tz_utc_offset_seconds = self.tz.utcoffset(None).seconds
-            if self.datefmt:
-                record.asctime = self.formatTime(record, self.datefmt)
-            else:
-                record.asctime = datetime.datetime.fromtimestamp(record.created, tz=self.tz).isoformat()
+            _asctime, _tz_name, _tz_utc_offset_seconds = self._timestamps.render_with_tz(record.created)
+            record.asctime = _asctime
+            record.tz_name = _tz_name
+            record.tz_utc_offset_seconds = _tz_utc_offset_seconds
 
         # add `exc_text`
         if record.exc_info and not record.exc_text:
             record.exc_text = self.formatException(record.exc_info)
 
+        if self._format_compiled is not None:
+            return self._format_compiled(record)
+
         if self._keys is not None:
             log_data = {k: getattr(record, v, None) for k, v in self._keys.items()}
         else:
@@ -138,7 +278,7 @@ class JsonFormatter(logging.Formatter):
 
         # noinspection PyBroadException
         try:
-            safe_log_data = jsonable_encoder(log_data)
+            safe_log_data = jsonable_encoder(log_data, budget=self.budget)
 
         # failsafe: stringify everything using `repr()`
         except Exception:
@@ -154,22 +294,16 @@ class JsonFormatter(logging.Formatter):
                         continue  # failed, skip key
 
                 # encode value
-                if isinstance(v, (int, float, bool, str, type(None))):
+                if isinstance(v, (int, float, bool, type(None))):
                     safe_log_data[k] = v
                 else:
                     # noinspection PyBroadException
                     try:
-                        safe_log_data[k] = repr(v)
+                        v = v if isinstance(v, str) else repr(v)
+                        safe_log_data[k] = truncate_string(v, self.budget.max_string_length if self.budget else None)
                     except Exception:
                         continue  # failed, skip key
 
-        # truncate extremely long things
-        # todo: make the length a specifiable parameter
-        # todo: handle other jsonable object types more intelligently
-        for k, v in safe_log_data.items():
-            if isinstance(v, str) and len(v) > 10000:
-                k[v] = f'{v[:9985]}... (truncated)'
-
         return json.dumps(safe_log_data,
                           ensure_ascii=self.ensure_ascii,
                           allow_nan=self.allow_nan,
@@ -183,28 +317,107 @@ def get_json_handler(*,
                      level: int = logging.NOTSET,
                      path: Optional[Path] = None,
                      stream: Optional[TextIO] = None,
+                     queue_size: Optional[int] = None,
+                     overflow_policy: str = OVERFLOW_DROP_OLDEST,
+                     max_bytes: Optional[int] = 100 * 1024 * 1024,
+                     rotate_interval: Optional[float] = None,
+                     backup_count: Optional[int] = 10,
+                     compression: Optional[str] = COMPRESSION_GZIP,
                      ) -> logging.Handler:
+    """
+    :param level: handler level
+    :param path: append to this file, with buffering, rotation, and compression (see `RotatingFileSink`)
+    :param stream: write to this stream (defaults to stderr if `path` is also not set)
+    :param queue_size: if set, format and write records in batches on a background thread (see `BatchingQueueHandler`)
+    :param overflow_policy: what to do when the queue is full, one of `OVERFLOW_POLICIES`
+    :param max_bytes: (path only) rotate when the file reaches this size
+    :param rotate_interval: (path only) rotate when the file is this many seconds old
+    :param backup_count: (path only) number of rotated files to keep
+    :param compression: (path only) how to compress rotated files, `COMPRESSION_GZIP`, `COMPRESSION_ZSTD`, or None
+    """
     if path is not None and stream is not None:
         raise ValueError('cannot set both path and stream')
 
     if path is not None:
-        handler = logging.FileHandler(path)
-    elif stream is not None:
-        handler = logging.StreamHandler(stream=stream)
+        stream = RotatingFileSink(path,
+                                  max_bytes=max_bytes,
+                                  rotate_interval=rotate_interval,
+                                  backup_count=backup_count,
+                                  compression=compression)
+
+    handler: logging.Handler
+    if queue_size is not None:
+        handler = BatchingQueueHandler(stream=stream, queue_size=queue_size, overflow_policy=overflow_policy)
     else:
-        handler = logging.StreamHandler(stream=sys.stderr)
+        handler = logging.StreamHandler(stream=stream if stream is not None else sys.stderr)
 
     handler.setFormatter(JsonFormatter())
     handler.setLevel(level)
     return handler
 
 
+@lru_cache  # avoid creating duplicate handlers
+def get_loki_handler(url: str,
+                     *,
+                     level: int = logging.NOTSET,
+                     queue_size: Optional[int] = None,
+                     overflow_policy: str = OVERFLOW_DROP_OLDEST,
+                     ) -> logging.Handler:
+    """
+    push json logs directly to Loki in gzipped batches, see `utils/loki_handler.py`
+
+    :param url: Loki push endpoint, e.g. `http://localhost:3100/loki/api/v1/push`
+    :param level: handler level
+    :param queue_size: max number of records waiting to be pushed
+    :param overflow_policy: what to do when the queue is full, one of `OVERFLOW_POLICIES`
+    """
+    if queue_size is not None:
+        handler = LokiHandler(url, level=level, queue_size=queue_size, overflow_policy=overflow_policy)
+    else:
+        handler = LokiHandler(url, level=level, overflow_policy=overflow_policy)
+    handler.setFormatter(JsonFormatter())
+    return handler
+
+
+@lru_cache  # avoid creating duplicate handlers
+def get_tail_buffer_handler(target: logging.Handler,
+                            *,
+                            level: int = logging.NOTSET,
+                            threshold: int = logging.INFO,
+                            latency_threshold_ms: Optional[float] = None,
+                            ) -> logging.Handler:
+    """
+    buffer records below `threshold` per trace, and only pass them to `target` if the trace errors or is slow
+    see `utils/tail_buffer.py`
+    """
+    return TailBufferHandler(target, level=level, threshold=threshold, latency_threshold_ms=latency_threshold_ms)
+
+
+def add_rate_limit_filter(handler: logging.Handler, rate: float, burst: Optional[float] = None) -> None:
+    """
+    rate-limit records per callsite, see `utils/rate_limit_filter.py`
+    idempotent; does nothing if the handler already has one
+    """
+    if any(isinstance(_filter, CallsiteRateLimitFilter) for _filter in handler.filters):
+        return
+    handler.addFilter(CallsiteRateLimitFilter(rate, burst, summary_handler=handler))
+
+
 @instrument_decorate
 def instrument_logging(*,
                        level: int = logging.NOTSET,
                        print_json: bool = True,
                        verbose: bool = True,
                        force_reinstrumentation: bool = False,
+                       path: Optional[Path] = None,
+                       stream: Optional[TextIO] = None,
+                       loki_url: Optional[str] = None,
+                       queue_size: Optional[int] = None,
+                       overflow_policy: str = OVERFLOW_DROP_OLDEST,
+                       tail_buffer_below: Optional[int] = None,
+                       tail_buffer_latency_ms: Optional[float] = None,
+                       rate_limit_per_callsite: Optional[float] = None,
+                       rate_limit_burst: Optional[float] = None,
                        ) -> None:
     """
     this function is (by default) idempotent; calling it multiple times has no additional side effects
@@ -213,6 +426,16 @@ def instrument_logging(*,
     :param verbose:
     :param force_reinstrumentation:
     :param level:
+    :param path: (json only) write to this file instead of stderr, rotated and compressed; see `get_json_handler`
+    :param stream: (json only) write to this stream instead of stderr
+    :param loki_url: (json only) push to this Loki endpoint instead of stderr; see `get_loki_handler`
+    :param queue_size: (json only) if set, logging never blocks on writes; see `get_json_handler`
+    :param overflow_policy: (json only) see `get_json_handler`
+    :param tail_buffer_below: (json only) if set, records below this level are only written if their trace ends
+                              with an error (or is slower than `tail_buffer_latency_ms`); see `get_tail_buffer_handler`
+    :param tail_buffer_latency_ms: (json only) see `get_tail_buffer_handler`
+    :param rate_limit_per_callsite: if set, max records per second from each line of code; see `add_rate_limit_filter`
+    :param rate_limit_burst: see `add_rate_limit_filter`
     :return:
     """
     _instrumentor = LoggingInstrumentor()
@@ -222,33 +445,38 @@ def instrument_logging(*,
         else:
             return
     _instrumentor.instrument(set_logging_format=False)
-    old_factory = logging.getLogRecordFactory()
 
-    # the instrumentor failed to use the @wraps decorator so let's do it for them
+    # replace their record factory (instead of wrapping it), see `utils/log_context.py`
+    # we want the trace-id and span-id in a log to match the span it was created in, so it's formatted to match
+    # note that logs outside a span will be assigned an invalid trace-id and span-id (all zeroes)
     # noinspection PyProtectedMember
-    if LoggingInstrumentor._old_factory is not None:
-        # noinspection PyProtectedMember
-        update_wrapper(old_factory, LoggingInstrumentor._old_factory)
-
-    @wraps(old_factory)
-    def record_factory(*args, **kwargs):
-        record = old_factory(*args, **kwargs)
-
-        # we want the trace-id and span-id in a log to match the span it was created in
-        # so we format it to match
-        # note that logs outside a span will be assigned an invalid trace-id and span-id (all zeroes)
-        record.otelTraceID = f'0x{int(record.otelTraceID, 16):032x}'
-        record.otelSpanID = f'0x{int(record.otelSpanID, 16):016x}'
-
-        return record
-
+    old_factory = LoggingInstrumentor._old_factory or logging.getLogRecordFactory()
+    record_factory = make_record_factory(old_factory)
     logging.setLogRecordFactory(record_factory)
 
     # output as json
     if print_json:
-        # todo: take in appropriate args to specify an output (e.g. to a path or stream)
         # todo: re-instrument correctly if args are different
-        json_handler = get_json_handler(level=level)
+        if loki_url is not None:
+            if path is not None or stream is not None:
+                raise ValueError('cannot set loki_url together with path or stream')
+            json_handler = get_loki_handler(loki_url,
+                                            level=level,
+                                            queue_size=queue_size,
+                                            overflow_policy=overflow_policy)
+        else:
+            json_handler = get_json_handler(level=level,
+                                            path=path,
+                                            stream=stream,
+                                            queue_size=queue_size,
+                                            overflow_policy=overflow_policy)
+        if tail_buffer_below is not None:
+            json_handler = get_tail_buffer_handler(json_handler,
+                                                   level=level,
+                                                   threshold=tail_buffer_below,
+                                                   latency_threshold_ms=tail_buffer_latency_ms)
+        if rate_limit_per_callsite is not None:
+            add_rate_limit_filter(json_handler, rate_limit_per_callsite, rate_limit_burst)
         if json_handler not in logging.root.handlers:
             logging.root.addHandler(json_handler)
         logging.root.setLevel(level)
@@ -260,3 +488,6 @@ def instrument_logging(*,
                             level=level,
                             force=True,
                             )
+        if rate_limit_per_callsite is not None:
+            for _handler in logging.root.handlers:
+                add_rate_limit_filter(_handler, rate_limit_per_callsite, rate_limit_burst)
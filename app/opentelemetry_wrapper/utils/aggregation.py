@@ -0,0 +1,212 @@
+"""
+collapse repeated calls of the same function under the same parent span into a single summary span
+
+the summary span is emitted when the parent span ends, and has the attributes
+    aggregate.count                         number of calls collapsed into this span
+    aggregate.duration.total_ns             sum of call durations
+    aggregate.duration.min_ns               fastest call
+    aggregate.duration.max_ns               slowest call
+    aggregate.duration.histogram_log2_us    call counts, where bucket `i` counts durations under `2 ** i` microseconds
+the summary span starts when the first call starts and ends when the last call ends
+
+errors and outliers are still emitted as individual spans (and not counted in the summary)
+note that spans created *inside* an aggregated call are attached to the parent span instead
+"""
+import threading
+from collections import OrderedDict
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from opentelemetry import trace
+from opentelemetry.context import Context
+from opentelemetry.sdk.trace import ReadableSpan
+from opentelemetry.sdk.trace import SpanProcessor
+from opentelemetry.trace import Span
+from opentelemetry.trace import Status
+from opentelemetry.trace import StatusCode
+from opentelemetry.trace import Tracer
+
+from opentelemetry_wrapper.utils.fork_safety import register_after_fork
+
+_HISTOGRAM_BUCKETS = 24  # the last bucket is everything over ~4 seconds
+
+
+class _Aggregate:
+    __slots__ = ('tracer', 'span_name', 'span_attributes', 'parent',
+                 'count', 'total_ns', 'min_ns', 'max_ns', 'start_ns', 'end_ns', 'histogram')
+
+    def __init__(self, tracer: Tracer, span_name: str, span_attributes: dict, parent: Span) -> None:
+        self.tracer = tracer
+        self.span_name = span_name
+        self.span_attributes = span_attributes
+        self.parent = parent
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns = 0
+        self.max_ns = 0
+        self.start_ns = 0
+        self.end_ns = 0
+        self.histogram = [0] * _HISTOGRAM_BUCKETS
+
+    def add(self, start_ns: int, end_ns: int) -> None:
+        duration_ns = end_ns - start_ns
+        if self.count == 0:
+            self.min_ns = self.max_ns = duration_ns
+            self.start_ns = start_ns
+        else:
+            self.min_ns = min(self.min_ns, duration_ns)
+            self.max_ns = max(self.max_ns, duration_ns)
+        self.count += 1
+        self.total_ns += duration_ns
+        self.end_ns = max(self.end_ns, end_ns)
+        self.histogram[min(_HISTOGRAM_BUCKETS - 1, (duration_ns // 1000).bit_length())] += 1
+
+    def emit(self) -> None:
+        _histogram = list(self.histogram)
+        while _histogram and not _histogram[-1]:
+            _histogram.pop()
+
+        _attribs = dict()
+        _attribs.update(self.span_attributes)
+        _attribs['aggregate.count'] = self.count
+        _attribs['aggregate.duration.total_ns'] = self.total_ns
+        _attribs['aggregate.duration.min_ns'] = self.min_ns
+        _attribs['aggregate.duration.max_ns'] = self.max_ns
+        _attribs['aggregate.duration.histogram_log2_us'] = _histogram
+
+        span = self.tracer.start_span(f'aggregate {self.span_name}',
+                                      context=trace.set_span_in_context(self.parent, Context()),
+                                      attributes=_attribs,
+                                      start_time=self.start_ns)
+        span.set_status(Status(StatusCode.OK))
+        span.end(end_time=self.end_ns)
+
+
+class SpanAggregator(SpanProcessor):
+    """
+    collects aggregated calls per parent span, and emits the summary spans when the parent span ends
+    this must be added to the tracer provider, otherwise aggregated calls are recorded as normal spans
+    """
+
+    def __init__(self,
+                 *,
+                 max_parents: int = 10000,
+                 outlier_threshold_ns: Optional[int] = None,
+                 outlier_ratio: float = 8.0,
+                 outlier_min_calls: int = 8,
+                 ) -> None:
+        """
+        :param max_parents: max number of parent spans to track; the oldest is flushed early if exceeded
+        :param outlier_threshold_ns: calls slower than this are always emitted as individual spans
+        :param outlier_ratio: calls slower than this multiple of the mean so far are emitted as individual spans
+        :param outlier_min_calls: don't use `outlier_ratio` until this many calls have been aggregated
+        """
+        self.max_parents = max_parents
+        self.outlier_threshold_ns = outlier_threshold_ns
+        self.outlier_ratio = outlier_ratio
+        self.outlier_min_calls = outlier_min_calls
+        self.enabled = False
+
+        self._aggregates: 'OrderedDict[int, Dict[str, _Aggregate]]' = OrderedDict()
+        self._lock = threading.Lock()
+        register_after_fork(self)
+
+    def _after_fork_in_child(self) -> None:
+        """
+        the parent emits the summaries it was aggregating
+        """
+        self._aggregates = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _is_outlier(self, aggregate: _Aggregate, duration_ns: int) -> bool:
+        if self.outlier_threshold_ns is not None and duration_ns > self.outlier_threshold_ns:
+            return True
+        if aggregate.count >= self.outlier_min_calls:
+            return duration_ns * aggregate.count > self.outlier_ratio * aggregate.total_ns
+        return False
+
+    def record(self,
+               tracer: Tracer,
+               span_name: str,
+               span_attributes: dict,
+               parent: Span,
+               start_ns: int,
+               end_ns: int,
+               exception: Optional[BaseException] = None,
+               ) -> None:
+        """
+        record a single call, which either gets aggregated or emitted immediately as an individual span
+
+        :param tracer: used to create the spans
+        :param span_name:
+        :param span_attributes:
+        :param parent: the current span when the call was made
+        :param start_ns: `time.time_ns()` at the start of the call
+        :param end_ns: `time.time_ns()` at the end of the call
+        :param exception: if the call raised
+        """
+        _overflow: List[Dict[str, _Aggregate]] = []
+        _key = parent.get_span_context().span_id
+
+        with self._lock:
+            _aggregates = self._aggregates.get(_key)
+            if _aggregates is None:
+                _aggregates = self._aggregates[_key] = dict()
+                while len(self._aggregates) > self.max_parents:
+                    _overflow.append(self._aggregates.popitem(last=False)[1])
+
+            _aggregate = _aggregates.get(span_name)
+            if _aggregate is None:
+                _aggregate = _aggregates[span_name] = _Aggregate(tracer, span_name, span_attributes, parent)
+
+            _individual = exception is not None or self._is_outlier(_aggregate, end_ns - start_ns)
+            if not _individual:
+                _aggregate.add(start_ns, end_ns)
+
+        # spans must be created outside the lock, since ending them calls `on_end`
+        for _aggregates in _overflow:
+            for _aggregate in _aggregates.values():
+                if _aggregate.count:
+                    _aggregate.emit()
+
+        if _individual:
+            span = tracer.start_span(span_name,
+                                     context=trace.set_span_in_context(parent, Context()),
+                                     attributes=span_attributes,
+                                     start_time=start_ns)
+            if exception is not None:
+                span.record_exception(exception)
+                span.set_status(Status(StatusCode.ERROR, f'{type(exception).__name__}: {exception}'))
+            else:
+                span.set_status(Status(StatusCode.OK))
+            span.end(end_time=end_ns)
+
+    def on_end(self, span: ReadableSpan) -> None:
+        with self._lock:
+            _aggregates = self._aggregates.pop(span.context.span_id, None)
+        if _aggregates:
+            for _aggregate in _aggregates.values():
+                if _aggregate.count:
+                    _aggregate.emit()
+
+    def shutdown(self) -> None:
+        self.force_flush()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        with self._lock:
+            _all_aggregates: List[Tuple[int, Dict[str, _Aggregate]]] = list(self._aggregates.items())
+            self._aggregates.clear()
+        for _, _aggregates in _all_aggregates:
+            for _aggregate in _aggregates.values():
+                if _aggregate.count:
+                    _aggregate.emit()
+        return True
+
+
+_AGGREGATOR = SpanAggregator()
+
+
+def get_span_aggregator() -> SpanAggregator:
+    return _AGGREGATOR
@@ -0,0 +1,240 @@
+"""
+a logging handler that never formats or writes on the calling thread
+
+records go into a bounded queue (a `deque`, so appending doesn't need a lock)
+a background thread formats them and writes each batch with a single `write` call
+when the queue is full, the overflow policy decides whether to wait, drop the oldest record, or drop the new one
+
+note that records are formatted later on another thread, so mutable `args` should not be modified after logging
+"""
+import atexit
+import logging
+import sys
+import threading
+from collections import deque
+from pathlib import Path
+from typing import Deque
+from typing import List
+from typing import Optional
+from typing import TextIO
+from typing import Union
+
+from opentelemetry_wrapper.utils.fork_safety import register_after_fork
+
+OVERFLOW_BLOCK = 'block'  # wait for the writer to catch up (the only policy that never loses records)
+OVERFLOW_DROP_OLDEST = 'drop_oldest'  # discard the oldest queued record to make space
+OVERFLOW_DROP_NEW = 'drop_new'  # discard the record being logged
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEW)
+
+
+class BatchingQueueHandler(logging.Handler):
+    """
+    writes to a stream (stderr by default) or appends to a file, from a background thread
+    queued records are flushed when the process exits, or by calling `flush()`
+    """
+
+    def __init__(self,
+                 stream: Optional[TextIO] = None,
+                 path: Optional[Path] = None,
+                 *,
+                 level: int = logging.NOTSET,
+                 queue_size: int = 10000,
+                 overflow_policy: str = OVERFLOW_DROP_OLDEST,
+                 batch_size: int = 512,
+                 flush_interval: float = 0.1,
+                 ) -> None:
+        """
+        :param stream: where to write, defaults to stderr
+        :param path: file to append to instead of a stream (opened immediately, closed with the handler)
+        :param level: handler level
+        :param queue_size: max number of records waiting to be written
+        :param overflow_policy: one of `OVERFLOW_POLICIES`
+        :param batch_size: max number of records per write
+        :param flush_interval: max seconds a record waits in the queue before being written
+        """
+        super().__init__(level)
+        if path is not None and stream is not None:
+            raise ValueError('cannot set both path and stream')
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f'overflow_policy must be one of {OVERFLOW_POLICIES}, got {overflow_policy!r}')
+        if queue_size < 1:
+            raise ValueError(queue_size)
+        if batch_size < 1:
+            raise ValueError(batch_size)
+
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._owns_stream = path is not None
+        self.stream: TextIO
+        if path is not None:
+            self.stream = open(path, 'a', encoding='utf8')
+        else:
+            self.stream = stream if stream is not None else sys.stderr
+
+        # drop_oldest is handled by the deque itself
+        self._queue: Deque[logging.LogRecord] = deque(
+            maxlen=queue_size if overflow_policy == OVERFLOW_DROP_OLDEST else None)
+
+        # counters, readable any time
+        self.dropped_oldest = 0
+        self.dropped_new = 0
+        self.written = 0
+        self._counter_lock = threading.Lock()
+
+        self._wake_writer = threading.Event()
+        self._space_available = threading.Condition()  # only used by OVERFLOW_BLOCK
+        self._write_lock = threading.Lock()  # one batch at a time, from the writer thread or `flush()`
+        self._closed = False
+
+        self._start_writer()
+        atexit.register(self.close)
+        register_after_fork(self)
+
+    def _start_writer(self) -> None:
+        self._writer_thread = threading.Thread(target=self._writer_loop,
+                                               name=f'{self.__class__.__name__}-writer',
+                                               daemon=True)
+        self._writer_thread.start()
+
+    def _after_fork_in_child(self) -> None:
+        """
+        the parent still writes whatever it had queued, so the child starts empty, with a new writer thread
+        """
+        self._queue = deque(maxlen=self._queue.maxlen)
+        self.dropped_oldest = 0
+        self.dropped_new = 0
+        self.written = 0
+        self._counter_lock = threading.Lock()
+        self._wake_writer = threading.Event()
+        self._space_available = threading.Condition()
+        self._write_lock = threading.Lock()
+        if not self._closed:
+            self._start_writer()
+
+    @property
+    def dropped(self) -> int:
+        return self.dropped_oldest + self.dropped_new
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+    def handle(self, record: logging.LogRecord) -> Union[bool, logging.LogRecord]:
+        """
+        same as `logging.Handler.handle`, but without holding `self.lock` while emitting
+        `emit` only touches the deque and counters, which are thread-safe anyway,
+        and waiting for space while holding the lock deadlocks if the writer thread logs to this handler
+        """
+        _result = self.filter(record)
+        if isinstance(_result, logging.LogRecord):  # python 3.12+ filters can return a replacement record
+            record = _result
+        if _result:
+            self.emit(record)
+        return _result
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if self._closed:
+            return
+
+        if len(self._queue) >= self.queue_size:
+            # the writer thread can't wait for itself (e.g. if formatting a record logs something)
+            if self.overflow_policy == OVERFLOW_BLOCK and threading.current_thread() is not self._writer_thread:
+                with self._space_available:
+                    while len(self._queue) >= self.queue_size and not self._closed:
+                        self._wake_writer.set()
+                        self._space_available.wait(self.flush_interval)
+            elif self.overflow_policy == OVERFLOW_DROP_OLDEST:
+                with self._counter_lock:
+                    self.dropped_oldest += 1
+            else:
+                with self._counter_lock:
+                    self.dropped_new += 1
+                return
+
+        self._queue.append(record)
+        if len(self._queue) >= self.batch_size:
+            self._wake_writer.set()
+
+    def _write_batches(self) -> None:
+        """
+        write everything that's queued, in batches
+        """
+        with self._write_lock:
+            while self._queue:
+                _batch: List[logging.LogRecord] = []
+                while len(_batch) < self.batch_size:
+                    try:
+                        _batch.append(self._queue.popleft())
+                    except IndexError:
+                        break
+
+                if self.overflow_policy == OVERFLOW_BLOCK:
+                    with self._space_available:
+                        self._space_available.notify_all()
+
+                if _batch:
+                    _written = self.write_batch(_batch)
+                    with self._counter_lock:
+                        self.written += _written
+
+    def write_batch(self, batch: List[logging.LogRecord]) -> int:
+        """
+        format and write one batch; override this to send records somewhere other than a stream
+
+        :return: number of records written
+        """
+        _lines = []
+        for _record in batch:
+            # noinspection PyBroadException
+            try:
+                _lines.append(self.format(_record))
+            except Exception:
+                self.handleError(_record)
+        if not _lines:
+            return 0
+
+        # noinspection PyBroadException
+        try:
+            self.stream.write('\n'.join(_lines) + '\n')
+            self.stream.flush()
+            return len(_lines)
+        except Exception:
+            self.handleError(batch[0])
+            return 0
+
+    def _writer_loop(self) -> None:
+        while not self._closed:
+            self._wake_writer.wait(self.flush_interval)
+            self._wake_writer.clear()
+            self._write_batches()
+
+    def flush(self) -> None:
+        """
+        writes everything queued so far, on the calling thread
+        """
+        self._write_batches()
+
+    def close(self) -> None:
+        """
+        idempotent; also called when the process exits
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._wake_writer.set()
+        with self._space_available:
+            self._space_available.notify_all()
+        if threading.current_thread() is not self._writer_thread:
+            self._writer_thread.join(timeout=max(1.0, 10 * self.flush_interval))
+        self._write_batches()
+        if self._owns_stream:
+            # noinspection PyBroadException
+            try:
+                self.stream.close()
+            except Exception:
+                pass
+        atexit.unregister(self.close)
+        super().close()
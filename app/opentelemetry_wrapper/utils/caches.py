@@ -0,0 +1,191 @@
+"""
+caches that don't grow forever in long-running processes
+
+* `WeakCache` is weak-keyed where possible (and optionally weak-valued), falling back to a bounded LRU otherwise
+* `bounded_lru_cache` is like `functools.lru_cache`, but also counts evictions, and forwards attribute access
+"""
+import threading
+import weakref
+from collections import OrderedDict
+from functools import update_wrapper
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import NamedTuple
+from typing import Optional
+
+
+class CacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    evictions: int  # removed to stay within maxsize
+    collected: int  # removed because the key was garbage collected
+    maxsize: Optional[int]
+    currsize: int
+
+
+_MISSING = object()
+
+
+class WeakCache:
+    """
+    a mapping that holds weak references to its keys where possible, so it doesn't keep them alive
+    keys that can't be weakly referenced (e.g. builtins) are held in a bounded LRU cache instead
+
+    with `weak_values=True`, values are also weakly referenced where possible
+    this is needed when the value references the key (e.g. a wrapper function), otherwise the key would never die
+    a value that has been garbage collected is treated as a cache miss
+    """
+
+    def __init__(self, maxsize: int = 4096, *, weak_values: bool = False) -> None:
+        """
+        :param maxsize: max number of entries that are held strongly (i.e. not weakly referenced)
+        :param weak_values: hold weak references to the values where possible
+        """
+        self.maxsize = maxsize
+        self.weak_values = weak_values
+
+        self._weak: Dict[weakref.ref, Any] = dict()
+        self._strong: 'OrderedDict[Any, Any]' = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._collected = 0
+
+        # don't let the callback keep the cache alive
+        _self_ref = weakref.ref(self)
+
+        def _on_collected(ref: weakref.ref) -> None:
+            _self = _self_ref()
+            if _self is not None and _self._weak.pop(ref, _MISSING) is not _MISSING:
+                _self._collected += 1
+
+        self._on_collected = _on_collected
+
+    def _wrap_value(self, value: Any) -> Any:
+        if self.weak_values and value is not None:
+            try:
+                return weakref.ref(value)
+            except TypeError:
+                pass
+        return value
+
+    def _unwrap_value(self, value: Any) -> Any:
+        if self.weak_values and type(value) is weakref.ref:
+            value = value()
+            if value is None:
+                return _MISSING
+        return value
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        try:
+            value = self._weak.get(weakref.ref(key), _MISSING)
+        except TypeError:
+            with self._lock:
+                value = self._strong.get(key, _MISSING)
+                if value is not _MISSING:
+                    self._strong.move_to_end(key)
+
+        if value is not _MISSING:
+            value = self._unwrap_value(value)
+        if value is _MISSING:
+            self._misses += 1
+            return default
+        self._hits += 1
+        return value
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        value = self._wrap_value(value)
+        try:
+            self._weak[weakref.ref(key, self._on_collected)] = value
+        except TypeError:
+            with self._lock:
+                self._strong[key] = value
+                self._strong.move_to_end(key)
+                while len(self._strong) > self.maxsize:
+                    self._strong.popitem(last=False)
+                    self._evictions += 1
+
+    def __contains__(self, key: Any) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __getitem__(self, key: Any) -> Any:
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __len__(self) -> int:
+        return len(self._weak) + len(self._strong)
+
+    def cache_info(self) -> CacheInfo:
+        return CacheInfo(self._hits, self._misses, self._evictions, self._collected, self.maxsize, len(self))
+
+    def cache_clear(self) -> None:
+        with self._lock:
+            self._weak.clear()
+            self._strong.clear()
+            self._hits = self._misses = self._evictions = self._collected = 0
+
+
+class _BoundedLRUCacheWrapper:
+    """
+    callable returned by `bounded_lru_cache`
+    attributes not defined here are looked up on the wrapped function (or class)
+    """
+
+    def __init__(self, func: Callable, maxsize: int) -> None:
+        self.__wrapped__ = func
+        self.maxsize = maxsize
+        self._cache: 'OrderedDict[Any, Any]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        update_wrapper(self, func, updated=())
+
+    def __call__(self, *args, **kwargs):
+        key = (args, tuple(kwargs.items())) if kwargs else args
+        with self._lock:
+            value = self._cache.get(key, _MISSING)
+            if value is not _MISSING:
+                self._cache.move_to_end(key)
+                self._hits += 1
+                return value
+
+        # don't hold the lock while calling the function, it might be slow or re-entrant
+        value = self.__wrapped__(*args, **kwargs)
+        with self._lock:
+            self._misses += 1
+            self._cache[key] = value
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+                self._evictions += 1
+        return value
+
+    def __getattr__(self, name: str) -> Any:
+        if name == '__wrapped__':
+            raise AttributeError(name)  # not initialized yet
+        return getattr(self.__wrapped__, name)
+
+    def cache_info(self) -> CacheInfo:
+        return CacheInfo(self._hits, self._misses, self._evictions, 0, self.maxsize, len(self._cache))
+
+    def cache_clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self._hits = self._misses = self._evictions = 0
+
+
+def bounded_lru_cache(maxsize: int = 4096) -> Callable[[Callable], _BoundedLRUCacheWrapper]:
+    """
+    like `functools.lru_cache`, but `cache_info()` also reports evictions
+    and it can wrap a class without hiding the class's other attributes (e.g. classmethods)
+    """
+
+    def decorator(func: Callable) -> _BoundedLRUCacheWrapper:
+        return _BoundedLRUCacheWrapper(func, maxsize)
+
+    return decorator
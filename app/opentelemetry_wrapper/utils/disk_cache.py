@@ -0,0 +1,125 @@
+"""
+optional on-disk cache of the expensive parts of `CodeInfo` (class name and line number), to speed up cold starts
+
+enable it by setting an env var to a writable file path, e.g.
+    OTEL_WRAPPER_CODEINFO_CACHE_PATH=/tmp/opentelemetry_wrapper.codeinfo.cache
+
+entries are keyed by source file path and qualname, and are discarded if the source file's mtime or size changes
+the file is written (atomically, merging with whatever is already there) when the process exits
+it's a `marshal`-ed dict, so it's compact and fast to load, but only readable by the same python version
+"""
+import atexit
+import marshal
+import os
+import threading
+from functools import lru_cache
+from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+ENV_CODEINFO_CACHE_PATH = 'OTEL_WRAPPER_CODEINFO_CACHE_PATH'
+
+_FORMAT_VERSION = 1
+
+# source path -> (mtime_ns, size, {qualname -> {attribute name -> value}})
+_FileEntry = Tuple[int, int, Dict[str, Dict[str, Any]]]
+
+
+def _file_signature(source_path: str) -> Optional[Tuple[int, int]]:
+    try:
+        _stat = os.stat(source_path)
+    except (OSError, ValueError):
+        return None
+    return _stat.st_mtime_ns, _stat.st_size
+
+
+class CodeInfoDiskCache:
+    """
+    thread-safe; the file is only read on first use
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._files: Optional[Dict[str, _FileEntry]] = None
+        self._signatures: Dict[str, Optional[Tuple[int, int]]] = dict()
+        self._dirty = False
+
+    def _read(self) -> Dict[str, _FileEntry]:
+        try:
+            _data = marshal.loads(self.path.read_bytes())
+        except (OSError, EOFError, ValueError, TypeError):
+            return dict()
+        if not isinstance(_data, dict) or _data.get('version') != _FORMAT_VERSION:
+            return dict()
+        _files = _data.get('files')
+        return _files if isinstance(_files, dict) else dict()
+
+    def _get_file_entry(self, source_path: str) -> Optional[_FileEntry]:
+        """
+        must be called with the lock held
+        """
+        if self._files is None:
+            self._files = self._read()
+
+        # stat each source file at most once per process
+        if source_path not in self._signatures:
+            self._signatures[source_path] = _file_signature(source_path)
+            _entry = self._files.get(source_path)
+            if _entry is not None and (_entry[0], _entry[1]) != self._signatures[source_path]:
+                del self._files[source_path]
+                self._dirty = True
+
+        return self._files.get(source_path)
+
+    def get(self, source_path: str, qualname: str, attribute_name: str, default: Any = None) -> Any:
+        with self._lock:
+            _entry = self._get_file_entry(source_path)
+            if _entry is None:
+                return default
+            return _entry[2].get(qualname, dict()).get(attribute_name, default)
+
+    def set(self, source_path: str, qualname: str, attribute_name: str, value: Any) -> None:
+        with self._lock:
+            _entry = self._get_file_entry(source_path)
+            if _entry is None:
+                _signature = self._signatures[source_path]
+                if _signature is None:
+                    return  # not a real file
+                _entry = self._files[source_path] = (_signature[0], _signature[1], dict())
+            _entry[2].setdefault(qualname, dict())[attribute_name] = value
+            self._dirty = True
+
+    def save(self) -> None:
+        """
+        merge with the file on disk (other processes may have written to it) and write atomically
+        """
+        with self._lock:
+            if not self._dirty or self._files is None:
+                return
+            _files = self._read()
+            _files.update(self._files)
+            _temp_path = self.path.with_name(f'{self.path.name}.{os.getpid()}.tmp')
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                _temp_path.write_bytes(marshal.dumps({'version': _FORMAT_VERSION, 'files': _files}))
+                os.replace(_temp_path, self.path)
+                self._dirty = False
+            except OSError:
+                pass  # never fail, this is just a cache
+
+
+@lru_cache(maxsize=None)  # only one instance per process
+def get_code_info_disk_cache() -> Optional[CodeInfoDiskCache]:
+    """
+    :return: None unless enabled by env var
+    """
+    _path = os.getenv(ENV_CODEINFO_CACHE_PATH, '').strip()
+    if not _path:
+        return None
+
+    _cache = CodeInfoDiskCache(Path(_path))
+    atexit.register(_cache.save)
+    return _cache
@@ -0,0 +1,321 @@
+"""
+a file-like object for writing logs to disk with as few syscalls as possible
+
+* writes are buffered in memory and written out when the buffer is full or `flush_interval` seconds have passed
+  (`flush()` only writes if either is true, since `logging.StreamHandler` calls it after every record)
+* the file is rotated when it reaches `max_bytes` or is older than `rotate_interval` seconds
+* rotated segments are compressed (gzip, or zstd if the `zstandard` package is installed) on a background thread,
+  and only the most recent `backup_count` segments are kept
+
+use it as the stream for `logging.StreamHandler` or `BatchingQueueHandler`
+
+several processes (e.g. forked workers) can append to the same path:
+sizes are checked on the file itself rather than this process's writes, rotation is serialized with a lock file
+(`{path}.lock`, not on windows), and when another process rotates the file, this one follows it to the new file
+"""
+import atexit
+import gzip
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import TextIO
+from typing import Tuple
+
+from opentelemetry_wrapper.utils.fork_safety import register_after_fork
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_ZSTD = 'zstd'
+_COMPRESSION_SUFFIXES = {
+    COMPRESSION_GZIP: '.gz',
+    COMPRESSION_ZSTD: '.zst',
+}
+
+
+def _compress_segment(segment_path: Path, compression: str) -> Path:
+    """
+    compress to a temp file first, so a crash never leaves a truncated archive with the final name
+
+    :return: path of the compressed file
+    """
+    _compressed_path = segment_path.with_name(segment_path.name + _COMPRESSION_SUFFIXES[compression])
+    _temp_path = _compressed_path.with_name(_compressed_path.name + '.tmp')
+    with segment_path.open('rb') as f_in:
+        if compression == COMPRESSION_ZSTD:
+            with _temp_path.open('wb') as f_out:
+                zstandard.ZstdCompressor().copy_stream(f_in, f_out)
+        else:
+            with gzip.open(_temp_path, 'wb', compresslevel=6) as f_out:
+                shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+    os.replace(_temp_path, _compressed_path)
+    segment_path.unlink()
+    return _compressed_path
+
+
+class RotatingFileSink:
+    """
+    thread-safe; all file operations (except compression) happen while holding a lock, on the writing thread
+    note that the file can grow past `max_bytes` by up to `buffer_size`, since the size is checked after each write
+    """
+
+    def __init__(self,
+                 path: Path,
+                 *,
+                 buffer_size: int = 1024 * 1024,
+                 flush_interval: float = 1.0,
+                 max_bytes: Optional[int] = 100 * 1024 * 1024,
+                 rotate_interval: Optional[float] = None,
+                 backup_count: Optional[int] = 10,
+                 compression: Optional[str] = COMPRESSION_GZIP,
+                 close_at_exit: bool = True,
+                 ) -> None:
+        """
+        :param path: file to append to
+        :param buffer_size: characters to buffer before writing to the file
+        :param flush_interval: max seconds to keep anything in the buffer
+        :param max_bytes: rotate when the file reaches this size; None to disable
+        :param rotate_interval: rotate when the file is this many seconds old; None to disable
+        :param backup_count: number of rotated segments to keep; None to keep all
+        :param compression: `COMPRESSION_GZIP`, `COMPRESSION_ZSTD`, or None for no compression
+        :param close_at_exit: close (and flush) when the process exits; set to False if whatever writes to the sink
+                              also closes it at exit, since atexit hooks run in reverse order and it may still write
+        """
+        if compression is not None and compression not in _COMPRESSION_SUFFIXES:
+            raise ValueError(f'compression must be one of {tuple(_COMPRESSION_SUFFIXES)} or None, got {compression!r}')
+        if compression == COMPRESSION_ZSTD and zstandard is None:
+            raise ValueError('zstd compression requires the `zstandard` package')
+
+        self.path = Path(path).absolute()
+        self._lock_path = self.path.with_name(self.path.name + '.lock')
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backup_count = backup_count
+        self.compression = compression
+
+        self._lock = threading.RLock()
+        self._buffer: List[str] = []
+        self._buffered = 0
+        self._last_flush = time.monotonic()
+        self._closed = False
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file: TextIO
+        self._file_id: Tuple[int, int] = (0, 0)  # (device, inode), to notice if another process rotated it
+        self._file_opened = 0.0
+        self._open()
+
+        self._start_threads()
+        if close_at_exit:
+            atexit.register(self.close)
+        register_after_fork(self)
+
+    def _start_threads(self) -> None:
+        # one thread, so segments are compressed (and old ones deleted) in order
+        self._compressor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'{self.__class__.__name__}-compress')
+
+        # makes sure nothing sits in the buffer for longer than `flush_interval`, even if nothing else is logged
+        self._stop = threading.Event()
+        self._flusher_thread = threading.Thread(target=self._flusher_loop,
+                                                name=f'{self.__class__.__name__}-flush',
+                                                daemon=True)
+        self._flusher_thread.start()
+
+    def _after_fork_in_child(self) -> None:
+        """
+        the parent writes whatever it had buffered, so the child starts with an empty buffer and its own file handle
+        """
+        self._lock = threading.RLock()
+        self._buffer = []
+        self._buffered = 0
+        self._last_flush = time.monotonic()
+        if self._closed:
+            return
+        # noinspection PyBroadException
+        try:
+            self._file.close()  # nothing to flush, since every write to it is flushed straight away
+        except Exception:
+            pass
+        self._open()
+        self._start_threads()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def writable(self) -> bool:
+        return True
+
+    def _open(self) -> None:
+        self._file = self.path.open('a', encoding='utf8')
+        _stat = os.fstat(self._file.fileno())
+        self._file_id = (_stat.st_dev, _stat.st_ino)
+        self._file_opened = time.monotonic()
+
+    def _rotated_elsewhere(self) -> bool:
+        """
+        true if another process rotated (or someone deleted) the file since it was opened
+        """
+        try:
+            _stat = os.stat(self.path)
+        except FileNotFoundError:
+            return True
+        return (_stat.st_dev, _stat.st_ino) != self._file_id
+
+    def write(self, text: str) -> int:
+        with self._lock:
+            if self._closed:
+                raise ValueError('write to closed file')
+            self._buffer.append(text)
+            self._buffered += len(text)
+            if self._buffered >= self.buffer_size:
+                self._write_buffer()
+        return len(text)
+
+    def _write_buffer(self) -> None:
+        """
+        must be called with the lock held
+        """
+        if self._buffer:
+            self._file.write(''.join(self._buffer))
+            self._file.flush()
+            self._buffer.clear()
+            self._buffered = 0
+        self._last_flush = time.monotonic()
+        self._maybe_rotate()
+
+    def flush(self, force: bool = False) -> None:
+        """
+        only writes to the file if the buffer is full or `flush_interval` has passed, unless forced
+        """
+        with self._lock:
+            if self._closed:
+                return
+            if force or self._buffered >= self.buffer_size or \
+                    time.monotonic() - self._last_flush >= self.flush_interval:
+                self._write_buffer()
+
+    def _flusher_loop(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            # noinspection PyBroadException
+            try:
+                self.flush()
+            except Exception:
+                pass  # e.g. disk full; try again next time
+
+    def _maybe_rotate(self) -> None:
+        """
+        must be called with the lock held, after writing the buffer
+        """
+        if self._rotated_elsewhere():
+            self._file.close()
+            self._open()
+            return
+
+        # not `tell()`, since other processes may be appending too
+        _size = os.fstat(self._file.fileno()).st_size
+        if self.max_bytes is not None and _size >= self.max_bytes:
+            self._rotate()
+        elif self.rotate_interval is not None and time.monotonic() - self._file_opened >= self.rotate_interval:
+            if _size > 0:  # don't rotate empty files
+                self._rotate()
+
+    def _rotate(self) -> None:
+        self._file.close()
+        with self._rotation_lock():
+            if self._rotated_elsewhere():  # another process got there first
+                self._open()
+                return
+            _timestamp = time.strftime('%Y%m%d-%H%M%S')
+            _segment_path = self.path.with_name(f'{self.path.name}.{_timestamp}')
+            _index = 0
+            while _segment_path.exists() or any(_segment_path.with_name(_segment_path.name + _suffix).exists()
+                                                for _suffix in _COMPRESSION_SUFFIXES.values()):
+                _index += 1
+                _segment_path = self.path.with_name(f'{self.path.name}.{_timestamp}.{_index}')
+            os.replace(self.path, _segment_path)
+            self._open()
+        try:
+            self._compressor.submit(self._finish_segment, _segment_path)
+        except RuntimeError:  # the interpreter is shutting down, or the sink was closed
+            self._finish_segment(_segment_path)
+
+    @contextmanager
+    def _rotation_lock(self) -> Iterator[None]:
+        """
+        stops processes sharing the path from rotating at the same time (the in-process lock is already held)
+        """
+        if fcntl is None:
+            yield
+            return
+        with open(self._lock_path, 'a') as _lock_file:
+            fcntl.flock(_lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(_lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _finish_segment(self, segment_path: Path) -> None:
+        """
+        runs on the compressor thread
+        """
+        # other processes appending to the same path keep writing to the segment until they notice it was rotated,
+        # which they check at least every `flush_interval`, so give them time to move on (unless closing)
+        self._stop.wait(2 * self.flush_interval)
+        # noinspection PyBroadException
+        try:
+            if self.compression is not None:
+                _compress_segment(segment_path, self.compression)
+        except Exception:
+            pass  # leave it uncompressed
+        self._delete_old_segments()
+
+    def rotated_segments(self) -> List[Path]:
+        """
+        oldest first
+        """
+        _segments = [_path for _path in self.path.parent.glob(f'{self.path.name}.*')
+                     if not _path.name.endswith('.tmp') and _path != self._lock_path]
+        return sorted(_segments, key=lambda _path: (_path.stat().st_mtime, _path.name))
+
+    def _delete_old_segments(self) -> None:
+        if self.backup_count is None:
+            return
+        _segments = self.rotated_segments()
+        for _path in _segments[:max(0, len(_segments) - self.backup_count)]:
+            # noinspection PyBroadException
+            try:
+                _path.unlink()
+            except Exception:
+                pass
+
+    def close(self) -> None:
+        """
+        idempotent; writes everything and waits for compression to finish
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._write_buffer()
+            self._closed = True
+            self._file.close()
+        self._stop.set()
+        self._compressor.shutdown(wait=True)
+        atexit.unregister(self.close)
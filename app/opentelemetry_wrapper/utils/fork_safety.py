@@ -0,0 +1,51 @@
+"""
+keep background threads, queues, and locks working in forked children (e.g. gunicorn workers with `--preload`)
+
+after a fork, only the thread that forked exists in the child, so
+* background threads (writers, flushers, exporters) are gone, and have to be restarted
+* locks that other threads held at the time of the fork stay locked forever, so they have to be replaced
+* anything queued or buffered belongs to the parent, which will still write it, so the child drops its copy
+
+objects register themselves with `register_after_fork`, and implement `_after_fork_in_child`
+(the SDK's `BatchSpanProcessor` already does the same for its own worker thread and queue)
+
+note that `uvicorn --workers` spawns instead of forking, so each worker imports (and sets up) everything itself
+"""
+import os
+import threading
+import weakref
+from typing import List
+
+# weak, so registering doesn't keep anything alive
+# a list rather than a `WeakSet`, since order matters (e.g. a file sink must be fixed before the handler writing to it)
+_OBJECTS: List[weakref.ReferenceType] = []
+_LOCK = threading.Lock()
+
+
+def register_after_fork(obj: object) -> None:
+    """
+    call `obj._after_fork_in_child()` in every forked child, in the order they were registered
+    """
+    assert callable(getattr(obj, '_after_fork_in_child', None)), obj
+    with _LOCK:
+        _OBJECTS[:] = [_ref for _ref in _OBJECTS if _ref() is not None]
+        _OBJECTS.append(weakref.ref(obj))
+
+
+def _after_fork_in_child() -> None:
+    global _LOCK
+    _LOCK = threading.Lock()
+    for _ref in list(_OBJECTS):
+        _obj = _ref()
+        if _obj is None:
+            continue
+        # noinspection PyBroadException
+        try:
+            # noinspection PyProtectedMember
+            _obj._after_fork_in_child()
+        except Exception:
+            pass  # nowhere safe to report this; keep going so everything else still works
+
+
+if hasattr(os, 'register_at_fork'):  # not on windows
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -1,46 +1,160 @@
 import asyncio
-import importlib.util
 import inspect
+import os
 import sys
-from dataclasses import dataclass
-from dataclasses import field
+import threading
+from dataclasses import FrozenInstanceError
 from functools import cached_property
-from functools import lru_cache
 from functools import partial
 from functools import partialmethod
 from functools import singledispatchmethod
 from pathlib import Path
 from types import ModuleType
+from typing import Any
 from typing import Callable
 from typing import Coroutine
 from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Tuple
 from typing import Union
 
+from opentelemetry_wrapper.utils.caches import bounded_lru_cache
+from opentelemetry_wrapper.utils.disk_cache import get_code_info_disk_cache
+from opentelemetry_wrapper.utils.source_index import get_source_index
 
-@lru_cache(maxsize=None)
-@dataclass(unsafe_hash=True, frozen=True)
+_MISSING = object()
+
+# paths are stored as indexes into this list, since the same few paths are shared by many instances
+_PATHS: List[str] = []
+_PATH_IDS: Dict[str, int] = dict()
+_PATHS_LOCK = threading.Lock()
+
+
+def _path_id(path: str) -> int:
+    with _PATHS_LOCK:
+        if path not in _PATH_IDS:
+            _PATH_IDS[path] = len(_PATHS)
+            _PATHS.append(sys.intern(path))
+        return _PATH_IDS[path]
+
+
+# noinspection PyPep8Naming
+class _cached_slot:
+    """
+    like `functools.cached_property`, but caches the value in the slot `_cached_{name}` instead of in `__dict__`
+    strings are interned, since the same module / class / function names are repeated across many instances
+    """
+    def __init__(self, func: Callable[[Any], Any]) -> None:
+        self.func = func
+        self.slot = None
+        self.__doc__ = func.__doc__
+
+    def __set_name__(self, owner: type, name: str) -> None:
+        # fails if the slot wasn't declared in `__slots__`
+        self.slot = owner.__dict__[f'_cached_{name.lstrip("_")}']
+
+    def __get__(self, instance: Any, owner: Optional[type] = None) -> Any:
+        if instance is None:
+            return self
+        try:
+            return self.slot.__get__(instance, owner)
+        except AttributeError:  # not set yet
+            pass
+        value = self.func(instance)
+        if type(value) is str:
+            value = sys.intern(value)
+        self.slot.__set__(instance, value)
+        return value
+
+
+# bounded, since a CodeInfo holds a strong reference to its code object (e.g. a closure created per call)
+# use `CodeInfo.cache_info()` to check the hit rate
+@bounded_lru_cache(maxsize=4096)
 class CodeInfo:
+    """
+    immutable, and uses `__slots__` to stay small since there can be thousands of these
+    every property is computed lazily and then cached in its own slot
+    """
+    __slots__ = (
+        'code_object',
+        'unwrap_partial',
+        'unwrap_async',
+        '_maybe_unsafe__try_very_hard_to_find_class',
+        '_cached_is_class',
+        '_cached_name',
+        '_cached_code__',
+        '_cached_function_qualname',
+        '_cached_function_name',
+        '_cached_module',
+        '_cached_module_name',
+        '_cached_cls',
+        '_cached_CodeInfo__class_qualname',
+        '_cached_CodeInfo__disk_cache_key',
+        '_cached_class_name',
+        '_cached_CodeInfo__path_id',
+        '_cached_lineno',
+        '_cached_CodeInfo__unwrapped',
+    )
+
     code_object: Union[Coroutine, Callable,
                        partial, partialmethod, singledispatchmethod, cached_property,
                        asyncio.Task,
                        type, property]
 
-    unwrap_partial: bool = True
-    unwrap_async: bool = True
-
-    _maybe_unsafe__try_very_hard_to_find_class: bool = True
-
-    __cached_cls: List[type] = field(default_factory=list, init=False, repr=False, hash=False, compare=False)
-    __cached_function: List[str] = field(default_factory=list, init=False, repr=False, hash=False, compare=False)
-
-    def __post_init__(self):
-        assert self.__is_supported_type(self.code_object), type(self.code_object)
-        assert isinstance(self.unwrap_partial, bool), self.unwrap_partial
-        assert isinstance(self.unwrap_async, bool), self.unwrap_async
+    unwrap_partial: bool
+    unwrap_async: bool
+
+    # no longer unsafe, since the source file is parsed statically instead of being imported
+    _maybe_unsafe__try_very_hard_to_find_class: bool
+
+    def __init__(self,
+                 code_object: Union[Coroutine, Callable,
+                                    partial, partialmethod, singledispatchmethod, cached_property,
+                                    asyncio.Task,
+                                    type, property],
+                 unwrap_partial: bool = True,
+                 unwrap_async: bool = True,
+                 _maybe_unsafe__try_very_hard_to_find_class: bool = True,
+                 ) -> None:
+        assert self.__is_supported_type(code_object), type(code_object)
+        assert isinstance(unwrap_partial, bool), unwrap_partial
+        assert isinstance(unwrap_async, bool), unwrap_async
+
+        object.__setattr__(self, 'code_object', code_object)
+        object.__setattr__(self, 'unwrap_partial', unwrap_partial)
+        object.__setattr__(self, 'unwrap_async', unwrap_async)
+        object.__setattr__(self, '_maybe_unsafe__try_very_hard_to_find_class',
+                           _maybe_unsafe__try_very_hard_to_find_class)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise FrozenInstanceError(f'cannot assign to field {name!r}')
+
+    def __delattr__(self, name: str) -> None:
+        raise FrozenInstanceError(f'cannot delete field {name!r}')
+
+    def __key(self) -> tuple:
+        return (self.code_object,
+                self.unwrap_partial,
+                self.unwrap_async,
+                self._maybe_unsafe__try_very_hard_to_find_class)
+
+    def __eq__(self, other: Any) -> bool:
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self.__key() == other.__key()
+
+    def __hash__(self) -> int:
+        return hash(self.__key())
+
+    def __repr__(self) -> str:
+        return (f'{self.__class__.__qualname__}('
+                f'code_object={self.code_object!r}, '
+                f'unwrap_partial={self.unwrap_partial!r}, '
+                f'unwrap_async={self.unwrap_async!r}, '
+                f'_maybe_unsafe__try_very_hard_to_find_class={self._maybe_unsafe__try_very_hard_to_find_class!r})')
 
-    @cached_property
+    @property
     def json(self) -> Dict[str, Union[str, int, bool, None]]:
         return {
             'name':              self.name,
@@ -48,19 +162,19 @@ class CodeInfo:
             'class_name':        self.class_name,
             'function_name':     self.function_name,
             'function_qualname': self.function_qualname,
-            'path':              str(self.path) if self.path else None,
+            'path':              self.__path_str,
             'lineno':            self.lineno,
             'is_class':          self.is_class,
         }
 
-    @cached_property
+    @_cached_slot
     def is_class(self) -> bool:
         """
         is the unwrapped base object a class?
         """
         return inspect.isclass(self.__unwrapped_code_object)
 
-    @cached_property
+    @_cached_slot
     def name(self) -> str:
 
         _prefixes = ' '.join(self.__unwrapped_prefixes) + ' ' if self.__unwrapped_prefixes else ''
@@ -81,7 +195,7 @@ class CodeInfo:
 
         return f'{_prefixes}{_module_name}{_class_name}{_function_name}'
 
-    @cached_property
+    @_cached_slot
     def __code__(self):
         # get the code stuff
         _code = getattr(self.__unwrapped_code_object, '__code__', None)
@@ -96,7 +210,7 @@ class CodeInfo:
 
         return _code
 
-    @cached_property
+    @_cached_slot
     def function_qualname(self) -> Optional[str]:
         # a class does not have a function name
         if self.is_class:
@@ -106,7 +220,7 @@ class CodeInfo:
         if hasattr(self.__unwrapped_code_object, '__qualname__'):
             return self.__unwrapped_code_object.__qualname__
 
-    @cached_property
+    @_cached_slot
     def function_name(self) -> Optional[str]:
         # a class does not have a function name
         if self.is_class:
@@ -131,25 +245,25 @@ class CodeInfo:
             if getattr(self.__code__, 'co_name', None):
                 return self.__code__.co_name
 
-    @cached_property
+    @_cached_slot
     def module(self) -> Optional[ModuleType]:
         module = inspect.getmodule(self.__unwrapped_code_object)
         if module is not None:
             return module
 
-    @cached_property
+    @_cached_slot
     def module_name(self) -> Optional[str]:
         if self.module is not None:
             return self.module.__name__
 
         # fallback to reading from file path
-        if self.path is not None:
-            _module_name = inspect.getmodulename(str(self.path))
+        if self.__path_str is not None:
+            _module_name = inspect.getmodulename(self.__path_str)
             if _module_name is not None:
                 _lineno = f':{self.lineno}' if self.lineno else ''
                 return f'<{_module_name}.py{_lineno}>'
 
-    @cached_property
+    @_cached_slot
     # flake8: noqa: C901
     def cls(self) -> Optional[type]:
         # if we already are a class
@@ -167,15 +281,7 @@ class CodeInfo:
                         if inspect.isclass(_cls) and self.__unwrapped_code_object.__name__ in _cls.__dict__:
                             return _cls
 
-        # get class qualname
-        if hasattr(self.__unwrapped_code_object, '__qualname__'):
-            _cls_qualname = self.__unwrapped_code_object.__qualname__.split('.<locals>')[0]
-            if '.' in _cls_qualname:
-                _cls_qualname = _cls_qualname.rsplit('.', 1)[0]
-            else:
-                _cls_qualname = ''
-        else:
-            _cls_qualname = ''
+        _cls_qualname = self.__class_qualname
 
         # get class from class qualname
         if _cls_qualname and self.module:
@@ -196,46 +302,129 @@ class CodeInfo:
             if inspect.isclass(_cls):
                 return _cls
 
-        # try harder: load module from path and search inside it to find the class qualname
-        if self._maybe_unsafe__try_very_hard_to_find_class and _cls_qualname and not self.module and self.path:
-            _temp_module_name = f'__introspected_file__.{self.path}'
-            if _temp_module_name in sys.modules:
-                _cls = sys.modules[_temp_module_name]
-            else:
-                spec = importlib.util.spec_from_file_location(_temp_module_name, self.path)
-                _cls = importlib.util.module_from_spec(spec)
-                sys.modules[_temp_module_name] = _cls
-                spec.loader.exec_module(_cls)
-
-            for _cls_name in _cls_qualname.split('.'):
-                if _cls is None:
-                    break
-                _cls = getattr(_cls, _cls_name, None)
-            else:
-                if _cls is not None:
-                    if inspect.isclass(_cls):
-                        return _cls
+    @_cached_slot
+    def __class_qualname(self) -> str:
+        """
+        qualname of the class this was defined in (if any), not counting classes defined inside functions
+        """
+        if hasattr(self.__unwrapped_code_object, '__qualname__'):
+            _cls_qualname = self.__unwrapped_code_object.__qualname__.split('.<locals>')[0]
+            if '.' in _cls_qualname:
+                return _cls_qualname.rsplit('.', 1)[0]
+        return ''
 
-    @cached_property
+    def __class_name_from_source(self) -> Optional[str]:
+        """
+        try harder: look up the class qualname in a static index of the source file
+        the file is only parsed, never imported, so this is cheap and has no side effects
+        """
+        if not self._maybe_unsafe__try_very_hard_to_find_class:
+            return None
+        if self.__class_qualname and not self.module and self.__path_str:
+            _source_index = get_source_index(self.__path_str)
+            if _source_index is not None:
+                _definition = _source_index.find_class(self.__class_qualname)
+                if _definition is not None:
+                    return _definition.name
+
+    @_cached_slot
+    def __disk_cache_key(self) -> Optional[Tuple[str, str]]:
+        """
+        (source path, qualname) for the on-disk cache, or None if it's disabled or this can't be cached
+        the first line number is part of the key since qualnames aren't unique (e.g. lambdas)
+        """
+        if get_code_info_disk_cache() is None or self.__path_str is None:
+            return None
+        _qualname = getattr(self.__unwrapped_code_object, '__qualname__', None)
+        if not isinstance(_qualname, str):
+            return None
+        if self.__code__ is not None and getattr(self.__code__, 'co_firstlineno', None):
+            _qualname = f'{_qualname}:{self.__code__.co_firstlineno}'
+        return self.__path_str, _qualname
+
+    def __from_disk_cache(self, attribute_name: str, compute: Callable[[], Any]) -> Any:
+        if self.__disk_cache_key is None:
+            return compute()
+        _disk_cache = get_code_info_disk_cache()
+        _value = _disk_cache.get(*self.__disk_cache_key, attribute_name, _MISSING)
+        if _value is _MISSING:
+            _value = compute()
+            _disk_cache.set(*self.__disk_cache_key, attribute_name, _value)
+        return _value
+
+    @_cached_slot
     def class_name(self) -> Optional[str]:
-        if self.cls:
-            return self.cls.__name__
+        return self.__from_disk_cache('class_name',
+                                      lambda: self.cls.__name__ if self.cls else self.__class_name_from_source())
 
-    @cached_property
-    def path(self) -> Optional[Path]:
+    @_cached_slot
+    def __path_id(self) -> Optional[int]:
         try:
             _source_file = inspect.getsourcefile(self.__unwrapped_code_object)
             if _source_file:
-                return Path(_source_file)
+                return _path_id(str(Path(_source_file)))
         except TypeError:
             pass
 
         if self.__code__ is not None:
             if getattr(self.__code__, 'co_filename', None):
-                return Path(self.__code__.co_filename)
+                return _path_id(str(Path(self.__code__.co_filename)))
+
+    @property
+    def __path_str(self) -> Optional[str]:
+        if self.__path_id is not None:
+            return _PATHS[self.__path_id]
+
+    @property
+    def path(self) -> Optional[Path]:
+        if self.__path_id is not None:
+            return Path(_PATHS[self.__path_id])
 
-    @cached_property
+    @_cached_slot
     def lineno(self) -> Optional[int]:
+        return self.__from_disk_cache('lineno', self.__get_lineno)
+
+    def __lineno_from_source_index(self) -> Any:
+        """
+        the file is parsed once and shared by everything defined in it
+        whereas `inspect.getsourcelines` re-reads and re-tokenizes the source for every object
+
+        :return: `_MISSING` if `inspect` needs to be used instead
+        """
+        # `inspect.getsourcelines` would unwrap this further
+        if self.__path_str is None or hasattr(self.__unwrapped_code_object, '__wrapped__'):
+            return _MISSING
+        _qualname = getattr(self.__unwrapped_code_object, '__qualname__', None)
+        if not isinstance(_qualname, str):
+            return _MISSING
+        _source_index = get_source_index(self.__path_str)
+        if _source_index is None:
+            return _MISSING
+
+        if self.is_class:
+            _definitions = [_definition for _definition in _source_index.find_all(_qualname) if _definition.is_class]
+            if len(_definitions) == 1:
+                return _definitions[0].lineno
+
+            # `inspect` would parse the same file and also fail to find it (e.g. a builtin class that was re-exported)
+            if not _definitions:
+                return None
+
+            # if the class is defined more than once (e.g. conditionally), let `inspect` decide which one it is
+            return _MISSING
+
+        if self.__code__ is not None and getattr(self.__code__, 'co_firstlineno', None):
+            _definition = _source_index.find(_qualname, self.__code__.co_firstlineno)
+            if _definition is not None and _definition.lineno == self.__code__.co_firstlineno:
+                return _definition.lineno
+
+        return _MISSING
+
+    def __get_lineno(self) -> Optional[int]:
+        _lineno = self.__lineno_from_source_index()
+        if _lineno is not _MISSING:
+            return _lineno
+
         try:
             _source_lines = inspect.getsourcelines(self.__unwrapped_code_object)
             if _source_lines:
@@ -247,6 +436,54 @@ class CodeInfo:
             if getattr(self.__code__, 'co_firstlineno', None):
                 return self.__code__.co_firstlineno
 
+    @classmethod
+    def for_module(cls, module: ModuleType) -> Dict[str, Dict[str, Union[str, int, bool, None]]]:
+        """
+        introspect everything defined in a module at once, by parsing its source file once
+        nothing is imported or executed, and no `CodeInfo` instances are created
+
+        :param module: an imported module
+        :return: {qualname: same as `CodeInfo.json`, plus `kind` (class / function / async function / property)}
+        """
+        try:
+            _source_file = inspect.getsourcefile(module)
+        except TypeError:  # builtin module
+            return dict()
+        if not _source_file:
+            return dict()
+        return _source_table(module.__name__, _source_file)
+
+    @classmethod
+    def for_package(cls, package: ModuleType) -> Dict[str, Dict[str, Dict[str, Union[str, int, bool, None]]]]:
+        """
+        like `for_module`, but for every source file in a package and its subpackages, without importing them
+
+        :param package: an imported package
+        :return: {module name: {qualname: row}}
+        """
+        _tables = dict()
+        if not hasattr(package, '__path__'):
+            _tables[package.__name__] = cls.for_module(package)
+            return _tables
+
+        for _package_path in package.__path__:
+            for _dir_path, _dir_names, _file_names in os.walk(_package_path):
+                # descend into anything that could be a (possibly namespace) package, but not `__pycache__` etc
+                _dir_names[:] = sorted(_dir_name for _dir_name in _dir_names
+                                       if _dir_name.isidentifier() and not _dir_name.startswith('__'))
+
+                _relative_parts = Path(_dir_path).relative_to(_package_path).parts
+                for _file_name in sorted(_file_names):
+                    if not _file_name.endswith('.py'):
+                        continue
+                    _module_parts = [package.__name__, *_relative_parts]
+                    if _file_name != '__init__.py':
+                        _module_parts.append(_file_name[:-3])
+                    _module_name = '.'.join(_module_parts)
+                    _tables[_module_name] = _source_table(_module_name, os.path.join(_dir_path, _file_name))
+
+        return _tables
+
     @staticmethod
     def __is_supported_type(code_object) -> bool:
         if callable(code_object):
@@ -258,7 +495,7 @@ class CodeInfo:
 
         return False
 
-    @cached_property
+    @_cached_slot
     def __unwrapped(self):
         _code_object = self.code_object
         _prefixes = []
@@ -340,3 +577,55 @@ class CodeInfo:
         the potential side-effects (or lack thereof) of calling an unwrapped function are undefined
         """
         return self.__unwrapped[1]
+
+
+def _source_table(module_name: str, source_file: str) -> Dict[str, Dict[str, Union[str, int, bool, None]]]:
+    """
+    mirrors what `CodeInfo.json` would return for each definition
+    """
+    _source_index = get_source_index(source_file)
+    if _source_index is None:
+        return dict()
+
+    _table = dict()
+    for _definition in _source_index.definitions:
+        # a setter has the same qualname as its property, but the property is still the getter
+        if _definition.is_property_accessor and _definition.qualname in _table:
+            continue
+
+        if _definition.is_class:
+            _class_name = _definition.name
+            _function_name = None
+            _function_qualname = None
+            _name = f'<{module_name}>.{_definition.name}'
+        else:
+            # same rules as `CodeInfo.cls`: the class containing it, unless it's local to a function
+            _class_name = None
+            _cls_qualname = _definition.qualname.split('.<locals>')[0]
+            if '.' in _cls_qualname:
+                _cls_definition = _source_index.find_class(_cls_qualname.rsplit('.', 1)[0])
+                if _cls_definition is not None:
+                    _class_name = _cls_definition.name
+
+            _function_qualname = _definition.qualname
+            _function_name = _function_qualname
+            if _class_name:
+                if _function_name.startswith(f'{_class_name}.'):
+                    _function_name = _function_name[len(_class_name) + 1:]
+                elif f'.{_class_name}.' in _function_name:
+                    _function_name = _function_name.split(f'.{_class_name}.', 1)[1]
+            _name = f'<{module_name}>.{_function_qualname}'
+
+        _table[_definition.qualname] = {
+            'name':              _name,
+            'module_name':       module_name,
+            'class_name':        _class_name,
+            'function_name':     _function_name,
+            'function_qualname': _function_qualname,
+            'path':              str(_source_index.path),
+            'lineno':            _definition.lineno,
+            'is_class':          _definition.is_class,
+            'kind':              'property' if _definition.is_property else _definition.kind,
+        }
+
+    return _table
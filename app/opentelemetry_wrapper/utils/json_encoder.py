@@ -1,15 +1,20 @@
 """
 stolen from fastapi.encoders, with a minor edit to force it to always return and never error
 ENCODERS_BY_TYPE was taken from pydantic.json
-all pydantic-specific code commented out
+all pydantic-specific code removed
+the type checks are resolved once per type and cached, and containers are encoded without recursion
+dataclasses, namedtuples, and `__slots__` classes are read with a field reader compiled once per type
 
-todo: specifiable max length of value, allow truncation
+encoding can be limited by an `EncodingBudget`, and circular references are always detected
 """
+import collections.abc
 import dataclasses
 import datetime
 import ipaddress
+import keyword
 from collections import defaultdict
 from collections import deque
+from dataclasses import dataclass
 from decimal import Decimal
 from enum import Enum
 from pathlib import Path
@@ -18,8 +23,8 @@ from re import Pattern
 from types import GeneratorType
 from typing import Any
 from typing import Callable
-from typing import Coroutine
 from typing import Dict
+from typing import Iterable
 from typing import Optional
 from typing import Set
 from typing import Tuple
@@ -27,7 +32,9 @@ from typing import Type
 from typing import Union
 from uuid import UUID
 
+from opentelemetry_wrapper.utils.caches import WeakCache
 from opentelemetry_wrapper.utils.introspect import CodeInfo
+from opentelemetry_wrapper.utils.span_info import cheap_name
 
 SetIntStr = Set[Union[int, str]]
 DictIntStrAny = Dict[Union[int, str], Any]
@@ -85,7 +92,191 @@ for data_type, data_encoder in ENCODERS_BY_TYPE.items():
     encoders_by_class_tuples[data_encoder] += (data_type,)
 
 
-# flake8: noqa: C901
+# resolved once per type (including subclasses), see `_resolve_kind`
+_KIND_IDENTITY = 0
+_KIND_DICT = 1
+_KIND_LIST = 2
+_KIND_ENCODER = 3
+_KIND_FIELDS = 4  # dataclass, namedtuple, or `__slots__` class
+_KIND_ENUM = 5
+_KIND_STR = 6
+_KIND_CALLABLE = 7
+_KIND_FALLBACK = 8
+
+_MISSING = object()
+
+# exact types that are returned as-is, checked before anything else
+_PRIMITIVE_TYPES = frozenset({str, int, float, bool, type(None)})
+
+# type -> (kind, encoder)
+_CACHE_KIND_BY_TYPE = WeakCache()
+
+
+def clear_type_cache() -> None:
+    """
+    call this after modifying `ENCODERS_BY_TYPE` or `encoders_by_class_tuples`
+    """
+    _CACHE_KIND_BY_TYPE.cache_clear()
+
+
+def _read_fields_slowly(obj: Any, field_names: Tuple[str, ...]) -> Dict[str, Any]:
+    """
+    skips unset attributes (e.g. an empty slot, or a dataclass field with `init=False` and no default)
+    """
+    out = dict()
+    for field_name in field_names:
+        value = getattr(obj, field_name, _MISSING)
+        if value is not _MISSING:
+            out[field_name] = value
+    return out
+
+
+def _compile_field_reader(field_names: Tuple[str, ...]) -> Callable[[Any], Dict[str, Any]]:
+    """
+    builds the equivalent of `lambda o: {'a': o.a, 'b': o.b}` for a specific type
+    this only reads the fields (no copying, unlike `dataclasses.asdict`), the values are encoded later as usual
+
+    :param field_names: attribute names, in output order
+    """
+    if not all(_name.isidentifier() and not keyword.iskeyword(_name) for _name in field_names):
+        return lambda obj: _read_fields_slowly(obj, field_names)
+
+    _items = ', '.join(f'{_name!r}: obj.{_name}' for _name in field_names)
+    _namespace: Dict[str, Any] = dict()
+    exec(f'def read_fields(obj):\n'  # noqa: S102, only ever formats identifiers
+         f'    return {{{_items}}}\n',
+         _namespace)
+    _read_fields_quickly = _namespace['read_fields']
+
+    def read_fields(obj: Any) -> Dict[str, Any]:
+        try:
+            return _read_fields_quickly(obj)
+        except AttributeError:
+            return _read_fields_slowly(obj, field_names)
+
+    return read_fields
+
+
+def _slot_names(obj_type: type) -> Tuple[str, ...]:
+    """
+    all the (non-special) slots of a class and its bases, with private names mangled the same way python does
+    """
+    out = []
+    for _class in reversed(obj_type.__mro__):
+        _slots = _class.__dict__.get('__slots__', ())
+        for _name in ((_slots,) if isinstance(_slots, str) else _slots):
+            if _name in ('__dict__', '__weakref__'):
+                continue
+            if _name.startswith('__') and not _name.endswith('__'):
+                _name = f'_{_class.__name__.lstrip("_")}{_name}'
+            if _name not in out:
+                out.append(_name)
+    return tuple(out)
+
+
+def _resolve_kind(obj_type: type) -> Tuple[int, Optional[Callable[[Any], Any]]]:
+    """
+    same order of checks that `jsonable_encoder` used to make for every single value
+    """
+    _cached = _CACHE_KIND_BY_TYPE.get(obj_type)
+    if _cached is not None:
+        return _cached
+
+    # the object is a class, which is callable (even if it's a dataclass)
+    if issubclass(obj_type, type):
+        _resolved = (_KIND_CALLABLE, None)
+    elif hasattr(obj_type, '__dataclass_fields__'):
+        _field_names = tuple(_field.name for _field in dataclasses.fields(obj_type))
+        _resolved = (_KIND_FIELDS, _compile_field_reader(_field_names))
+    elif issubclass(obj_type, Enum):
+        _resolved = (_KIND_ENUM, None)
+    elif issubclass(obj_type, PurePath):
+        _resolved = (_KIND_STR, None)
+    elif issubclass(obj_type, (str, int, float, type(None))):
+        _resolved = (_KIND_IDENTITY, None)
+    elif issubclass(obj_type, dict):
+        _resolved = (_KIND_DICT, None)
+    elif issubclass(obj_type, tuple) and isinstance(getattr(obj_type, '_fields', None), tuple):
+        _resolved = (_KIND_FIELDS, _compile_field_reader(obj_type._fields))  # namedtuple
+    elif issubclass(obj_type, (list, set, frozenset, GeneratorType, tuple)):
+        _resolved = (_KIND_LIST, None)
+    elif obj_type in ENCODERS_BY_TYPE:
+        _resolved = (_KIND_ENCODER, ENCODERS_BY_TYPE[obj_type])
+    else:
+        for encoder, classes_tuple in encoders_by_class_tuples.items():
+            if issubclass(obj_type, classes_tuple):
+                _resolved = (_KIND_ENCODER, encoder)
+                break
+        else:
+            if issubclass(obj_type, (collections.abc.Coroutine, collections.abc.Callable)):
+                _resolved = (_KIND_CALLABLE, None)
+            # `__slots__` classes have no `vars()`, so they'd otherwise end up as a `repr()`
+            elif obj_type.__dictoffset__ == 0 and not issubclass(obj_type, collections.abc.Iterable) and \
+                    _slot_names(obj_type):
+                _resolved = (_KIND_FIELDS, _compile_field_reader(_slot_names(obj_type)))
+            else:
+                _resolved = (_KIND_FALLBACK, None)
+
+    _CACHE_KIND_BY_TYPE[obj_type] = _resolved
+    return _resolved
+
+
+@dataclass(frozen=True)
+class EncodingBudget:
+    """
+    limits on how much work `jsonable_encoder` does, enforced while walking (not by truncating afterwards)
+    anything over a limit is replaced with a short marker string; set a limit to None to disable it
+    """
+    max_depth: Optional[int] = 32  # nested containers
+    max_items: Optional[int] = 1000  # per container
+    max_string_length: Optional[int] = 10000  # including the truncation suffix
+    max_total_size: Optional[int] = 1_000_000  # approximate length of the json output
+
+
+TRUNCATED_SUFFIX = '... (truncated)'
+TRUNCATED_MARKER = '(truncated)'
+CIRCULAR_REFERENCE_MARKER = '<circular reference>'
+MAX_DEPTH_MARKER = '<max depth exceeded>'
+
+# frame layout for the explicit stack in `jsonable_encoder`
+_FRAME_IS_DICT = 0
+_FRAME_ITEMS = 1
+_FRAME_APPLY_INCLUDE_EXCLUDE = 2
+_FRAME_SOURCE_ID = 3
+_FRAME_OUT = 4
+_FRAME_COUNT = 5
+
+
+def truncate_string(value: str, max_length: Optional[int]) -> str:
+    if max_length is None or len(value) <= max_length:
+        return value
+    return f'{value[:max(0, max_length - len(TRUNCATED_SUFFIX))]}{TRUNCATED_SUFFIX}'
+
+
+def _flat_size(values: Iterable[Any], max_string_length: Optional[int]) -> Optional[int]:
+    """
+    approximate json length of primitives
+
+    :return: None if any string is too long
+    """
+    size = 0
+    for value in values:
+        if type(value) is str:
+            if max_string_length is not None and len(value) > max_string_length:
+                return None
+            size += len(value) + 3
+        else:
+            size += 8
+    return size
+
+
+def _mark_truncated(out: Union[dict, list]) -> None:
+    if type(out) is dict:
+        out['...'] = TRUNCATED_MARKER
+    else:
+        out.append(TRUNCATED_SUFFIX)
+
+
 def jsonable_encoder(obj: Any,
                      include: Optional[Union[SetIntStr, DictIntStrAny]] = None,
                      exclude: Optional[Union[SetIntStr, DictIntStrAny]] = None,
@@ -95,123 +286,236 @@ def jsonable_encoder(obj: Any,
                      exclude_none: bool = False,
                      custom_encoder: Optional[Dict[Any, Callable[[Any], Any]]] = None,
                      sqlalchemy_safe: bool = True,
+                     budget: Optional[EncodingBudget] = None,
                      ) -> Any:
-    custom_encoder = custom_encoder or {}
-    if custom_encoder:
-        if type(obj) in custom_encoder:
-            return custom_encoder[type(obj)](obj)
-        else:
-            for encoder_type, encoder_instance in custom_encoder.items():
-                if isinstance(obj, encoder_type):
-                    return encoder_instance(obj)
+    """
+    `by_alias`, `exclude_unset`, and `exclude_defaults` only applied to pydantic models, and are ignored
+
+    containers are walked iteratively with an explicit stack, so deep nesting can't hit the recursion limit
+    like the original, `include` and `exclude` only apply to the top-level dict (or dicts nested only inside lists)
+    circular references are always replaced with a marker string
+
+    :param budget: limits on depth, container length, string length, and total size; unlimited if not set
+    """
+    return _jsonable_encoder(obj, include, exclude, exclude_none, custom_encoder, sqlalchemy_safe, budget, 0)[0]
+
+
+# flake8: noqa: C901
+def _jsonable_encoder(obj: Any,
+                      include: Optional[Union[SetIntStr, DictIntStrAny]],
+                      exclude: Optional[Union[SetIntStr, DictIntStrAny]],
+                      exclude_none: bool,
+                      custom_encoder: Optional[Dict[Any, Callable[[Any], Any]]],
+                      sqlalchemy_safe: bool,
+                      budget: Optional[EncodingBudget],
+                      size: int,
+                      ) -> Tuple[Any, int]:
+    """
+    see `jsonable_encoder`
+
+    :param size: how much of `max_total_size` has already been used (e.g. when encoding a dict key)
+    :return: (encoded value, size used including this value)
+    """
+    if budget is not None:
+        max_depth = budget.max_depth
+        max_items = budget.max_items
+        max_string_length = budget.max_string_length
+        max_total_size = budget.max_total_size
+    else:
+        max_depth = max_items = max_string_length = max_total_size = None
+
+    if type(obj) in _PRIMITIVE_TYPES and not custom_encoder:
+        if type(obj) is str:
+            obj = truncate_string(obj, max_string_length)
+            return obj, size + len(obj) + 3
+        return obj, size + 8
+
     if include is not None and not isinstance(include, (set, dict)):
         include = set(include)
     if exclude is not None and not isinstance(exclude, (set, dict)):
         exclude = set(exclude)
-    # if isinstance(obj, BaseModel):
-    #     encoder = getattr(obj.__config__, "json_encoders", {})
-    #     if custom_encoder:
-    #         encoder.update(custom_encoder)
-    #     obj_dict = obj.dict(
-    #         include=include,  # type: ignore # in Pydantic
-    #         exclude=exclude,  # type: ignore # in Pydantic
-    #         by_alias=by_alias,
-    #         exclude_unset=exclude_unset,
-    #         exclude_none=exclude_none,
-    #         exclude_defaults=exclude_defaults,
-    #     )
-    #     if "__root__" in obj_dict:
-    #         obj_dict = obj_dict["__root__"]
-    #     return jsonable_encoder(
-    #         obj_dict,
-    #         exclude_none=exclude_none,
-    #         exclude_defaults=exclude_defaults,
-    #         custom_encoder=encoder,
-    #         sqlalchemy_safe=sqlalchemy_safe,
-    #     )
-    if dataclasses.is_dataclass(obj):
-        return dataclasses.asdict(obj)
-    if isinstance(obj, Enum):
-        return obj.value
-    if isinstance(obj, PurePath):
-        return str(obj)
-    if isinstance(obj, (str, int, float, type(None))):
-        return obj
-    if isinstance(obj, dict):
-        encoded_dict = {}
-        for key, value in obj.items():
-            if (
-                    (
-                            not sqlalchemy_safe
-                            or (not isinstance(key, str))
-                            or (not key.startswith("_sa"))
-                    )
-                    and (value is not None or not exclude_none)
-                    and ((include and key in include) or not exclude or key not in exclude)
-            ):
-                encoded_key = jsonable_encoder(
-                    key,
-                    by_alias=by_alias,
-                    exclude_unset=exclude_unset,
-                    exclude_none=exclude_none,
-                    custom_encoder=custom_encoder,
-                    sqlalchemy_safe=sqlalchemy_safe,
-                )
-                encoded_value = jsonable_encoder(
-                    value,
-                    by_alias=by_alias,
-                    exclude_unset=exclude_unset,
-                    exclude_none=exclude_none,
-                    custom_encoder=custom_encoder,
-                    sqlalchemy_safe=sqlalchemy_safe,
-                )
-                encoded_dict[encoded_key] = encoded_value
-        return encoded_dict
-    if isinstance(obj, (list, set, frozenset, GeneratorType, tuple)):
-        encoded_list = []
-        for item in obj:
-            encoded_list.append(
-                jsonable_encoder(
-                    item,
-                    include=include,
-                    exclude=exclude,
-                    by_alias=by_alias,
-                    exclude_unset=exclude_unset,
-                    exclude_defaults=exclude_defaults,
-                    exclude_none=exclude_none,
-                    custom_encoder=custom_encoder,
-                    sqlalchemy_safe=sqlalchemy_safe,
-                )
-            )
-        return encoded_list
-
-    if type(obj) in ENCODERS_BY_TYPE:
-        return ENCODERS_BY_TYPE[type(obj)](obj)
-    for encoder, classes_tuple in encoders_by_class_tuples.items():
-        if isinstance(obj, classes_tuple):
-            return encoder(obj)
-
-    # EDITS START HERE
-    if isinstance(obj, (Coroutine, Callable)):
-        return CodeInfo(obj).name
-
-    # noinspection PyBroadException
-    try:
-        data = dict(obj)
-    except Exception:
+
+    def encode_scalar(value: Any) -> Any:
+        """
+        apply the budget to something that's already been encoded
+        """
+        nonlocal size
+        if type(value) is str:
+            value = truncate_string(value, max_string_length)
+            size += len(value) + 3
+        else:
+            size += 8
+        return value
+
+    def encode_one(value: Any, apply_include_exclude: bool, depth: int, source_id: Optional[int] = None,
+                   ) -> Tuple[Any, Optional[list]]:
+        """
+        :param depth: number of containers this value is nested in
+        :return: (encoded value, stack frame to fill it in if it's a container)
+        """
+        nonlocal size
+        if custom_encoder:
+            if type(value) in custom_encoder:
+                return custom_encoder[type(value)](value), None
+            for encoder_type, encoder_instance in custom_encoder.items():
+                if isinstance(value, encoder_type):
+                    return encoder_instance(value), None
+
+        _type = type(value)
+        if _type in _PRIMITIVE_TYPES:
+            return value, None
+
+        # skip the cache lookup for the most common containers
+        if _type is dict:
+            kind, encoder = _KIND_DICT, None
+        elif _type is list:
+            kind, encoder = _KIND_LIST, None
+        else:
+            kind, encoder = _resolve_kind(_type)
+
+        # containers that are too deep get a frame anyway, so the caller replaces them with a marker
+        _fast = max_depth is None or depth < max_depth
+
+        if kind == _KIND_DICT:
+            _filtered = apply_include_exclude and (include is not None or exclude is not None)
+            if _fast and not _filtered and not exclude_none and not custom_encoder:
+                # fast path for flat dicts of primitives
+                if all(type(_value) in _PRIMITIVE_TYPES for _value in value.values()) and \
+                        all(type(_key) is str and not (sqlalchemy_safe and _key.startswith('_sa')) for _key in value):
+                    if budget is None:
+                        return dict(value), None
+                    if max_items is None or len(value) <= max_items:
+                        _size = _flat_size(value.values(), max_string_length)
+                        _keys_size = _flat_size(value, max_string_length)  # keys are all strings here
+                        if _size is not None and _keys_size is not None:
+                            _size += _keys_size
+                            # otherwise the walk below truncates it partway
+                            if max_total_size is None or size + _size <= max_total_size:
+                                size += _size
+                                return dict(value), None
+            return {}, [True, iter(value.items()), _filtered, id(value) if source_id is None else source_id]
+
+        if kind == _KIND_LIST:
+            # fast path for flat lists of primitives
+            if _fast and not custom_encoder and _type in (list, tuple) and \
+                    all(type(_item) in _PRIMITIVE_TYPES for _item in value):
+                if budget is None:
+                    return list(value), None
+                if max_items is None or len(value) <= max_items:
+                    _size = _flat_size(value, max_string_length)
+                    if _size is not None and (max_total_size is None or size + _size <= max_total_size):
+                        size += _size
+                        return list(value), None
+            return [], [False, iter(value), apply_include_exclude, id(value) if source_id is None else source_id]
+
+        if kind == _KIND_IDENTITY:
+            return value, None
+        if kind == _KIND_ENCODER:
+            return encoder(value), None
+        if kind == _KIND_FIELDS:
+            # the field dict is new every time, so use the original object to detect cycles
+            return encode_one(encoder(value), False, depth, id(value))
+        if kind == _KIND_ENUM:
+            return value.value, None
+        if kind == _KIND_STR:
+            return str(value), None
+        if kind == _KIND_CALLABLE:
+            return cheap_name(value) or CodeInfo(value).name, None
+
+        # EDITS START HERE
         # noinspection PyBroadException
         try:
-            data = vars(obj)
+            data = dict(value)
         except Exception:
-            return repr(obj)
-    # EDITS END HERE
-
-    return jsonable_encoder(
-        data,
-        by_alias=by_alias,
-        exclude_unset=exclude_unset,
-        exclude_defaults=exclude_defaults,
-        exclude_none=exclude_none,
-        custom_encoder=custom_encoder,
-        sqlalchemy_safe=sqlalchemy_safe,
-    )
+            # noinspection PyBroadException
+            try:
+                data = vars(value)
+            except Exception:
+                return repr(value), None
+        # EDITS END HERE
+
+        # `dict(value)` is a new dict every time, so use the original object to detect cycles
+        return encode_one(data, False, depth, id(value))
+
+    encoded, frame = encode_one(obj, True, 0)
+    if frame is None:
+        return (encode_scalar(encoded) if budget is not None else encoded), size
+    if max_depth is not None and max_depth < 1:
+        return MAX_DEPTH_MARKER, size + len(MAX_DEPTH_MARKER) + 3
+
+    frame.append(encoded)
+    frame.append(0)
+    stack = [frame]
+    active_ids = {frame[_FRAME_SOURCE_ID]}  # containers currently being encoded, to detect cycles
+    while stack:
+        frame = stack[-1]
+        is_dict = frame[_FRAME_IS_DICT]
+        items = frame[_FRAME_ITEMS]
+        apply_include_exclude = frame[_FRAME_APPLY_INCLUDE_EXCLUDE]
+        out = frame[_FRAME_OUT]
+
+        while True:
+            item = next(items, _MISSING)
+            if item is _MISSING:
+                stack.pop()
+                active_ids.discard(frame[_FRAME_SOURCE_ID])
+                break
+
+            # stop early instead of encoding everything and truncating afterwards
+            if budget is not None:
+                if (max_items is not None and frame[_FRAME_COUNT] >= max_items) or \
+                        (max_total_size is not None and size > max_total_size):
+                    _mark_truncated(out)
+                    stack.pop()
+                    active_ids.discard(frame[_FRAME_SOURCE_ID])
+                    break
+                frame[_FRAME_COUNT] += 1
+
+            if is_dict:
+                key, value = item
+                if sqlalchemy_safe and isinstance(key, str) and key.startswith('_sa'):
+                    continue
+                if value is None and exclude_none:
+                    continue
+                if apply_include_exclude and not ((include and key in include) or not exclude or key not in exclude):
+                    continue
+                if type(key) is str and not custom_encoder:
+                    encoded_key = key
+                    if budget is not None:
+                        encoded_key = truncate_string(key, max_string_length)
+                        size += len(encoded_key) + 3
+                else:
+                    encoded_key, size = _jsonable_encoder(key, None, None, exclude_none, custom_encoder,
+                                                          sqlalchemy_safe, budget, size)
+                if type(value) in _PRIMITIVE_TYPES and not custom_encoder:
+                    out[encoded_key] = encode_scalar(value) if budget is not None else value
+                    continue
+                encoded_value, child_frame = encode_one(value, False, len(stack))
+            else:
+                if type(item) in _PRIMITIVE_TYPES and not custom_encoder:
+                    out.append(encode_scalar(item) if budget is not None else item)
+                    continue
+                encoded_value, child_frame = encode_one(item, apply_include_exclude, len(stack))
+
+            if child_frame is None:
+                if budget is not None:
+                    encoded_value = encode_scalar(encoded_value)
+            elif child_frame[_FRAME_SOURCE_ID] in active_ids:
+                encoded_value, child_frame = CIRCULAR_REFERENCE_MARKER, None
+            elif max_depth is not None and len(stack) >= max_depth:
+                encoded_value, child_frame = MAX_DEPTH_MARKER, None
+
+            if is_dict:
+                out[encoded_key] = encoded_value
+            else:
+                out.append(encoded_value)
+
+            if child_frame is not None:
+                size += 2
+                child_frame.append(encoded_value)
+                child_frame.append(0)
+                stack.append(child_frame)
+                active_ids.add(child_frame[_FRAME_SOURCE_ID])
+                break  # resume this container after the child is done
+
+    return encoded, size
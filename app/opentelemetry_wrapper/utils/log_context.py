@@ -0,0 +1,91 @@
+"""
+adds the current trace context to every LogRecord, as `otelTraceID`, `otelSpanID`, `otelServiceName`, etc
+
+replaces the record factory from `opentelemetry-instrumentation-logging` (instead of wrapping it), because
+* it formats both ids as hex for every record, which we then had to parse and reformat with a `0x` prefix
+* newer versions only add the ids if `inject_trace_context` is set, so the attributes could be missing entirely
+
+the ids are plain strings (so any formatter, filter, or handler can use them), but they're formatted once per span
+and shared by every record logged in that span, rather than formatted again for each record
+"""
+import logging
+from functools import wraps
+from typing import Callable
+from typing import Dict
+from typing import Tuple
+
+from opentelemetry.instrumentation.logging import LoggingInstrumentor
+from opentelemetry.trace import get_current_span
+from opentelemetry.trace import get_tracer_provider
+
+# what logs outside a span get; same format as real ids, so they're easy to filter
+INVALID_TRACE_ID = f'0x{0:032x}'
+INVALID_SPAN_ID = f'0x{0:016x}'
+
+
+# span id -> (trace id, formatted trace id, formatted span id)
+# every record logged in a span gets the same strings, so each span's ids are only formatted once
+_FORMATTED_IDS: Dict[int, Tuple[int, str, str]] = dict()
+_MAX_FORMATTED_IDS = 4096  # more than the number of spans that log concurrently; cleared when full
+
+
+def _formatted_ids(trace_id: int, span_id: int) -> Tuple[int, str, str]:
+    """
+    thread-safe without a lock, since each dict operation is atomic and a race only formats an id twice
+    """
+    _cached = _FORMATTED_IDS.get(span_id)
+    if _cached is None or _cached[0] != trace_id:
+        _cached = (trace_id, f'0x{trace_id:032x}', f'0x{span_id:016x}')
+        if len(_FORMATTED_IDS) >= _MAX_FORMATTED_IDS:
+            _FORMATTED_IDS.clear()
+        _FORMATTED_IDS[span_id] = _cached
+    return _cached
+
+
+def _get_service_name() -> str:
+    _resource = getattr(get_tracer_provider(), 'resource', None)
+    if _resource is None:
+        return ''
+    return _resource.attributes.get('service.name') or ''
+
+
+def make_record_factory(old_factory: Callable[..., logging.LogRecord]) -> Callable[..., logging.LogRecord]:
+    """
+    :param old_factory: the record factory to wrap, i.e. the one from before any otel instrumentation
+    """
+    _service_name = ''
+
+    @wraps(old_factory)
+    def record_factory(*args, **kwargs) -> logging.LogRecord:
+        nonlocal _service_name
+        record = old_factory(*args, **kwargs)
+
+        # the tracer provider may be set after logging is instrumented, so keep checking until it's known
+        if not _service_name:
+            _service_name = _get_service_name()
+        record.otelServiceName = _service_name
+
+        _span = get_current_span()
+        _span_context = _span.get_span_context()
+        if not _span_context.is_valid:
+            record.otelTraceID = INVALID_TRACE_ID
+            record.otelSpanID = INVALID_SPAN_ID
+            record.otelTraceSampled = False
+            return record
+
+        _, record.otelTraceID, record.otelSpanID = _formatted_ids(_span_context.trace_id, _span_context.span_id)
+        record.otelTraceSampled = _span_context.trace_flags.sampled
+
+        # same hook the upstream instrumentor supports
+        # noinspection PyProtectedMember
+        _log_hook = LoggingInstrumentor._log_hook
+        if callable(_log_hook):
+            # noinspection PyBroadException
+            try:
+                _log_hook(_span, record)
+            except Exception:
+                pass
+
+        return record
+
+    return record_factory
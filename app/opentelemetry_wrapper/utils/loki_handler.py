@@ -0,0 +1,166 @@
+"""
+push logs directly to Loki (https://grafana.com/docs/loki/latest/reference/loki-http-api/#ingest-logs)
+
+instead of writing to stderr and having the docker loki driver forward each line,
+records are queued (see `BatchingQueueHandler`), grouped into streams by a small set of labels,
+and pushed in gzipped batches from a background thread
+failed pushes are retried with exponential backoff, and dropped (and counted) if they keep failing
+
+labels are `service` (from `config.get_service_name`), `level`, plus any static labels you pass in
+keep the label set small, since every distinct combination is a separate stream in Loki
+"""
+import gzip
+import json
+import logging
+import time
+import urllib.error
+import urllib.request
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from opentelemetry_wrapper.config import get_service_name
+from opentelemetry_wrapper.utils.batching_handler import BatchingQueueHandler
+from opentelemetry_wrapper.utils.batching_handler import OVERFLOW_DROP_OLDEST
+
+DEFAULT_LOKI_URL = 'http://localhost:3100/loki/api/v1/push'
+
+# worth retrying; anything else (e.g. 400 for a malformed or too-old entry) will fail again
+_RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+
+class LokiHandler(BatchingQueueHandler):
+    """
+    pushes JSON-formatted records to Loki's push API from a background thread
+    """
+
+    def __init__(self,
+                 url: str = DEFAULT_LOKI_URL,
+                 *,
+                 level: int = logging.NOTSET,
+                 labels: Optional[Dict[str, str]] = None,
+                 queue_size: int = 10000,
+                 overflow_policy: str = OVERFLOW_DROP_OLDEST,
+                 batch_size: int = 1000,
+                 max_batch_bytes: int = 1024 * 1024,
+                 flush_interval: float = 1.0,
+                 max_retries: int = 5,
+                 backoff_seconds: float = 0.5,
+                 max_backoff_seconds: float = 30.0,
+                 timeout_seconds: float = 10.0,
+                 headers: Optional[Dict[str, str]] = None,
+                 ) -> None:
+        """
+        :param url: Loki push endpoint
+        :param level: handler level
+        :param labels: static labels added to every stream (in addition to `service` and `level`)
+        :param queue_size: max number of records waiting to be pushed
+        :param overflow_policy: what to do when the queue is full, one of `OVERFLOW_POLICIES`
+        :param batch_size: max records per push
+        :param max_batch_bytes: max (uncompressed) log line bytes per push
+        :param flush_interval: max seconds a record waits before being pushed
+        :param max_retries: retries per push before dropping the batch
+        :param backoff_seconds: wait before the first retry, doubled after each retry
+        :param max_backoff_seconds: max wait between retries
+        :param timeout_seconds: HTTP timeout per push
+        :param headers: extra HTTP headers, e.g. `X-Scope-OrgID` or `Authorization`
+        """
+        self.url = url
+        self.labels: Dict[str, str] = {'service': get_service_name()}
+        self.labels.update(labels or dict())
+        self.max_batch_bytes = max_batch_bytes
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.timeout_seconds = timeout_seconds
+        self.headers: Dict[str, str] = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+        self.headers.update(headers or dict())
+
+        # counters, readable any time
+        self.pushes = 0
+        self.retries = 0
+        self.failed_records = 0  # gave up after retrying, or rejected by Loki
+
+        super().__init__(level=level,
+                         queue_size=queue_size,
+                         overflow_policy=overflow_policy,
+                         batch_size=batch_size,
+                         flush_interval=flush_interval)
+
+    def _after_fork_in_child(self) -> None:
+        self.pushes = 0
+        self.retries = 0
+        self.failed_records = 0
+        super()._after_fork_in_child()
+
+    def _stream_labels(self, record: logging.LogRecord) -> Tuple[Tuple[str, str], ...]:
+        _labels = dict(self.labels)
+        _labels['level'] = record.levelname.lower()
+        return tuple(sorted(_labels.items()))
+
+    def write_batch(self, batch: List[logging.LogRecord]) -> int:
+        """
+        push one batch, split into chunks of at most `max_batch_bytes`
+        """
+        _written = 0
+        _streams: Dict[Tuple[Tuple[str, str], ...], List[Tuple[str, str]]] = dict()
+        _size = 0
+        for _record in batch:
+            # noinspection PyBroadException
+            try:
+                _line = self.format(_record)
+            except Exception:
+                self.handleError(_record)
+                continue
+
+            if _size + len(_line) > self.max_batch_bytes and _streams:
+                _written += self._push(_streams)
+                _streams = dict()
+                _size = 0
+
+            # loki wants nanosecond timestamps as strings
+            _timestamp = str(int(_record.created * 1_000_000) * 1000)
+            _streams.setdefault(self._stream_labels(_record), []).append((_timestamp, _line))
+            _size += len(_line)
+
+        if _streams:
+            _written += self._push(_streams)
+        return _written
+
+    def _push(self, streams: Dict[Tuple[Tuple[str, str], ...], List[Tuple[str, str]]]) -> int:
+        """
+        :return: number of records pushed
+        """
+        _count = sum(len(_values) for _values in streams.values())
+        _body = gzip.compress(json.dumps({
+            'streams': [{'stream':  dict(_labels),
+                         'values':  sorted(_values)}  # older versions of loki reject out-of-order entries
+                        for _labels, _values in streams.items()],
+        }, ensure_ascii=False).encode('utf8'), compresslevel=6)
+
+        _backoff = self.backoff_seconds
+        for _attempt in range(self.max_retries + 1):
+            if _attempt:
+                self.retries += 1
+                time.sleep(_backoff)
+                _backoff = min(self.max_backoff_seconds, _backoff * 2)
+
+            _request = urllib.request.Request(self.url, data=_body, headers=self.headers, method='POST')
+            try:
+                with urllib.request.urlopen(_request, timeout=self.timeout_seconds) as _response:
+                    _response.read()
+                self.pushes += 1
+                return _count
+            except urllib.error.HTTPError as e:
+                if e.code not in _RETRYABLE_STATUS_CODES:
+                    break
+            except (urllib.error.URLError, OSError):
+                pass  # e.g. connection refused or timed out
+
+            # don't hold up shutdown for too long
+            if self._closed:
+                break
+
+        self.failed_records += _count
+        return 0
@@ -0,0 +1,151 @@
+"""
+rate-limit log records per callsite, i.e. per (logger name, file, line number, level)
+
+a hot loop that logs (e.g. `bitshift` in `experiment_otel_logging.py`) would otherwise write millions of lines
+each callsite gets its own `TokenBucket`, and records over the limit are dropped and counted
+the count is reported in a summary record from the same callsite, at most once per `summary_interval` seconds,
+the next time that callsite is allowed to log again (or when the process exits)
+
+the callsite lookup is a single dict lookup, and the only locks are per callsite, so threads rarely contend
+"""
+import atexit
+import logging
+import threading
+import time
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from opentelemetry_wrapper.utils.fork_safety import register_after_fork
+from opentelemetry_wrapper.utils.sampling import TokenBucket
+
+# set on summary records, so they're never rate-limited themselves
+RATE_LIMIT_SUPPRESSED_ATTRIBUTE = 'rate_limit_suppressed'
+
+_CallsiteKey = Tuple[str, str, int, int]
+
+
+class _Callsite:
+    __slots__ = ('token_bucket', 'suppressed', 'suppressed_since', 'last_summary', 'lock', 'record')
+
+    def __init__(self, rate: float, burst: Optional[float]) -> None:
+        self.token_bucket = TokenBucket(rate, burst)
+        self.suppressed = 0
+        self.suppressed_since = 0.0
+        self.last_summary = 0.0
+        self.lock = threading.Lock()
+        self.record: Optional[logging.LogRecord] = None  # the last suppressed record, to copy the callsite from
+
+
+class CallsiteRateLimitFilter(logging.Filter):
+    """
+    add this to a handler (not a logger, since logger filters don't apply to records from child loggers)
+    """
+
+    def __init__(self,
+                 rate: float,
+                 burst: Optional[float] = None,
+                 *,
+                 summary_interval: float = 10.0,
+                 summary_handler: Optional[logging.Handler] = None,
+                 max_callsites: int = 10000,
+                 ) -> None:
+        """
+        :param rate: records per second, per callsite
+        :param burst: max burst per callsite; defaults to one second's worth
+        :param summary_interval: min seconds between "suppressed N similar messages" records, per callsite
+        :param summary_handler: where to send summary records, usually the handler this filter is added to;
+                                if not set, they're logged to the callsite's logger instead
+        :param max_callsites: callsites past this many are not rate-limited, so memory stays bounded
+        """
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.summary_interval = summary_interval
+        self.summary_handler = summary_handler
+        self.max_callsites = max_callsites
+
+        self._callsites: Dict[_CallsiteKey, _Callsite] = dict()
+        atexit.register(self.flush_summaries)
+        register_after_fork(self)
+
+    def _after_fork_in_child(self) -> None:
+        """
+        the parent reports its own suppressed records, and each child gets its own rate limit
+        """
+        self._callsites = dict()
+
+    @property
+    def suppressed(self) -> int:
+        """
+        number of records currently suppressed and not yet reported in a summary
+        """
+        return sum(_callsite.suppressed for _callsite in list(self._callsites.values()))
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if hasattr(record, RATE_LIMIT_SUPPRESSED_ATTRIBUTE):
+            return True
+
+        _key = (record.name, record.pathname, record.lineno, record.levelno)
+        _callsite = self._callsites.get(_key)
+        if _callsite is None:
+            if len(self._callsites) >= self.max_callsites:
+                return True
+            # `setdefault` is atomic, so concurrent first calls share one callsite
+            _callsite = self._callsites.setdefault(_key, _Callsite(self.rate, self.burst))
+
+        if not _callsite.token_bucket.acquire():
+            with _callsite.lock:
+                if not _callsite.suppressed:
+                    _callsite.suppressed_since = time.time()
+                _callsite.suppressed += 1
+                _callsite.record = record
+            return False
+
+        if _callsite.suppressed:
+            self._summarize(_callsite, force=False)
+        return True
+
+    def _summarize(self, callsite: _Callsite, force: bool) -> None:
+        with callsite.lock:
+            _now = time.time()
+            if not callsite.suppressed or (not force and _now - callsite.last_summary < self.summary_interval):
+                return
+            _count = callsite.suppressed
+            _since = callsite.suppressed_since
+            _record = callsite.record
+            callsite.suppressed = 0
+            callsite.record = None
+            callsite.last_summary = _now
+        if _record is None:
+            return
+
+        _summary = logging.getLogger(_record.name).makeRecord(
+            _record.name,
+            _record.levelno,
+            _record.pathname,
+            _record.lineno,
+            'suppressed %d similar messages in the last %.1f seconds',
+            (_count, _now - _since),
+            None,
+            func=_record.funcName,
+            extra={RATE_LIMIT_SUPPRESSED_ATTRIBUTE: _count},
+        )
+        # noinspection PyBroadException
+        try:
+            if self.summary_handler is not None:
+                self.summary_handler.handle(_summary)
+            else:
+                logging.getLogger(_record.name).handle(_summary)
+        except Exception:
+            pass
+
+    def flush_summaries(self) -> None:
+        """
+        report every callsite with suppressed records, regardless of `summary_interval`
+        """
+        _callsites: List[_Callsite] = list(self._callsites.values())
+        for _callsite in _callsites:
+            if _callsite.suppressed:
+                self._summarize(_callsite, force=True)
@@ -0,0 +1,247 @@
+"""
+per-function sampling for `instrument_decorate`
+
+rules can be set by decorator argument, by calling `add_sampling_rule`, or by env var
+env vars are comma-separated lists of `{glob}={value}` pairs (or just `{glob}` for the flag lists), e.g.
+    OTEL_WRAPPER_DO_NOT_INSTRUMENT='my_app.utils.*,*.hot_helper'
+    OTEL_WRAPPER_SAMPLE_RATIO='my_app.db.*=0.1'
+    OTEL_WRAPPER_RATE_LIMIT='*.bitshift=100'
+    OTEL_WRAPPER_AGGREGATE='*.bitshift'
+
+globs are matched (case-sensitively) against `{module}.{qualname}`, e.g. `__main__.A.b`
+rules added later take precedence over rules added earlier, and env vars are loaded first
+rules are resolved when a function is decorated, so set them before importing the code they apply to
+"""
+import fnmatch
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+ENV_DO_NOT_INSTRUMENT = 'OTEL_WRAPPER_DO_NOT_INSTRUMENT'
+ENV_SAMPLE_RATIO = 'OTEL_WRAPPER_SAMPLE_RATIO'
+ENV_RATE_LIMIT = 'OTEL_WRAPPER_RATE_LIMIT'
+ENV_AGGREGATE = 'OTEL_WRAPPER_AGGREGATE'
+
+
+class TokenBucket:
+    """
+    thread-safe token bucket that refills continuously at `rate` tokens per second, up to `capacity` tokens
+    """
+    __slots__ = ('rate', 'capacity', '_tokens', '_last', '_lock')
+
+    def __init__(self, rate: float, capacity: Optional[float] = None) -> None:
+        """
+        :param rate: tokens per second
+        :param capacity: max burst size; defaults to one second's worth of tokens (and at least 1)
+        """
+        if rate < 0:
+            raise ValueError(rate)
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity is not None else max(1.0, self.rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        """
+        take one token if available
+
+        :return: True if a token was taken
+        """
+        with self._lock:
+            now = time.monotonic()
+            tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if tokens >= 1:
+                self._tokens = tokens - 1
+                return True
+            self._tokens = tokens
+            return False
+
+
+class Sampler:
+    """
+    decides if a single call should be recorded as a span
+    a sampler is shared by every function with the same qualified name, so rate limits apply across instances
+    """
+    __slots__ = ('sample_ratio', 'rate_limit', '_token_bucket')
+
+    def __init__(self,
+                 sample_ratio: Optional[float] = None,
+                 rate_limit: Optional[float] = None,
+                 ) -> None:
+        """
+        :param sample_ratio: fraction of calls to record, between 0 and 1
+        :param rate_limit: max number of recorded calls per second
+        """
+        if sample_ratio is not None and not 0 <= sample_ratio <= 1:
+            raise ValueError(sample_ratio)
+        self.sample_ratio = sample_ratio
+        self.rate_limit = rate_limit
+        self._token_bucket = TokenBucket(rate_limit) if rate_limit is not None else None
+
+    def __call__(self) -> bool:
+        if self.sample_ratio is not None and random.random() >= self.sample_ratio:
+            return False
+        if self._token_bucket is not None and not self._token_bucket.acquire():
+            return False
+        return True
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(sample_ratio={self.sample_ratio!r}, rate_limit={self.rate_limit!r})'
+
+
+@dataclass(frozen=True)
+class SamplingRule:
+    pattern: str
+    sample_ratio: Optional[float] = None
+    rate_limit: Optional[float] = None
+    do_not_instrument: bool = False
+    aggregate: bool = False
+
+    def matches(self, qualified_name: str) -> bool:
+        return fnmatch.fnmatchcase(qualified_name, self.pattern)
+
+
+_RULES: List[SamplingRule] = []
+_SAMPLERS: Dict[Tuple[str, Optional[float], Optional[float]], Sampler] = dict()
+_LOCK = threading.Lock()
+
+
+def add_sampling_rule(pattern: str,
+                      *,
+                      sample_ratio: Optional[float] = None,
+                      rate_limit: Optional[float] = None,
+                      do_not_instrument: bool = False,
+                      aggregate: bool = False,
+                      ) -> SamplingRule:
+    """
+    add a rule for all functions (and classes) whose `{module}.{qualname}` matches the glob `pattern`
+    only applies to things decorated after the rule is added
+
+    :param pattern: glob, e.g. `my_app.utils.*`
+    :param sample_ratio: fraction of calls to record, between 0 and 1
+    :param rate_limit: max number of recorded calls per second
+    :param do_not_instrument: never instrument matching functions at all
+    :param aggregate: collapse repeated calls under the same parent span into a summary span
+    :return:
+    """
+    if sample_ratio is not None and not 0 <= sample_ratio <= 1:
+        raise ValueError(sample_ratio)
+    if rate_limit is not None and rate_limit < 0:
+        raise ValueError(rate_limit)
+
+    rule = SamplingRule(pattern, sample_ratio, rate_limit, do_not_instrument, aggregate)
+    with _LOCK:
+        _RULES.append(rule)
+    return rule
+
+
+def clear_sampling_rules() -> None:
+    """
+    remove all rules, including those loaded from env vars
+    """
+    with _LOCK:
+        _RULES.clear()
+        _SAMPLERS.clear()
+
+
+def _parse_env_rules(env_var: str) -> List[Tuple[str, Optional[str]]]:
+    out = []
+    for item in os.getenv(env_var, '').split(','):
+        pattern, sep, value = item.partition('=')
+        if pattern.strip():
+            out.append((pattern.strip(), value.strip() if sep else None))
+    return out
+
+
+def load_sampling_rules_from_env() -> None:
+    """
+    read rules from env vars; invalid entries are silently skipped
+    """
+    for pattern, _ in _parse_env_rules(ENV_DO_NOT_INSTRUMENT):
+        add_sampling_rule(pattern, do_not_instrument=True)
+    for pattern, _ in _parse_env_rules(ENV_AGGREGATE):
+        add_sampling_rule(pattern, aggregate=True)
+
+    for env_var, kwarg in ((ENV_SAMPLE_RATIO, 'sample_ratio'), (ENV_RATE_LIMIT, 'rate_limit')):
+        for pattern, value in _parse_env_rules(env_var):
+            try:
+                add_sampling_rule(pattern, **{kwarg: float(value)})
+            except (TypeError, ValueError):
+                continue
+
+
+def qualified_name_of(func: Any) -> Optional[str]:
+    """
+    cheaply get `{module}.{qualname}` without introspecting the source
+
+    :param func: function, method, or class
+    :return: None if the name cannot be determined
+    """
+    _qualname = getattr(func, '__qualname__', None) or getattr(func, '__name__', None)
+    if not isinstance(_qualname, str):
+        return None
+    _module = getattr(func, '__module__', None)
+    if isinstance(_module, str) and _module:
+        return f'{_module}.{_qualname}'
+    return _qualname
+
+
+def is_do_not_instrument(qualified_name: Optional[str]) -> bool:
+    if qualified_name is None:
+        return False
+    return any(rule.do_not_instrument and rule.matches(qualified_name) for rule in _RULES)
+
+
+def should_aggregate(qualified_name: Optional[str]) -> bool:
+    if qualified_name is None:
+        return False
+    return any(rule.aggregate and rule.matches(qualified_name) for rule in _RULES)
+
+
+def get_sampler(qualified_name: Optional[str],
+                sample_ratio: Optional[float] = None,
+                rate_limit: Optional[float] = None,
+                ) -> Optional[Sampler]:
+    """
+    find the sampler for a function, with the explicit args taking precedence over matching rules
+
+    :param qualified_name: `{module}.{qualname}`
+    :param sample_ratio: overrides any rule
+    :param rate_limit: overrides any rule
+    :return: None if every call should be recorded
+    """
+    if qualified_name is not None:
+        for rule in reversed(_RULES):
+            if sample_ratio is not None and rate_limit is not None:
+                break
+            if rule.matches(qualified_name):
+                if sample_ratio is None:
+                    sample_ratio = rule.sample_ratio
+                if rate_limit is None:
+                    rate_limit = rule.rate_limit
+
+    if sample_ratio is None and rate_limit is None:
+        return None
+
+    if qualified_name is None:
+        return Sampler(sample_ratio, rate_limit)
+
+    # share the sampler (and its token bucket) between all functions with the same name
+    # otherwise each bound method would get its own rate limit
+    key = (qualified_name, sample_ratio, rate_limit)
+    with _LOCK:
+        if key not in _SAMPLERS:
+            _SAMPLERS[key] = Sampler(sample_ratio, rate_limit)
+        return _SAMPLERS[key]
+
+
+load_sampling_rules_from_env()
@@ -0,0 +1,180 @@
+"""
+static index of the classes and functions defined in a source file, built by parsing the file (once) with `ast`
+nothing is imported or executed, so it's safe to use on any file
+
+each file is parsed at most once per (mtime, size), and the most recently used indexes are kept in memory
+"""
+import ast
+import os
+import tokenize
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+from opentelemetry_wrapper.utils.caches import bounded_lru_cache
+
+KIND_CLASS = 'class'
+KIND_FUNCTION = 'function'
+KIND_ASYNC_FUNCTION = 'async function'
+
+_PROPERTY_DECORATORS = {'property', 'cached_property', 'functools.cached_property'}
+_PROPERTY_ACCESSOR_DECORATOR_SUFFIXES = ('.getter', '.setter', '.deleter')
+
+
+@dataclass(frozen=True)
+class SourceDefinition:
+    qualname: str  # same as the `__qualname__` the object will have at runtime, e.g. `A.f.<locals>.g`
+    name: str
+    kind: str  # one of the `KIND_*` constants
+    class_name: Optional[str]  # for a class, its own name; for a method, the class it's defined in
+    lineno: int  # first line, including decorators, same as `inspect.getsourcelines` and `co_firstlineno`
+    end_lineno: Optional[int]  # last line (inclusive), or None if the python version doesn't track it
+    decorators: Tuple[str, ...]  # dotted names of the decorators, e.g. `('property',)` or `('x.setter',)`
+
+    @property
+    def is_class(self) -> bool:
+        return self.kind == KIND_CLASS
+
+    @property
+    def is_property(self) -> bool:
+        """
+        best guess from the decorator names, since nothing is executed
+        """
+        return any(_decorator in _PROPERTY_DECORATORS for _decorator in self.decorators)
+
+    @property
+    def is_property_accessor(self) -> bool:
+        """
+        e.g. `@x.setter`, which redefines the qualname but doesn't replace the property
+        """
+        return any(_decorator.endswith(_PROPERTY_ACCESSOR_DECORATOR_SUFFIXES) for _decorator in self.decorators)
+
+
+def _decorator_name(node: ast.expr) -> str:
+    if isinstance(node, ast.Call):
+        node = node.func
+    _parts = []
+    while isinstance(node, ast.Attribute):
+        _parts.append(node.attr)
+        node = node.value
+    if isinstance(node, ast.Name):
+        _parts.append(node.id)
+    else:
+        _parts.append('?')
+    return '.'.join(reversed(_parts))
+
+
+def _walk(body: List[ast.AST],
+          qualname_prefix: str,
+          class_name: Optional[str],
+          out: List[SourceDefinition],
+          ) -> None:
+    """
+    mirrors how python builds `__qualname__`, i.e. functions add `.<locals>` but classes don't
+    also walks into `if` / `try` / `with` / etc blocks, since definitions inside those are still in the same scope
+    """
+    for node in body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            _qualname = f'{qualname_prefix}{node.name}'
+            _lineno = min([node.lineno] + [_decorator.lineno for _decorator in node.decorator_list])
+            if isinstance(node, ast.ClassDef):
+                _kind = KIND_CLASS
+                _class_name = node.name
+            else:
+                _kind = KIND_ASYNC_FUNCTION if isinstance(node, ast.AsyncFunctionDef) else KIND_FUNCTION
+                _class_name = class_name
+            out.append(SourceDefinition(qualname=_qualname,
+                                        name=node.name,
+                                        kind=_kind,
+                                        class_name=_class_name,
+                                        lineno=_lineno,
+                                        end_lineno=getattr(node, 'end_lineno', None),
+                                        decorators=tuple(_decorator_name(_decorator)
+                                                         for _decorator in node.decorator_list),
+                                        ))
+            if isinstance(node, ast.ClassDef):
+                _walk(node.body, f'{_qualname}.', node.name, out)
+            else:
+                _walk(node.body, f'{_qualname}.<locals>.', None, out)
+            continue
+
+        # compound statements (and except / case clauses) that don't create a new scope
+        for _field in ('body', 'orelse', 'finalbody', 'handlers', 'cases'):
+            _children = getattr(node, _field, None)
+            if isinstance(_children, list):
+                _walk(_children, qualname_prefix, class_name, out)
+
+
+class SourceIndex:
+    """
+    every class and function (including methods and nested functions, but not lambdas) defined in one file
+    """
+
+    def __init__(self, path: Path, definitions: Tuple[SourceDefinition, ...]) -> None:
+        self.path = path
+        self.definitions = definitions
+        self._by_qualname: Dict[str, List[SourceDefinition]] = dict()
+        for _definition in definitions:
+            self._by_qualname.setdefault(_definition.qualname, []).append(_definition)
+
+    def __len__(self) -> int:
+        return len(self.definitions)
+
+    def find(self, qualname: str, lineno: Optional[int] = None) -> Optional[SourceDefinition]:
+        """
+        qualnames aren't unique (e.g. conditional definitions, or property setters), so `lineno` disambiguates
+        otherwise the last definition wins, same as it would at runtime
+
+        :param qualname: `__qualname__`
+        :param lineno: `co_firstlineno`, if known
+        :return:
+        """
+        _definitions = self._by_qualname.get(qualname)
+        if not _definitions:
+            return None
+        if lineno is not None:
+            for _definition in _definitions:
+                if _definition.lineno == lineno:
+                    return _definition
+        return _definitions[-1]
+
+    def find_all(self, qualname: str) -> Tuple[SourceDefinition, ...]:
+        return tuple(self._by_qualname.get(qualname, ()))
+
+    def find_class(self, qualname: str) -> Optional[SourceDefinition]:
+        for _definition in reversed(self._by_qualname.get(qualname, ())):
+            if _definition.is_class:
+                return _definition
+        return None
+
+
+@bounded_lru_cache(maxsize=256)
+def _build_source_index(path: str, mtime_ns: int, size: int) -> Optional[SourceIndex]:
+    """
+    mtime and size are only here to invalidate the cache
+    """
+    try:
+        with tokenize.open(path) as f:  # respects PEP 263 encoding declarations
+            _tree = ast.parse(f.read(), filename=path)
+    except (OSError, SyntaxError, UnicodeDecodeError, ValueError):
+        return None
+
+    _definitions: List[SourceDefinition] = []
+    _walk(_tree.body, '', None, _definitions)
+    return SourceIndex(Path(path), tuple(_definitions))
+
+
+def get_source_index(path: Union[str, Path]) -> Optional[SourceIndex]:
+    """
+    :param path: path to a python source file
+    :return: None if the file can't be read or parsed
+    """
+    try:
+        _stat = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    return _build_source_index(str(path), _stat.st_mtime_ns, _stat.st_size)
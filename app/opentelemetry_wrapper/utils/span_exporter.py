@@ -0,0 +1,310 @@
+"""
+span exporter that writes a whole batch of spans with a single `write` call
+
+`ConsoleSpanExporter` with `span.to_json()` builds a dict per span, round-trips the resource through json,
+formats every timestamp from scratch, and writes each span separately
+this serializes each span straight to a compact json line (same keys and values as `to_json`), with
+* the resource encoded once, rather than once per span
+* timestamps formatted per second, with only the fraction formatted per span
+* ids formatted directly from the ints
+
+the resource also gets a `process.pid` attribute (by default), so spans from different workers can be told apart
+
+alternatively, it can write OTLP protobuf (`ExportTraceServiceRequest` messages, each prefixed with its varint length),
+if `opentelemetry-exporter-otlp-proto-common` is installed
+
+the output can be configured by env var, e.g.
+    OTEL_WRAPPER_SPAN_EXPORT_PATH=/var/log/spans.jsonl
+    OTEL_WRAPPER_SPAN_EXPORT_FORMAT=otlp_protobuf
+"""
+import json
+import os
+import sys
+import threading
+import time
+from json.encoder import encode_basestring_ascii
+from pathlib import Path
+from typing import BinaryIO
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import TextIO
+from typing import Tuple
+from typing import Union
+
+from opentelemetry.attributes import BoundedAttributes
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import ReadableSpan
+from opentelemetry.sdk.trace.export import SpanExporter
+from opentelemetry.sdk.trace.export import SpanExportResult
+from opentelemetry.semconv.resource import ResourceAttributes
+from opentelemetry.trace import SpanContext
+from opentelemetry.trace import SpanKind
+
+from opentelemetry_wrapper.utils.file_sink import RotatingFileSink
+from opentelemetry_wrapper.utils.fork_safety import register_after_fork
+from opentelemetry_wrapper.utils.timestamps import split_timestamp
+
+try:
+    from opentelemetry.exporter.otlp.proto.common.trace_encoder import encode_spans
+except ImportError:
+    encode_spans = None
+
+ENV_SPAN_EXPORT_PATH = 'OTEL_WRAPPER_SPAN_EXPORT_PATH'
+ENV_SPAN_EXPORT_FORMAT = 'OTEL_WRAPPER_SPAN_EXPORT_FORMAT'
+
+FORMAT_JSON = 'json'
+FORMAT_OTLP_PROTOBUF = 'otlp_protobuf'
+FORMATS = (FORMAT_JSON, FORMAT_OTLP_PROTOBUF)
+
+# same as `json.dumps` in `to_json`, but without the spaces
+_JSON_ENCODER = json.JSONEncoder(separators=(',', ':'))
+
+_KIND_JSON = {_kind: encode_basestring_ascii(str(_kind)) for _kind in SpanKind}
+
+
+class _ResourceJson:
+    """
+    almost every span shares the provider's resource, so only the last one is cached
+    (by identity, since hashing a `Resource` serializes it to json)
+    """
+
+    def __init__(self, tag_pid: bool = False) -> None:
+        self.tag_pid = tag_pid
+        self._resource: Optional[Resource] = None
+        self._json = 'null'
+
+    def __call__(self, resource: Resource) -> str:
+        if resource is not self._resource:
+            # same as `json.loads(resource.to_json())` would encode to
+            _resource = json.loads(resource.to_json(indent=None))
+            if self.tag_pid:
+                _resource['attributes'][ResourceAttributes.PROCESS_PID] = os.getpid()
+            self._json = _JSON_ENCODER.encode(_resource)
+            self._resource = resource
+        return self._json
+
+
+class _IsoTimestamps:
+    """
+    same output as `opentelemetry.sdk.util.ns_to_iso_str`, but only formats the date and time once per second
+    """
+
+    def __init__(self) -> None:
+        self._cached: Tuple[int, str] = (-1, '')
+
+    def __call__(self, nanoseconds: Optional[int]) -> str:
+        if not nanoseconds:
+            return 'null'
+        _second, _microseconds = split_timestamp(nanoseconds / 1e9)
+        _cached = self._cached
+        if _cached[0] != _second:
+            _cached = self._cached = (_second, time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(_second)))
+        return f'"{_cached[1]}.{_microseconds:06d}Z"'
+
+
+def _context_json(trace_id: int, span_id: int, trace_state: object) -> str:
+    return (f'{{"trace_id":"0x{trace_id:032x}",'
+            f'"span_id":"0x{span_id:016x}",'
+            f'"trace_state":{encode_basestring_ascii(repr(trace_state))}}}')
+
+
+def _span_context_json(context: Optional[SpanContext]) -> str:
+    if context is None:
+        return 'null'
+    return _context_json(context.trace_id, context.span_id, context.trace_state)
+
+
+def _attributes_json(attributes: object) -> str:
+    if attributes is None:
+        return 'null'
+    if not attributes:
+        return '{}'
+    if isinstance(attributes, BoundedAttributes):
+        # noinspection PyProtectedMember
+        attributes = attributes._dict  # skips the per-item lock
+    return _JSON_ENCODER.encode(dict(attributes))
+
+
+def span_to_json(span: ReadableSpan,
+                 iso_timestamps: Optional[_IsoTimestamps] = None,
+                 resource_json: Optional[_ResourceJson] = None,
+                 ) -> str:
+    """
+    same as `json.loads(span.to_json())`, but encoded compactly, and much faster
+    pass in the same `iso_timestamps` and `resource_json` for a whole batch to reuse their caches
+    """
+    if iso_timestamps is None:
+        iso_timestamps = _IsoTimestamps()
+    if resource_json is None:
+        resource_json = _ResourceJson()
+
+    _parent_id = f'"0x{span.parent.span_id:016x}"' if span.parent is not None else 'null'
+    _status = span.status
+    _status_description = f',"description":{encode_basestring_ascii(_status.description)}' \
+        if _status.description else ''
+
+    _events = ','.join(f'{{"name":{encode_basestring_ascii(_event.name)},'
+                       f'"timestamp":{iso_timestamps(_event.timestamp)},'
+                       f'"attributes":{_attributes_json(_event.attributes)}}}'
+                       for _event in span.events)
+    _links = ','.join(f'{{"context":{_span_context_json(_link.context)},'
+                      f'"attributes":{_attributes_json(_link.attributes)}}}'
+                      for _link in span.links)
+
+    return (f'{{"name":{encode_basestring_ascii(span.name)},'
+            f'"context":{_span_context_json(span.context)},'
+            f'"kind":{_KIND_JSON[span.kind]},'
+            f'"parent_id":{_parent_id},'
+            f'"start_time":{iso_timestamps(span.start_time)},'
+            f'"end_time":{iso_timestamps(span.end_time)},'
+            f'"status":{{"status_code":"{_status.status_code.name}"{_status_description}}},'
+            f'"attributes":{_attributes_json(span.attributes)},'
+            f'"events":[{_events}],'
+            f'"links":[{_links}],'
+            f'"resource":{resource_json(span.resource)}}}')
+
+
+class SpanJsonEncoder:
+    """
+    `span_to_json`, keeping the timestamp and resource caches between calls; not thread-safe
+    """
+
+    def __init__(self, tag_pid: bool = False) -> None:
+        """
+        :param tag_pid: add this process's pid to the resource as `process.pid`
+        """
+        self._iso_timestamps = _IsoTimestamps()
+        self._resource_json = _ResourceJson(tag_pid)
+
+    def encode(self, span: ReadableSpan) -> str:
+        return span_to_json(span, self._iso_timestamps, self._resource_json)
+
+
+def _varint(value: int) -> bytes:
+    _out = bytearray()
+    while True:
+        _byte = value & 0x7F
+        value >>= 7
+        if value:
+            _out.append(_byte | 0x80)
+        else:
+            _out.append(_byte)
+            return bytes(_out)
+
+
+class BatchSpanWriter(SpanExporter):
+    """
+    writes each batch of spans with a single `write` call, either as json lines or as OTLP protobuf
+    meant to be used with a `BatchSpanProcessor`
+    """
+
+    def __init__(self,
+                 stream: Optional[Union[TextIO, BinaryIO]] = None,
+                 path: Optional[Path] = None,
+                 *,
+                 output_format: str = FORMAT_JSON,
+                 tag_pid: bool = True,
+                 ) -> None:
+        """
+        :param stream: where to write, defaults to stdout (a binary stream for protobuf, or `sys.stdout.buffer`)
+        :param path: file to append to instead of a stream (json is written via `RotatingFileSink`)
+        :param output_format: `FORMAT_JSON` or `FORMAT_OTLP_PROTOBUF`
+        :param tag_pid: add this process's pid to the resource as `process.pid`
+        """
+        if path is not None and stream is not None:
+            raise ValueError('cannot set both path and stream')
+        if output_format not in FORMATS:
+            raise ValueError(f'output_format must be one of {FORMATS}, got {output_format!r}')
+        if output_format == FORMAT_OTLP_PROTOBUF and encode_spans is None:
+            raise ValueError('protobuf output requires the `opentelemetry-exporter-otlp-proto-common` package')
+
+        self.output_format = output_format
+        self.tag_pid = tag_pid
+        self._owns_stream = path is not None
+        self.stream: Union[TextIO, BinaryIO]
+        if output_format == FORMAT_JSON:
+            if path is not None:
+                # closed by `shutdown`, which the tracer provider calls at exit (after registering its own atexit hook
+                # first, so the sink's hook would otherwise run first and the last batch would be lost)
+                self.stream = RotatingFileSink(path, close_at_exit=False)
+            else:
+                self.stream = stream if stream is not None else sys.stdout
+        else:
+            if path is not None:
+                self.stream = open(path, 'ab')
+            else:
+                self.stream = stream if stream is not None else sys.stdout.buffer
+
+        self._json_encoder = SpanJsonEncoder(tag_pid)
+        self._lock = threading.Lock()
+        self._shutdown = False
+        register_after_fork(self)
+
+    def _after_fork_in_child(self) -> None:
+        self._lock = threading.Lock()
+        self._json_encoder = SpanJsonEncoder(self.tag_pid)  # new pid
+
+    def _serialize_json(self, spans: Sequence[ReadableSpan]) -> str:
+        _lines: List[str] = [self._json_encoder.encode(_span) for _span in spans]
+        _lines.append('')  # trailing newline
+        return '\n'.join(_lines)
+
+    def _serialize_protobuf(self, spans: Sequence[ReadableSpan]) -> bytes:
+        _request = encode_spans(spans)
+        if self.tag_pid:
+            _pid = os.getpid()
+            for _resource_spans in _request.resource_spans:
+                _attributes = _resource_spans.resource.attributes
+                for _attribute in _attributes:
+                    if _attribute.key == ResourceAttributes.PROCESS_PID:
+                        _attribute.value.int_value = _pid
+                        break
+                else:
+                    _attributes.add(key=ResourceAttributes.PROCESS_PID).value.int_value = _pid
+        _message = _request.SerializeToString()
+        return _varint(len(_message)) + _message
+
+    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        if self._shutdown:
+            return SpanExportResult.FAILURE
+        if not spans:
+            return SpanExportResult.SUCCESS
+
+        # noinspection PyBroadException
+        try:
+            with self._lock:  # the json caches aren't thread-safe
+                if self.output_format == FORMAT_JSON:
+                    _data: Union[str, bytes] = self._serialize_json(spans)
+                else:
+                    _data = self._serialize_protobuf(spans)
+                self.stream.write(_data)
+                self.stream.flush()
+        except Exception:
+            return SpanExportResult.FAILURE
+        return SpanExportResult.SUCCESS
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        with self._lock:
+            if isinstance(self.stream, RotatingFileSink):
+                self.stream.flush(force=True)
+            else:
+                self.stream.flush()
+        return True
+
+    def shutdown(self) -> None:
+        if self._shutdown:
+            return
+        self.force_flush()
+        self._shutdown = True
+        if self._owns_stream:
+            self.stream.close()
+
+
+def get_span_exporter_from_env() -> BatchSpanWriter:
+    """
+    writes json lines to stdout unless configured otherwise by `ENV_SPAN_EXPORT_PATH` and `ENV_SPAN_EXPORT_FORMAT`
+    """
+    _path = os.getenv(ENV_SPAN_EXPORT_PATH, '').strip()
+    _format = os.getenv(ENV_SPAN_EXPORT_FORMAT, '').strip().lower() or FORMAT_JSON
+    return BatchSpanWriter(path=Path(_path) if _path else None, output_format=_format)
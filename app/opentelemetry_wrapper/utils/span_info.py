@@ -0,0 +1,163 @@
+"""
+lazily resolved span names and `code.*` span attributes for instrumented functions and classes
+
+introspecting code with `inspect` is slow (it reads and tokenizes source files, and may even import modules)
+so it's deferred until the first span is actually recorded, and plain functions skip it entirely
+by reading everything from the raw `__code__` object, which is memoized per code object
+"""
+import inspect
+import sys
+from pathlib import Path
+from types import FunctionType
+from types import MethodType
+from typing import Any
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+from opentelemetry.semconv.trace import SpanAttributes
+
+from opentelemetry_wrapper.utils.caches import CacheInfo
+from opentelemetry_wrapper.utils.caches import WeakCache
+from opentelemetry_wrapper.utils.introspect import CodeInfo
+
+# code object -> (name, span attributes)
+# the attributes dict is shared and must never be modified
+_CACHE_CODE_SPAN_INFO = WeakCache()
+
+
+def cache_info() -> CacheInfo:
+    return _CACHE_CODE_SPAN_INFO.cache_info()
+
+
+def cheap_name(obj: Any) -> Optional[str]:
+    """
+    get the same name that `CodeInfo(obj).name` would return, but without introspecting any source code
+    only works for plain functions, methods, and classes
+
+    :param obj: function, method, or class
+    :return: None if it can't be done cheaply
+    """
+    if isinstance(obj, MethodType):
+        obj = obj.__func__
+    if not isinstance(obj, (FunctionType, type)) or hasattr(obj, '__wrapped__'):
+        return None
+
+    _module_name = getattr(obj, '__module__', None)
+    if not isinstance(_module_name, str) or _module_name not in sys.modules or _module_name == 'asgiref.sync':
+        return None
+
+    # for some reason `CodeInfo.class_name` uses the class name instead of the class qualname
+    if isinstance(obj, type):
+        return f'<{_module_name}>.{obj.__name__}'
+    return f'<{_module_name}>.{obj.__qualname__}'
+
+
+def _describe_function(func: FunctionType) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """
+    get the same name and attributes that `CodeInfo` would, but only reading from the function and its code object
+    """
+    _code = func.__code__
+    _cached = _CACHE_CODE_SPAN_INFO.get(_code)
+    if _cached is not None:
+        return _cached
+
+    _name = cheap_name(func)
+    if _name is None:
+        return None
+    _module = sys.modules[func.__module__]
+
+    # strip out the class name from the qualname if the class can be found in the module
+    _function_name = func.__qualname__
+    _cls_qualname = _function_name.split('.<locals>')[0]
+    if '.' in _cls_qualname:
+        _cls = _module
+        for _cls_name in _cls_qualname.rsplit('.', 1)[0].split('.'):
+            _cls = getattr(_cls, _cls_name, None)
+            if _cls is None:
+                break
+        if inspect.isclass(_cls):
+            if _function_name.startswith(f'{_cls.__name__}.'):
+                _function_name = _function_name[len(_cls.__name__) + 1:]
+            elif f'.{_cls.__name__}.' in _function_name:
+                _function_name = _function_name.split(f'.{_cls.__name__}.', 1)[1]
+
+    _attributes = {
+        SpanAttributes.CODE_FUNCTION:  _function_name,
+        SpanAttributes.CODE_NAMESPACE: _module.__name__,
+        SpanAttributes.CODE_FILEPATH:  str(Path(_code.co_filename)),
+        SpanAttributes.CODE_LINENO:    _code.co_firstlineno,
+    }
+    _CACHE_CODE_SPAN_INFO[_code] = (_name, _attributes)
+    return _name, _attributes
+
+
+def _describe_with_code_info(obj: Any) -> Tuple[str, Dict[str, Any]]:
+    """
+    the slow way, for builtins, wrapped functions, classes, etc
+    """
+    code_info = CodeInfo(obj)
+
+    # build span attributes for this class / function / method / builtin / etc
+    span_attributes = dict()
+    if code_info.function_name:
+        span_attributes[SpanAttributes.CODE_FUNCTION] = code_info.function_name
+    if code_info.module_name:
+        span_attributes[SpanAttributes.CODE_NAMESPACE] = code_info.module_name
+    if code_info.path:
+        span_attributes[SpanAttributes.CODE_FILEPATH] = str(code_info.path)
+    if code_info.lineno:
+        span_attributes[SpanAttributes.CODE_LINENO] = code_info.lineno
+
+    return code_info.name, span_attributes
+
+
+class SpanInfo:
+    """
+    span name and attributes for an instrumented class / function / method / builtin / etc
+    nothing is introspected until `get()` is first called, i.e. when the first span is recorded
+    """
+    __slots__ = ('_obj', '_name', '_prefix', '_span_name', '_attributes')
+
+    def __init__(self, obj: Any, name: Optional[str] = None, prefix: str = '') -> None:
+        """
+        :param obj: the function or class being instrumented
+        :param name: if not set, makes an intelligent guess
+        :param prefix: prepended to the span name, e.g. 'async '
+        """
+        self._obj = obj
+        self._name = name
+        self._prefix = prefix
+        self._span_name: Optional[str] = None
+        self._attributes: Optional[Dict[str, Any]] = None
+
+    @property
+    def name(self) -> str:
+        """
+        name without the prefix, which is cheap to get for plain functions and classes
+        """
+        if self._name is None:
+            self._name = cheap_name(self._obj)
+            if self._name is None:
+                self._resolve()
+        return self._name
+
+    def _resolve(self) -> None:
+        _obj = self._obj.__func__ if isinstance(self._obj, MethodType) else self._obj
+        _described = _describe_function(_obj) if isinstance(_obj, FunctionType) else None
+        if _described is None:
+            _described = _describe_with_code_info(self._obj)
+
+        if self._name is None:
+            self._name = _described[0]
+        self._attributes = _described[1]
+
+    def get(self) -> Tuple[str, Dict[str, Any]]:
+        """
+        :return: span name (including prefix), span attributes (which must not be modified)
+        """
+        if self._span_name is None:
+            if self._attributes is None:
+                self._resolve()
+            self._span_name = f'{self._prefix}{self._name}'
+        return self._span_name, self._attributes
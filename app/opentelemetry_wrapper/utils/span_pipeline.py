@@ -0,0 +1,374 @@
+"""
+a `BatchSpanProcessor` that reports on itself, so its queue and batch sizes can be tuned for real traffic
+
+tuning (passed to `init_tracer` or `get_tracer`, which can be called again later to re-tune;
+otherwise the SDK reads its standard env vars, and then falls back to its defaults)
+    max_queue_size          OTEL_BSP_MAX_QUEUE_SIZE         spans waiting to be exported, beyond this they're dropped
+    max_export_batch_size   OTEL_BSP_MAX_EXPORT_BATCH_SIZE  spans per export call
+    schedule_delay_millis   OTEL_BSP_SCHEDULE_DELAY         max wait between exports
+    export_timeout_millis   OTEL_BSP_EXPORT_TIMEOUT         max time per export call
+
+stats (see `SpanPipelineStats.snapshot`)
+    queue_depth / queue_capacity                    spans currently waiting
+    spans_received / spans_exported / spans_failed  counted as spans enter the queue and as exports return
+    spans_dropped                                   queue was full, so the oldest span was discarded (approximate)
+    export_latency_ms_*                             per export call, with a log2 histogram in microseconds
+    batch_size_*                                    spans per export call, with a log2 histogram
+
+they can be read with `get_span_pipeline_stats()`, are logged every `stats_interval` seconds
+(or `OTEL_WRAPPER_SPAN_PIPELINE_STATS_INTERVAL`) to the `opentelemetry_wrapper.span_pipeline` logger,
+and are registered as observable instruments, which are only collected if a `MeterProvider` is set up
+"""
+import logging
+import os
+import threading
+import time
+from typing import Deque
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Union
+
+from opentelemetry import metrics
+from opentelemetry.context import Context
+from opentelemetry.metrics import CallbackOptions
+from opentelemetry.metrics import Observation
+from opentelemetry.sdk.trace import ReadableSpan
+from opentelemetry.sdk.trace import Span
+from opentelemetry.sdk.trace import SpanProcessor
+from opentelemetry.sdk.trace.export import BatchSpanProcessor
+from opentelemetry.sdk.trace.export import SpanExporter
+from opentelemetry.sdk.trace.export import SpanExportResult
+
+from opentelemetry_wrapper.utils.fork_safety import register_after_fork
+
+ENV_STATS_INTERVAL = 'OTEL_WRAPPER_SPAN_PIPELINE_STATS_INTERVAL'
+
+# the `BatchSpanProcessor` kwargs that can be tuned
+_BATCH_SETTINGS = ('max_queue_size', 'schedule_delay_millis', 'max_export_batch_size', 'export_timeout_millis')
+
+_HISTOGRAM_BUCKETS = 24  # the last bucket is everything over ~4 seconds (or ~4 million spans)
+
+_LOGGER = logging.getLogger('opentelemetry_wrapper.span_pipeline')
+
+
+def _trimmed(histogram: List[int]) -> List[int]:
+    _histogram = list(histogram)
+    while _histogram and not _histogram[-1]:
+        _histogram.pop()
+    return _histogram
+
+
+class SpanPipelineStats:
+    """
+    counters are updated under a lock, and can be read any time
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._queue: Optional[Deque] = None  # set by the processor, if it can find its queue
+        self._reset()
+
+    def _reset(self) -> None:
+        self.spans_received = 0
+        self.spans_dropped = 0
+        self.spans_exported = 0
+        self.spans_failed = 0
+        self.exports = 0
+        self.export_latency_ns_total = 0
+        self.export_latency_ns_max = 0
+        self.export_latency_histogram_log2_us = [0] * _HISTOGRAM_BUCKETS
+        self.batch_size_max = 0
+        self.batch_size_histogram_log2 = [0] * _HISTOGRAM_BUCKETS
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue) if self._queue is not None else 0
+
+    @property
+    def queue_capacity(self) -> Optional[int]:
+        return self._queue.maxlen if self._queue is not None else None
+
+    def on_received(self) -> None:
+        with self._lock:
+            self.spans_received += 1
+            if self._queue is not None and len(self._queue) >= self._queue.maxlen:
+                self.spans_dropped += 1
+
+    def on_exported(self, batch_size: int, latency_ns: int, success: bool) -> None:
+        with self._lock:
+            self.exports += 1
+            if success:
+                self.spans_exported += batch_size
+            else:
+                self.spans_failed += batch_size
+            self.export_latency_ns_total += latency_ns
+            self.export_latency_ns_max = max(self.export_latency_ns_max, latency_ns)
+            self.export_latency_histogram_log2_us[min(_HISTOGRAM_BUCKETS - 1, (latency_ns // 1000).bit_length())] += 1
+            self.batch_size_max = max(self.batch_size_max, batch_size)
+            self.batch_size_histogram_log2[min(_HISTOGRAM_BUCKETS - 1, batch_size.bit_length())] += 1
+
+    def snapshot(self) -> Dict[str, Union[int, float, None, List[int]]]:
+        with self._lock:
+            _exports = self.exports
+            _spans = self.spans_exported + self.spans_failed
+            return {
+                'queue_depth':                       self.queue_depth,
+                'queue_capacity':                    self.queue_capacity,
+                'spans_received':                    self.spans_received,
+                'spans_dropped':                     self.spans_dropped,
+                'spans_exported':                    self.spans_exported,
+                'spans_failed':                      self.spans_failed,
+                'exports':                           _exports,
+                'export_latency_ms_mean':            self.export_latency_ns_total / _exports / 1e6 if _exports else 0.0,
+                'export_latency_ms_max':             self.export_latency_ns_max / 1e6,
+                'export_latency_histogram_log2_us':  _trimmed(self.export_latency_histogram_log2_us),
+                'batch_size_mean':                   _spans / _exports if _exports else 0.0,
+                'batch_size_max':                    self.batch_size_max,
+                'batch_size_histogram_log2':         _trimmed(self.batch_size_histogram_log2),
+            }
+
+
+class _TimedSpanExporter(SpanExporter):
+    """
+    wraps the real exporter to time each export call
+    """
+
+    def __init__(self, exporter: SpanExporter, stats: SpanPipelineStats) -> None:
+        self.exporter = exporter
+        self.stats = stats
+
+    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        _start = time.perf_counter_ns()
+        _result = SpanExportResult.FAILURE
+        try:
+            _result = self.exporter.export(spans)
+            return _result
+        finally:
+            self.stats.on_exported(len(spans), time.perf_counter_ns() - _start, _result == SpanExportResult.SUCCESS)
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        return self.exporter.force_flush(timeout_millis)
+
+    def shutdown(self) -> None:
+        pass  # the exporter outlives the batch processor, see `SpanPipeline.configure`
+
+
+def _find_queue(processor: BatchSpanProcessor) -> Optional[Deque]:
+    """
+    the queue is internal to the SDK and has moved between versions
+    """
+    # noinspection PyProtectedMember
+    for _owner in (getattr(processor, '_batch_processor', None), processor):
+        for _name in ('_queue', 'queue'):
+            _queue = getattr(_owner, _name, None)
+            if _queue is not None and hasattr(_queue, 'maxlen') and _queue.maxlen is not None:
+                return _queue
+    return None
+
+
+class _InstrumentedBatchSpanProcessor(BatchSpanProcessor):
+    def __init__(self,
+                 span_exporter: SpanExporter,
+                 stats: SpanPipelineStats,
+                 max_queue_size: Optional[int] = None,
+                 schedule_delay_millis: Optional[float] = None,
+                 max_export_batch_size: Optional[int] = None,
+                 export_timeout_millis: Optional[float] = None,
+                 ) -> None:
+        self.stats = stats
+        super().__init__(_TimedSpanExporter(span_exporter, stats),
+                         max_queue_size=max_queue_size,
+                         schedule_delay_millis=schedule_delay_millis,
+                         max_export_batch_size=max_export_batch_size,
+                         export_timeout_millis=export_timeout_millis)
+        self.queue_for_stats = _find_queue(self)
+
+    def on_end(self, span: ReadableSpan) -> None:
+        # same check as the SDK, so unsampled spans aren't counted
+        if span.context and span.context.trace_flags.sampled:
+            self.stats.on_received()
+        super().on_end(span)
+
+
+class _StatsReporter:
+    """
+    logs a snapshot of the stats every `interval` seconds, from a daemon thread
+    """
+
+    def __init__(self, stats: SpanPipelineStats, interval: float) -> None:
+        self.stats = stats
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name=self.__class__.__name__, daemon=True)
+        self._thread.start()
+
+    def _loop(self) -> None:
+        while not self._stop.wait(self.interval):
+            _snapshot = self.stats.snapshot()
+            _LOGGER.info('span pipeline: queue %s/%s, %d received, %d exported, %d dropped, %d failed',
+                         _snapshot['queue_depth'],
+                         _snapshot['queue_capacity'],
+                         _snapshot['spans_received'],
+                         _snapshot['spans_exported'],
+                         _snapshot['spans_dropped'],
+                         _snapshot['spans_failed'],
+                         extra={'span_pipeline': _snapshot})
+
+    def stop(self) -> None:
+        self._stop.set()
+
+
+class SpanPipeline(SpanProcessor):
+    """
+    the tracer provider's last span processor, which can be re-tuned after it's been added
+    (the wrapper sets up tracing on import, before anyone has had a chance to pass in any settings)
+    """
+
+    def __init__(self, span_exporter: SpanExporter) -> None:
+        self.exporter = span_exporter
+        self.stats = SpanPipelineStats()
+        # batch processor kwarg -> value, where None means the SDK's default (or its `OTEL_BSP_*` env var)
+        self._settings: Dict[str, Optional[float]] = dict.fromkeys(_BATCH_SETTINGS)
+        self._processor: Optional[_InstrumentedBatchSpanProcessor] = None
+        self._reporter: Optional[_StatsReporter] = None
+        self._lock = threading.Lock()
+        self.reset()
+        register_after_fork(self)
+
+    def configure(self,
+                  *,
+                  max_queue_size: Optional[int] = None,
+                  schedule_delay_millis: Optional[float] = None,
+                  max_export_batch_size: Optional[int] = None,
+                  export_timeout_millis: Optional[float] = None,
+                  stats_interval: Optional[float] = None,
+                  ) -> None:
+        """
+        unset settings keep their current values, so e.g. a module calling `get_tracer(stats_interval=60)`
+        doesn't undo another module's `init_tracer(max_queue_size=8192)`; use `reset` to go back to the defaults
+        the batch processor is only replaced (after flushing it) if the effective settings changed
+
+        :param stats_interval: seconds between stats log records
+        """
+        if stats_interval is not None and stats_interval <= 0:
+            raise ValueError(stats_interval)
+
+        _updates = {'max_queue_size':        max_queue_size,
+                    'schedule_delay_millis': schedule_delay_millis,
+                    'max_export_batch_size': max_export_batch_size,
+                    'export_timeout_millis': export_timeout_millis}
+        with self._lock:
+            _settings = dict(self._settings)
+            _settings.update((_name, _value) for _name, _value in _updates.items() if _value is not None)
+            if stats_interval is None and self._reporter is not None:
+                stats_interval = self._reporter.interval
+            self._apply(_settings, stats_interval)
+
+    def reset(self) -> None:
+        """
+        go back to the defaults: the SDK's `OTEL_BSP_*` env vars, and `ENV_STATS_INTERVAL` (or no stats logging)
+        """
+        _interval = os.getenv(ENV_STATS_INTERVAL, '').strip()
+        _stats_interval = float(_interval) if _interval else None
+        if _stats_interval is not None and _stats_interval <= 0:
+            raise ValueError(_stats_interval)
+        with self._lock:
+            self._apply(dict.fromkeys(_BATCH_SETTINGS), _stats_interval)
+
+    def _apply(self, settings: Dict[str, Optional[float]], stats_interval: Optional[float]) -> None:
+        """
+        must be called with the lock held
+        """
+        if self._processor is None or settings != self._settings:
+            _old_processor = self._processor
+            self._processor = _InstrumentedBatchSpanProcessor(self.exporter, self.stats, **settings)
+            self.stats._queue = self._processor.queue_for_stats
+            self._settings = settings
+            if _old_processor is not None:
+                _old_processor.shutdown()  # exports whatever it still has queued
+
+        if (self._reporter.interval if self._reporter is not None else None) != stats_interval:
+            if self._reporter is not None:
+                self._reporter.stop()
+            self._reporter = _StatsReporter(self.stats, stats_interval) if stats_interval is not None else None
+
+    def _after_fork_in_child(self) -> None:
+        """
+        the SDK restarts the batch processor's own thread; this restarts the stats
+        """
+        self._lock = threading.Lock()
+        self.stats._lock = threading.Lock()
+        self.stats._reset()
+        if self._reporter is not None:
+            self._reporter = _StatsReporter(self.stats, self._reporter.interval)
+
+    def on_start(self, span: Span, parent_context: Optional[Context] = None) -> None:
+        pass
+
+    def on_end(self, span: ReadableSpan) -> None:
+        self._processor.on_end(span)
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        return self._processor.force_flush(timeout_millis)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._reporter is not None:
+                self._reporter.stop()
+            self._processor.shutdown()
+        self.exporter.shutdown()
+
+
+def _register_instruments(stats: SpanPipelineStats) -> None:
+    _meter = metrics.get_meter(__name__)
+
+    def _observe(attribute: str):
+        def _callback(_options: CallbackOptions) -> Iterable[Observation]:
+            return [Observation(getattr(stats, attribute))]
+
+        return _callback
+
+    _meter.create_observable_gauge('otel_wrapper.span_pipeline.queue_depth',
+                                   callbacks=[_observe('queue_depth')],
+                                   unit='{span}',
+                                   description='spans waiting to be exported')
+    for _attribute, _description in (('spans_received', 'spans added to the queue'),
+                                     ('spans_dropped', 'spans dropped because the queue was full'),
+                                     ('spans_exported', 'spans exported successfully'),
+                                     ('spans_failed', 'spans in export calls that failed'),
+                                     ('exports', 'export calls')):
+        _meter.create_observable_counter(f'otel_wrapper.span_pipeline.{_attribute}',
+                                         callbacks=[_observe(_attribute)],
+                                         description=_description)
+
+
+_PIPELINE: Optional[SpanPipeline] = None
+
+
+def create_span_pipeline(span_exporter: SpanExporter) -> SpanPipeline:
+    """
+    only meant to be called once, by `init_tracer`; this is the pipeline `get_span_pipeline` returns
+    """
+    global _PIPELINE
+    _PIPELINE = SpanPipeline(span_exporter)
+    _register_instruments(_PIPELINE.stats)
+    return _PIPELINE
+
+
+def get_span_pipeline() -> Optional[SpanPipeline]:
+    """
+    :return: None if the tracer provider wasn't set up by this wrapper
+    """
+    return _PIPELINE
+
+
+def get_span_pipeline_stats() -> Optional[Dict[str, Union[int, float, None, List[int]]]]:
+    """
+    :return: a snapshot of the stats, or None if the tracer provider wasn't set up by this wrapper
+    """
+    if _PIPELINE is None:
+        return None
+    return _PIPELINE.stats.snapshot()
@@ -0,0 +1,456 @@
+"""
+keep recent spans in this process, to look at traces in dev / staging without running Jaeger
+
+a `SpanStoreProcessor` (added by `init_tracer`) queues finished spans, and a background thread adds them to a store
+* `MemorySpanStore` is a ring buffer of the last `max_spans` spans
+* `SqliteSpanStore` keeps the last `max_spans` spans in a SQLite file on local disk, so they survive restarts
+both are indexed by trace id, service, span name, and duration (plus errors by time), so queries never scan everything
+
+does nothing until enabled by `enable_span_store`, or by env var, e.g.
+    OTEL_WRAPPER_SPAN_STORE_MAX_SPANS=100000
+    OTEL_WRAPPER_SPAN_STORE_SQLITE_PATH=/tmp/spans.sqlite3
+
+spans are stored as the same json as the exported spans (see `span_exporter.SpanJsonEncoder`)
+use `instrument_fastapi_app(app, span_store_prefix='/debug/spans')` to query them over http
+"""
+import bisect
+import os
+import sqlite3
+import threading
+from collections import deque
+from pathlib import Path
+from typing import Deque
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from typing import Union
+
+from opentelemetry.context import Context
+from opentelemetry.sdk.resources import SERVICE_NAME
+from opentelemetry.sdk.trace import ReadableSpan
+from opentelemetry.sdk.trace import Span
+from opentelemetry.sdk.trace import SpanProcessor
+from opentelemetry.trace import StatusCode
+
+from opentelemetry_wrapper.utils.fork_safety import register_after_fork
+from opentelemetry_wrapper.utils.span_exporter import SpanJsonEncoder
+
+ENV_SPAN_STORE_MAX_SPANS = 'OTEL_WRAPPER_SPAN_STORE_MAX_SPANS'
+ENV_SPAN_STORE_SQLITE_PATH = 'OTEL_WRAPPER_SPAN_STORE_SQLITE_PATH'
+
+# (trace id, span count, error count, last end time in ns)
+ErrorTrace = Tuple[int, int, int, int]
+
+
+class StoredSpan:
+    __slots__ = ('seq', 'trace_id', 'span_id', 'name', 'service', 'start_ns', 'end_ns', 'duration_ns', 'is_error',
+                 'json')
+
+    def __init__(self, seq: int, span: ReadableSpan, span_json: str) -> None:
+        self.seq = seq
+        self.trace_id: int = span.context.trace_id
+        self.span_id: int = span.context.span_id
+        self.name: str = span.name
+        self.service: str = str(span.resource.attributes.get(SERVICE_NAME, ''))
+        self.start_ns: int = span.start_time or 0
+        self.end_ns: int = span.end_time or self.start_ns
+        self.duration_ns: int = self.end_ns - self.start_ns
+        self.is_error: bool = span.status.status_code is StatusCode.ERROR
+        self.json = span_json
+
+
+class MemorySpanStore:
+    """
+    thread-safe; adding a span and evicting the oldest one are both O(log n) (plus list shifting in the indexes)
+    """
+
+    def __init__(self, max_spans: int = 10000) -> None:
+        if max_spans < 1:
+            raise ValueError(max_spans)
+        self.max_spans = max_spans
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._ring: Deque[StoredSpan] = deque()
+        self._by_trace: Dict[int, List[StoredSpan]] = dict()
+        self._by_service: Dict[str, Deque[StoredSpan]] = dict()  # oldest first
+        self._errors: Deque[StoredSpan] = deque()  # oldest first
+        # sorted by (duration, seq), so the slowest are at the end
+        self._by_duration: List[Tuple[int, int, StoredSpan]] = []
+        self._by_name_duration: Dict[str, List[Tuple[int, int, StoredSpan]]] = dict()
+        self._by_service_duration: Dict[str, List[Tuple[int, int, StoredSpan]]] = dict()
+        self._json_encoder = SpanJsonEncoder()
+
+    def _after_fork_in_child(self) -> None:
+        """
+        called by `SpanStoreProcessor`, before its writer thread restarts
+        if the lock was held at the fork, the indexes may be half-updated, so the child starts empty
+        """
+        if self._lock.locked():
+            self._ring = deque()
+            self._by_trace = dict()
+            self._by_service = dict()
+            self._errors = deque()
+            self._by_duration = []
+            self._by_name_duration = dict()
+            self._by_service_duration = dict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._ring)
+
+    def add(self, spans: Sequence[ReadableSpan]) -> None:
+        with self._lock:
+            for _span in spans:
+                self._seq += 1
+                _stored = StoredSpan(self._seq, _span, self._json_encoder.encode(_span))
+                self._ring.append(_stored)
+                self._by_trace.setdefault(_stored.trace_id, []).append(_stored)
+                self._by_service.setdefault(_stored.service, deque()).append(_stored)
+                if _stored.is_error:
+                    self._errors.append(_stored)
+                _key = (_stored.duration_ns, _stored.seq, _stored)
+                bisect.insort(self._by_duration, _key)
+                bisect.insort(self._by_name_duration.setdefault(_stored.name, []), _key)
+                bisect.insort(self._by_service_duration.setdefault(_stored.service, []), _key)
+
+                while len(self._ring) > self.max_spans:
+                    self._evict(self._ring.popleft())
+
+    @staticmethod
+    def _remove_sorted(index: List[Tuple[int, int, StoredSpan]], stored: StoredSpan) -> None:
+        _position = bisect.bisect_left(index, (stored.duration_ns, stored.seq))
+        if _position < len(index) and index[_position][2] is stored:
+            del index[_position]
+
+    def _evict(self, stored: StoredSpan) -> None:
+        """
+        must be called with the lock held; the evicted span is always the oldest, so it's first in the deques
+        """
+        _trace = self._by_trace[stored.trace_id]
+        _trace.remove(stored)
+        if not _trace:
+            del self._by_trace[stored.trace_id]
+
+        _service = self._by_service[stored.service]
+        _service.popleft()
+        if not _service:
+            del self._by_service[stored.service]
+
+        if stored.is_error:
+            self._errors.popleft()
+
+        self._remove_sorted(self._by_duration, stored)
+        _by_name = self._by_name_duration[stored.name]
+        self._remove_sorted(_by_name, stored)
+        if not _by_name:
+            del self._by_name_duration[stored.name]
+        _by_service = self._by_service_duration[stored.service]
+        self._remove_sorted(_by_service, stored)
+        if not _by_service:
+            del self._by_service_duration[stored.service]
+
+    def trace(self, trace_id: int) -> List[str]:
+        """
+        :return: json of each span in the trace, by start time
+        """
+        with self._lock:
+            _spans = list(self._by_trace.get(trace_id, ()))
+        return [_stored.json for _stored in sorted(_spans, key=lambda _stored: _stored.start_ns)]
+
+    def slowest(self, name: Optional[str] = None, service: Optional[str] = None, limit: int = 20) -> List[str]:
+        """
+        :return: json of the slowest spans (optionally with this name and / or service), slowest first
+        """
+        _out: List[str] = []
+        with self._lock:
+            if name is not None and service is not None:
+                # walk whichever index is smaller, filtering by the other
+                _by_name = self._by_name_duration.get(name, [])
+                _by_service = self._by_service_duration.get(service, [])
+                _index = _by_name if len(_by_name) <= len(_by_service) else _by_service
+            elif name is not None:
+                _index = self._by_name_duration.get(name, [])
+            elif service is not None:
+                _index = self._by_service_duration.get(service, [])
+            else:
+                _index = self._by_duration
+            for _position in range(len(_index) - 1, -1, -1):
+                if len(_out) >= limit:
+                    break
+                _stored = _index[_position][2]
+                if (name is None or _stored.name == name) and (service is None or _stored.service == service):
+                    _out.append(_stored.json)
+        return _out
+
+    def recent(self, service: Optional[str] = None, limit: int = 20) -> List[str]:
+        """
+        :return: json of the most recently ended spans (optionally from this service), newest first
+        """
+        with self._lock:
+            _index = self._by_service.get(service, ()) if service is not None else self._ring
+            return [_index[-_i].json for _i in range(1, min(limit, len(_index)) + 1)]
+
+    def error_traces(self, since_ns: int, limit: int = 100) -> List[ErrorTrace]:
+        """
+        :return: traces with an error span that ended at or after `since_ns`, most recent first
+        """
+        _errors: Dict[int, Tuple[int, int]] = dict()  # trace id -> (error count, last error end time)
+        with self._lock:
+            for _position in range(len(self._errors) - 1, -1, -1):
+                _stored = self._errors[_position]
+                if _stored.end_ns < since_ns:
+                    break
+                _count, _last = _errors.get(_stored.trace_id, (0, 0))
+                _errors[_stored.trace_id] = (_count + 1, max(_last, _stored.end_ns))
+            _out = [(_trace_id, len(self._by_trace.get(_trace_id, ())), _count, _last)
+                    for _trace_id, (_count, _last) in _errors.items()]
+        _out.sort(key=lambda _row: _row[3], reverse=True)
+        return _out[:limit]
+
+    def services(self) -> Dict[str, int]:
+        """
+        :return: service name -> number of stored spans
+        """
+        with self._lock:
+            return {_service: len(_spans) for _service, _spans in self._by_service.items()}
+
+    def close(self) -> None:
+        pass
+
+
+class SqliteSpanStore:
+    """
+    same queries as `MemorySpanStore`, backed by a SQLite file (one connection, shared under a lock)
+    the oldest spans are deleted after each insert, once there are more than `max_spans`
+    """
+
+    def __init__(self, path: Union[str, Path], max_spans: int = 100000) -> None:
+        if max_spans < 1:
+            raise ValueError(max_spans)
+        self.path = Path(path).absolute()
+        self.max_spans = max_spans
+        self._lock = threading.Lock()
+        self._json_encoder = SpanJsonEncoder()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=OFF')  # it's only debugging data
+        # trace ids don't fit in a sqlite INTEGER, so they're stored as hex
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS spans (
+                seq         INTEGER PRIMARY KEY AUTOINCREMENT,
+                trace_id    TEXT NOT NULL,
+                name        TEXT NOT NULL,
+                service     TEXT NOT NULL,
+                start_ns    INTEGER NOT NULL,
+                end_ns      INTEGER NOT NULL,
+                duration_ns INTEGER NOT NULL,
+                is_error    INTEGER NOT NULL,
+                json        TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS spans_trace_id ON spans (trace_id, start_ns);
+            CREATE INDEX IF NOT EXISTS spans_service ON spans (service, seq);
+            CREATE INDEX IF NOT EXISTS spans_service_duration ON spans (service, duration_ns);
+            CREATE INDEX IF NOT EXISTS spans_duration ON spans (duration_ns);
+            CREATE INDEX IF NOT EXISTS spans_name_duration ON spans (name, duration_ns);
+            CREATE INDEX IF NOT EXISTS spans_errors ON spans (end_ns) WHERE is_error;
+        ''')
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM spans').fetchone()[0]
+
+    def add(self, spans: Sequence[ReadableSpan]) -> None:
+        with self._lock:
+            _rows = []
+            for _span in spans:
+                _stored = StoredSpan(0, _span, self._json_encoder.encode(_span))
+                _rows.append((f'{_stored.trace_id:032x}', _stored.name, _stored.service, _stored.start_ns,
+                              _stored.end_ns, _stored.duration_ns, int(_stored.is_error), _stored.json))
+            with self._connection:  # one transaction
+                self._connection.execute('BEGIN')
+                _cursor = self._connection.executemany(
+                    'INSERT INTO spans (trace_id, name, service, start_ns, end_ns, duration_ns, is_error, json) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', _rows)
+                _last_seq = self._connection.execute('SELECT MAX(seq) FROM spans').fetchone()[0] or 0
+                self._connection.execute('DELETE FROM spans WHERE seq <= ?', (_last_seq - self.max_spans,))
+                _cursor.close()
+
+    def trace(self, trace_id: int) -> List[str]:
+        with self._lock:
+            return [_row[0] for _row in self._connection.execute(
+                'SELECT json FROM spans WHERE trace_id = ? ORDER BY start_ns', (f'{trace_id:032x}',))]
+
+    def slowest(self, name: Optional[str] = None, service: Optional[str] = None, limit: int = 20) -> List[str]:
+        _where = []
+        _params: List[Union[str, int]] = []
+        if name is not None:
+            _where.append('name = ?')
+            _params.append(name)
+        if service is not None:
+            _where.append('service = ?')
+            _params.append(service)
+        _where_sql = f'WHERE {" AND ".join(_where)} ' if _where else ''
+        with self._lock:
+            return [_row[0] for _row in self._connection.execute(
+                f'SELECT json FROM spans {_where_sql}ORDER BY duration_ns DESC LIMIT ?', (*_params, limit))]
+
+    def recent(self, service: Optional[str] = None, limit: int = 20) -> List[str]:
+        with self._lock:
+            if service is not None:
+                _rows = self._connection.execute(
+                    'SELECT json FROM spans WHERE service = ? ORDER BY seq DESC LIMIT ?', (service, limit))
+            else:
+                _rows = self._connection.execute('SELECT json FROM spans ORDER BY seq DESC LIMIT ?', (limit,))
+            return [_row[0] for _row in _rows]
+
+    def error_traces(self, since_ns: int, limit: int = 100) -> List[ErrorTrace]:
+        with self._lock:
+            _rows = self._connection.execute(
+                'SELECT trace_id, COUNT(*), MAX(end_ns) FROM spans WHERE is_error AND end_ns >= ? '
+                'GROUP BY trace_id ORDER BY MAX(end_ns) DESC LIMIT ?', (since_ns, limit)).fetchall()
+            return [(int(_trace_id, 16),
+                     self._connection.execute('SELECT COUNT(*) FROM spans WHERE trace_id = ?',
+                                              (_trace_id,)).fetchone()[0],
+                     _count,
+                     _last)
+                    for _trace_id, _count, _last in _rows]
+
+    def services(self) -> Dict[str, int]:
+        with self._lock:
+            # only reads the (service, seq) index, not the table
+            return dict(self._connection.execute('SELECT service, COUNT(*) FROM spans GROUP BY service'))
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+SpanStore = Union[MemorySpanStore, SqliteSpanStore]
+
+
+class SpanStoreProcessor(SpanProcessor):
+    """
+    queues finished spans (dropping the oldest if the queue is full) and adds them to the store in batches,
+    so the thread that ended the span never waits for the store
+    """
+
+    def __init__(self, store: Optional[SpanStore] = None, *, queue_size: int = 10000, interval: float = 0.5) -> None:
+        self.store = store
+        self.queue_size = queue_size
+        self.interval = interval
+        self._queue: Deque[ReadableSpan] = deque(maxlen=queue_size)
+        self._write_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        register_after_fork(self)
+
+    def _start(self) -> None:
+        if self._thread is None:
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._loop, name=self.__class__.__name__, daemon=True)
+            self._thread.start()
+
+    def _after_fork_in_child(self) -> None:
+        """
+        the store is fixed here rather than registering itself, so it's usable before the writer thread restarts
+        """
+        self._queue = deque(maxlen=self.queue_size)
+        self._write_lock = threading.Lock()
+        self._thread = None
+        if isinstance(self.store, SqliteSpanStore):
+            # a sqlite connection must not be used across a fork
+            self.store = SqliteSpanStore(self.store.path, self.store.max_spans)
+        elif self.store is not None:
+            # noinspection PyProtectedMember
+            self.store._after_fork_in_child()
+        if self.store is not None:
+            self._start()
+
+    def enable(self, store: SpanStore) -> None:
+        _old_store, self.store = self.store, store
+        if _old_store is not None and _old_store is not store:
+            _old_store.close()
+        self._start()
+
+    def _loop(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.force_flush()
+
+    def on_start(self, span: Span, parent_context: Optional[Context] = None) -> None:
+        pass
+
+    def on_end(self, span: ReadableSpan) -> None:
+        if self.store is not None:
+            self._queue.append(span)
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        with self._write_lock:
+            _store = self.store
+            while self._queue:
+                _batch: List[ReadableSpan] = []
+                while self._queue and len(_batch) < 1000:
+                    _batch.append(self._queue.popleft())
+                if _store is not None:
+                    # noinspection PyBroadException
+                    try:
+                        _store.add(_batch)
+                    except Exception:
+                        pass  # e.g. disk full, nowhere to report it
+        return True
+
+    def shutdown(self) -> None:
+        self._stop.set()
+        self.force_flush()
+        if self.store is not None:
+            self.store.close()
+
+
+_PROCESSOR = SpanStoreProcessor()
+
+
+def get_span_store_processor() -> SpanStoreProcessor:
+    return _PROCESSOR
+
+
+def get_span_store() -> Optional[SpanStore]:
+    """
+    :return: None unless `enable_span_store` was called (or the env vars were set)
+    """
+    return _PROCESSOR.store
+
+
+def enable_span_store(*,
+                      max_spans: int = 10000,
+                      sqlite_path: Optional[Union[str, Path]] = None,
+                      ) -> SpanStore:
+    """
+    :param max_spans: how many of the most recent spans to keep
+    :param sqlite_path: keep them in this SQLite file instead of in memory
+    """
+    if sqlite_path is not None:
+        _store: SpanStore = SqliteSpanStore(sqlite_path, max_spans)
+    else:
+        _store = MemorySpanStore(max_spans)
+    _PROCESSOR.enable(_store)
+    return _store
+
+
+def load_span_store_from_env() -> None:
+    """
+    enables the span store if either env var is set
+    """
+    _max_spans = os.getenv(ENV_SPAN_STORE_MAX_SPANS, '').strip()
+    _sqlite_path = os.getenv(ENV_SPAN_STORE_SQLITE_PATH, '').strip()
+    if not _max_spans and not _sqlite_path:
+        return
+    try:
+        enable_span_store(max_spans=int(_max_spans) if _max_spans else 10000, sqlite_path=_sqlite_path or None)
+    except ValueError:
+        enable_span_store(sqlite_path=_sqlite_path or None)
+
+
+load_span_store_from_env()
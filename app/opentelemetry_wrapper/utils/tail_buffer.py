@@ -0,0 +1,247 @@
+"""
+keep low-level (e.g. DEBUG) logs in memory per trace, and only write them if the trace turns out to be interesting
+
+a `TailBufferHandler` wraps the real handler:
+* records at or above `threshold` are passed straight through
+* records below it are buffered per trace (by `otelTraceID`), or dropped if they're not in a trace
+* when a span in the trace ends with an error, or the (local) root span is slower than `latency_threshold_ms`,
+  the trace's buffered records are written, and the rest of that trace's records are passed straight through
+* otherwise the buffered records are dropped when the (local) root span ends
+
+memory is bounded by the number of records per trace, the total (estimated) size, and the age of each trace
+span ends are forwarded by `TailBufferSpanProcessor`, which `init_tracer` adds to the tracer provider
+"""
+import logging
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from collections import deque
+from typing import Deque
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from opentelemetry.sdk.trace import ReadableSpan
+from opentelemetry.sdk.trace import SpanProcessor
+from opentelemetry.trace import StatusCode
+
+from opentelemetry_wrapper.utils.fork_safety import register_after_fork
+
+# rough per-record overhead (the LogRecord and its `__dict__`), plus the message length
+_RECORD_BASE_SIZE = 512
+
+# traces being written through are normally forgotten when they end, this is just in case they never do
+_MAX_PASSTHROUGH_TRACES = 10000
+
+
+def _trace_key(record: logging.LogRecord) -> Optional[int]:
+    """
+    :return: the trace id as an int, or None if the record isn't in a trace
+    """
+    _trace_id = getattr(record, 'otelTraceID', None)
+    if isinstance(_trace_id, str):
+        try:
+            return int(_trace_id, 16) or None
+        except ValueError:
+            return None
+    return None
+
+
+def _estimate_size(record: logging.LogRecord) -> int:
+    return _RECORD_BASE_SIZE + (len(record.msg) if isinstance(record.msg, str) else 0)
+
+
+class _TraceBuffer:
+    __slots__ = ('created', 'records', 'size')
+
+    def __init__(self, max_records: int) -> None:
+        self.created = time.monotonic()
+        self.records: Deque[Tuple[logging.LogRecord, int]] = deque(maxlen=max_records)
+        self.size = 0
+
+
+class TailBufferHandler(logging.Handler):
+    """
+    the handler's own level is the lowest level that gets buffered
+    note that buffered records are formatted later, so mutable `args` should not be modified after logging
+    """
+
+    def __init__(self,
+                 target: logging.Handler,
+                 *,
+                 level: int = logging.NOTSET,
+                 threshold: int = logging.INFO,
+                 latency_threshold_ms: Optional[float] = None,
+                 max_records_per_trace: int = 1000,
+                 max_total_size: int = 16 * 1024 * 1024,
+                 max_age_seconds: float = 300.0,
+                 ) -> None:
+        """
+        :param target: where records are actually written
+        :param level: handler level, records below this are ignored completely
+        :param threshold: records at or above this level are never buffered
+        :param latency_threshold_ms: write the buffered records if the root span takes longer than this
+        :param max_records_per_trace: ring buffer size per trace; the oldest records are dropped first
+        :param max_total_size: approximate max bytes buffered across all traces; the oldest traces are dropped first
+        :param max_age_seconds: traces buffered for longer than this are dropped (e.g. if the root span never ends)
+        """
+        super().__init__(level)
+        self.target = target
+        self.threshold = threshold
+        self.latency_threshold_ns = int(latency_threshold_ms * 1_000_000) if latency_threshold_ms is not None else None
+        self.max_records_per_trace = max_records_per_trace
+        self.max_total_size = max_total_size
+        self.max_age_seconds = max_age_seconds
+
+        # trace id -> buffered records, oldest trace first
+        self._buffers: 'OrderedDict[int, _TraceBuffer]' = OrderedDict()
+        # trace id -> None, for traces that are being written through because they were interesting
+        self._passthrough: 'OrderedDict[int, None]' = OrderedDict()
+        self._total_size = 0
+        self._buffer_lock = threading.Lock()
+
+        # counters, readable any time
+        self.flushed_records = 0  # written after the trace turned out to be interesting
+        self.discarded_records = 0  # dropped because the trace ended normally, or records not in a trace
+        self.evicted_records = 0  # dropped to stay within the memory limits
+
+        _register_handler(self)
+        register_after_fork(self)
+
+    def _after_fork_in_child(self) -> None:
+        """
+        traces that were in progress belong to the parent
+        """
+        self._buffers = OrderedDict()
+        self._passthrough = OrderedDict()
+        self._total_size = 0
+        self._buffer_lock = threading.Lock()
+        self.flushed_records = 0
+        self.discarded_records = 0
+        self.evicted_records = 0
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if record.levelno >= self.threshold:
+            self.target.handle(record)
+            return
+
+        _key = _trace_key(record)
+        with self._buffer_lock:
+            if _key is None:
+                self.discarded_records += 1
+                return
+            if _key not in self._passthrough:
+                _buffer = self._buffers.get(_key)
+                if _buffer is None:
+                    _buffer = self._buffers[_key] = _TraceBuffer(self.max_records_per_trace)
+                if len(_buffer.records) == self.max_records_per_trace:
+                    _buffer.size -= _buffer.records[0][1]
+                    self._total_size -= _buffer.records[0][1]
+                    self.evicted_records += 1
+                _size = _estimate_size(record)
+                _buffer.records.append((record, _size))
+                _buffer.size += _size
+                self._total_size += _size
+                self._evict()
+                return
+
+        self.target.handle(record)
+
+    def _evict(self) -> None:
+        """
+        must be called with the lock held
+        """
+        _now = time.monotonic()
+        while self._buffers:
+            _key, _buffer = next(iter(self._buffers.items()))
+            if self._total_size <= self.max_total_size and _now - _buffer.created <= self.max_age_seconds:
+                break
+            del self._buffers[_key]
+            self._total_size -= _buffer.size
+            self.evicted_records += len(_buffer.records)
+
+        while len(self._passthrough) > _MAX_PASSTHROUGH_TRACES:
+            self._passthrough.popitem(last=False)
+
+    def _pop_buffer(self, trace_id: int) -> List[logging.LogRecord]:
+        with self._buffer_lock:
+            _buffer = self._buffers.pop(trace_id, None)
+            if _buffer is None:
+                return []
+            self._total_size -= _buffer.size
+            return [_record for _record, _ in _buffer.records]
+
+    def flush_trace(self, trace_id: int) -> None:
+        """
+        write everything buffered for this trace, and write through anything else logged in it until it ends
+        """
+        with self._buffer_lock:
+            self._passthrough[trace_id] = None
+        _records = self._pop_buffer(trace_id)
+        for _record in _records:
+            self.target.handle(_record)
+        with self._buffer_lock:
+            self.flushed_records += len(_records)
+
+    def discard_trace(self, trace_id: int) -> None:
+        _records = self._pop_buffer(trace_id)
+        with self._buffer_lock:
+            self.discarded_records += len(_records)
+            self._passthrough.pop(trace_id, None)
+
+    def on_span_end(self, span: ReadableSpan) -> None:
+        _trace_id = span.context.trace_id
+        _is_local_root = span.parent is None or span.parent.is_remote
+
+        if span.status.status_code is StatusCode.ERROR:
+            self.flush_trace(_trace_id)
+        elif _is_local_root and self.latency_threshold_ns is not None and \
+                span.end_time is not None and span.start_time is not None and \
+                span.end_time - span.start_time > self.latency_threshold_ns:
+            self.flush_trace(_trace_id)
+
+        if _is_local_root:
+            self.discard_trace(_trace_id)
+
+    def flush(self) -> None:
+        self.target.flush()
+
+    def close(self) -> None:
+        with self._buffer_lock:
+            self.discarded_records += sum(len(_buffer.records) for _buffer in self._buffers.values())
+            self._buffers.clear()
+            self._passthrough.clear()
+            self._total_size = 0
+        super().close()
+
+
+# handlers that get notified when spans end
+_HANDLERS: 'weakref.WeakSet[TailBufferHandler]' = weakref.WeakSet()
+
+
+def _register_handler(handler: TailBufferHandler) -> None:
+    _HANDLERS.add(handler)
+
+
+class TailBufferSpanProcessor(SpanProcessor):
+    """
+    forwards span ends to every `TailBufferHandler`; does nothing if there aren't any
+    """
+
+    def on_end(self, span: ReadableSpan) -> None:
+        if not _HANDLERS:
+            return
+        for _handler in list(_HANDLERS):
+            # noinspection PyBroadException
+            try:
+                _handler.on_span_end(span)
+            except Exception:
+                pass
+
+
+_PROCESSOR = TailBufferSpanProcessor()
+
+
+def get_tail_buffer_processor() -> TailBufferSpanProcessor:
+    return _PROCESSOR
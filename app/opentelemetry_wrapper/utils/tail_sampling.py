@@ -0,0 +1,332 @@
+"""
+tail-based sampling: decide whether to export a trace after its (local) root span ends, rather than when it starts
+
+finished spans are buffered per trace, and when the local root span ends the whole trace is either exported or dropped
+a trace is kept if
+* any of its spans ended with an error
+* the root span took longer than the latency threshold for its route (`http.route`, or the span name otherwise)
+* it falls within the probabilistic `baseline_ratio` (decided by trace id, so every service agrees)
+spans that end after the decision (e.g. background tasks started by the request) follow the same decision
+
+memory is bounded by the number of buffered traces, the total number of buffered spans, and the age of each trace
+(e.g. if the root span never ends); the oldest traces are evicted (i.e. dropped) first
+
+does nothing (spans are passed straight through) until enabled by `enable_tail_sampling`, or by env var, e.g.
+    OTEL_WRAPPER_TAIL_SAMPLING_RATIO=0.05
+    OTEL_WRAPPER_TAIL_SAMPLING_LATENCY_MS='/items/*=500,*=2000'
+where the latency thresholds are comma-separated `{route glob}={milliseconds}` pairs, and the first match wins
+
+note that this only sees this process's spans, so a trace across several services is decided separately by each
+"""
+import fnmatch
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from opentelemetry.context import Context
+from opentelemetry.sdk.trace import ReadableSpan
+from opentelemetry.sdk.trace import Span
+from opentelemetry.sdk.trace import SpanProcessor
+from opentelemetry.semconv.trace import SpanAttributes
+from opentelemetry.trace import StatusCode
+
+from opentelemetry_wrapper.utils.fork_safety import register_after_fork
+# noinspection PyProtectedMember
+from opentelemetry_wrapper.utils.sampling import _parse_env_rules
+
+ENV_TAIL_SAMPLING_RATIO = 'OTEL_WRAPPER_TAIL_SAMPLING_RATIO'
+ENV_TAIL_SAMPLING_LATENCY_MS = 'OTEL_WRAPPER_TAIL_SAMPLING_LATENCY_MS'
+
+# same as the SDK's `TraceIdRatioBased`, only the lower 64 bits of the trace id are used
+_TRACE_ID_LIMIT = (1 << 64) - 1
+
+# decided traces are normally only looked up by spans that end shortly after the root span, so keep just the latest
+_MAX_DECISIONS = 10000
+
+
+class _PendingTrace:
+    __slots__ = ('created', 'spans', 'has_error')
+
+    def __init__(self) -> None:
+        self.created = time.monotonic()
+        self.spans: List[ReadableSpan] = []
+        self.has_error = False
+
+
+class TailSamplingSpanProcessor(SpanProcessor):
+    """
+    buffers spans in front of `downstream` (the processor that actually exports them)
+    """
+
+    def __init__(self,
+                 downstream: Optional[SpanProcessor] = None,
+                 *,
+                 baseline_ratio: float = 0.01,
+                 latency_threshold_ms: Optional[float] = None,
+                 route_latency_thresholds_ms: Optional[Dict[str, float]] = None,
+                 max_traces: int = 10000,
+                 max_spans: int = 100000,
+                 max_age_seconds: float = 300.0,
+                 ) -> None:
+        """
+        :param downstream: where kept spans are sent; set by `init_tracer`
+        :param baseline_ratio: fraction of traces to keep regardless, between 0 and 1
+        :param latency_threshold_ms: keep traces whose root span takes longer than this, unless a route matches
+        :param route_latency_thresholds_ms: route glob -> latency threshold, first match wins
+        :param max_traces: max traces buffered at once
+        :param max_spans: max spans buffered at once, across all traces
+        :param max_age_seconds: traces buffered for longer than this are evicted
+        """
+        self.downstream = downstream
+        self.enabled = False
+        self.configure(baseline_ratio=baseline_ratio,
+                       latency_threshold_ms=latency_threshold_ms,
+                       route_latency_thresholds_ms=route_latency_thresholds_ms,
+                       max_traces=max_traces,
+                       max_spans=max_spans,
+                       max_age_seconds=max_age_seconds)
+
+        # trace id -> buffered spans, oldest trace first
+        self._pending: 'OrderedDict[int, _PendingTrace]' = OrderedDict()
+        self._pending_spans = 0
+        # trace id -> whether it was kept, for spans that end after the root span
+        self._decisions: 'OrderedDict[int, bool]' = OrderedDict()
+        self._lock = threading.Lock()
+
+        # counters, readable any time
+        self.kept_traces = 0
+        self.kept_for_error = 0
+        self.kept_for_latency = 0
+        self.kept_for_baseline = 0
+        self.dropped_traces = 0
+        self.evicted_traces = 0  # dropped to stay within the memory limits
+        self.evicted_spans = 0
+
+        register_after_fork(self)
+
+    def configure(self,
+                  *,
+                  baseline_ratio: float = 0.01,
+                  latency_threshold_ms: Optional[float] = None,
+                  route_latency_thresholds_ms: Optional[Dict[str, float]] = None,
+                  max_traces: int = 10000,
+                  max_spans: int = 100000,
+                  max_age_seconds: float = 300.0,
+                  ) -> None:
+        """
+        see `__init__`; takes effect for traces decided from now on
+        """
+        if not 0 <= baseline_ratio <= 1:
+            raise ValueError(baseline_ratio)
+        if max_traces < 1:
+            raise ValueError(max_traces)
+        if max_spans < 1:
+            raise ValueError(max_spans)
+
+        self.baseline_ratio = baseline_ratio
+        self.latency_threshold_ms = latency_threshold_ms
+        self.route_latency_thresholds_ms: Dict[str, float] = dict(route_latency_thresholds_ms or dict())
+        self.max_traces = max_traces
+        self.max_spans = max_spans
+        self.max_age_seconds = max_age_seconds
+        self._baseline_bound = round(baseline_ratio * (_TRACE_ID_LIMIT + 1))
+
+    def _after_fork_in_child(self) -> None:
+        """
+        traces that were in progress belong to the parent
+        """
+        self._pending = OrderedDict()
+        self._pending_spans = 0
+        self._decisions = OrderedDict()
+        self._lock = threading.Lock()
+        self.kept_traces = 0
+        self.kept_for_error = 0
+        self.kept_for_latency = 0
+        self.kept_for_baseline = 0
+        self.dropped_traces = 0
+        self.evicted_traces = 0
+        self.evicted_spans = 0
+
+    @property
+    def pending_traces(self) -> int:
+        return len(self._pending)
+
+    @property
+    def pending_spans(self) -> int:
+        return self._pending_spans
+
+    def _latency_threshold_ms(self, root: ReadableSpan) -> Optional[float]:
+        if self.route_latency_thresholds_ms:
+            _route = (root.attributes or dict()).get(SpanAttributes.HTTP_ROUTE)
+            if not isinstance(_route, str):
+                _route = root.name
+            for _pattern, _threshold_ms in self.route_latency_thresholds_ms.items():
+                if fnmatch.fnmatchcase(_route, _pattern):
+                    return _threshold_ms
+        return self.latency_threshold_ms
+
+    def _decide(self, root: ReadableSpan, has_error: bool) -> bool:
+        """
+        must be called with the lock held
+        """
+        if has_error:
+            self.kept_for_error += 1
+            return True
+
+        _threshold_ms = self._latency_threshold_ms(root)
+        if _threshold_ms is not None and root.end_time is not None and root.start_time is not None and \
+                root.end_time - root.start_time > _threshold_ms * 1_000_000:
+            self.kept_for_latency += 1
+            return True
+
+        if root.context.trace_id & _TRACE_ID_LIMIT < self._baseline_bound:
+            self.kept_for_baseline += 1
+            return True
+
+        return False
+
+    def _evict(self) -> None:
+        """
+        must be called with the lock held
+        """
+        _now = time.monotonic()
+        while self._pending:
+            _trace_id, _pending = next(iter(self._pending.items()))
+            if len(self._pending) <= self.max_traces and self._pending_spans <= self.max_spans and \
+                    _now - _pending.created <= self.max_age_seconds:
+                break
+            del self._pending[_trace_id]
+            self._pending_spans -= len(_pending.spans)
+            self.evicted_traces += 1
+            self.evicted_spans += len(_pending.spans)
+
+    def on_start(self, span: Span, parent_context: Optional[Context] = None) -> None:
+        if self.downstream is not None:
+            self.downstream.on_start(span, parent_context=parent_context)
+
+    def on_end(self, span: ReadableSpan) -> None:
+        if self.downstream is None:
+            return
+        if not self.enabled:
+            self.downstream.on_end(span)
+            return
+
+        _trace_id = span.context.trace_id
+        _is_local_root = span.parent is None or span.parent.is_remote
+        _spans: List[ReadableSpan] = []
+
+        with self._lock:
+            _decision = self._decisions.get(_trace_id)
+            if _decision is not None:
+                if _decision:
+                    _spans.append(span)
+
+            else:
+                _pending = self._pending.get(_trace_id)
+                if _pending is None:
+                    _pending = self._pending[_trace_id] = _PendingTrace()
+                _pending.spans.append(span)
+                _pending.has_error = _pending.has_error or span.status.status_code is StatusCode.ERROR
+                self._pending_spans += 1
+
+                if _is_local_root:
+                    del self._pending[_trace_id]
+                    self._pending_spans -= len(_pending.spans)
+                    _decision = self._decide(span, _pending.has_error)
+                    if _decision:
+                        self.kept_traces += 1
+                        _spans = _pending.spans
+                    else:
+                        self.dropped_traces += 1
+                    self._decisions[_trace_id] = _decision
+                    while len(self._decisions) > _MAX_DECISIONS:
+                        self._decisions.popitem(last=False)
+                else:
+                    self._evict()
+
+        # exporting must happen outside the lock
+        for _span in _spans:
+            self.downstream.on_end(_span)
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        """
+        unfinished traces stay buffered, since they haven't been decided yet
+        """
+        if self.downstream is None:
+            return True
+        return self.downstream.force_flush(timeout_millis)
+
+    def shutdown(self) -> None:
+        """
+        unfinished traces are kept only if they already have an error
+        """
+        with self._lock:
+            _pending: List[Tuple[int, _PendingTrace]] = list(self._pending.items())
+            self._pending.clear()
+            self._pending_spans = 0
+        if self.downstream is None:
+            return
+        for _, _trace in _pending:
+            if _trace.has_error:
+                for _span in _trace.spans:
+                    self.downstream.on_end(_span)
+        self.downstream.shutdown()
+
+
+_PROCESSOR = TailSamplingSpanProcessor()
+
+
+def get_tail_sampling_processor() -> TailSamplingSpanProcessor:
+    return _PROCESSOR
+
+
+def enable_tail_sampling(*,
+                         baseline_ratio: float = 0.01,
+                         latency_threshold_ms: Optional[float] = None,
+                         route_latency_thresholds_ms: Optional[Dict[str, float]] = None,
+                         max_traces: int = 10000,
+                         max_spans: int = 100000,
+                         max_age_seconds: float = 300.0,
+                         ) -> TailSamplingSpanProcessor:
+    """
+    see `TailSamplingSpanProcessor`; can be called again to change the settings
+    """
+    _PROCESSOR.configure(baseline_ratio=baseline_ratio,
+                         latency_threshold_ms=latency_threshold_ms,
+                         route_latency_thresholds_ms=route_latency_thresholds_ms,
+                         max_traces=max_traces,
+                         max_spans=max_spans,
+                         max_age_seconds=max_age_seconds)
+    _PROCESSOR.enabled = True
+    return _PROCESSOR
+
+
+def load_tail_sampling_from_env() -> None:
+    """
+    enables tail sampling if either env var is set; invalid entries are silently skipped
+    """
+    _ratio = os.getenv(ENV_TAIL_SAMPLING_RATIO, '').strip()
+    _thresholds = _parse_env_rules(ENV_TAIL_SAMPLING_LATENCY_MS)
+    if not _ratio and not _thresholds:
+        return
+
+    _route_latency_thresholds_ms: Dict[str, float] = dict()
+    for _pattern, _value in _thresholds:
+        try:
+            _route_latency_thresholds_ms.setdefault(_pattern, float(_value))
+        except (TypeError, ValueError):
+            continue
+
+    try:
+        _baseline_ratio = float(_ratio) if _ratio else 0.01
+        enable_tail_sampling(baseline_ratio=_baseline_ratio, route_latency_thresholds_ms=_route_latency_thresholds_ms)
+    except ValueError:
+        enable_tail_sampling(route_latency_thresholds_ms=_route_latency_thresholds_ms)
+
+
+load_tail_sampling_from_env()
@@ -0,0 +1,117 @@
+"""
+fast timestamp rendering for log records
+
+formatting a timestamp from scratch (`datetime.fromtimestamp(...).isoformat()`, or `time.strftime`) is slow,
+but consecutive log records are almost always in the same second, so everything except the fraction is cached
+the timezone is looked up per second (not once at startup), so DST changes are picked up
+"""
+import math
+import time
+from typing import Callable
+from typing import Optional
+from typing import Tuple
+
+
+def format_utc_offset(offset_seconds: int) -> str:
+    """
+    same format as `datetime.isoformat()`, e.g. `+08:00` or `-03:30`, with seconds only if non-zero
+    """
+    _sign = '-' if offset_seconds < 0 else '+'
+    _minutes, _seconds = divmod(abs(offset_seconds), 60)
+    _hours, _minutes = divmod(_minutes, 60)
+    if _seconds:
+        return f'{_sign}{_hours:02d}:{_minutes:02d}:{_seconds:02d}'
+    return f'{_sign}{_hours:02d}:{_minutes:02d}'
+
+
+def split_timestamp(timestamp: float) -> Tuple[int, int]:
+    """
+    same rounding as `datetime.fromtimestamp` (round half to even, carrying into the next second)
+
+    :return: (whole seconds, microseconds)
+    """
+    _fraction, _second = math.modf(timestamp)
+    _microseconds = round(_fraction * 1e6)
+    if _microseconds >= 1_000_000:
+        _second += 1
+        _microseconds -= 1_000_000
+    elif _microseconds < 0:
+        _second -= 1
+        _microseconds += 1_000_000
+    return int(_second), _microseconds
+
+
+class TimestampRenderer:
+    """
+    thread-safe (the cache is a single tuple, replaced atomically)
+    """
+
+    def __init__(self,
+                 datefmt: Optional[str] = None,
+                 converter: Callable[[Optional[float]], time.struct_time] = time.localtime,
+                 ) -> None:
+        """
+        :param datefmt: `time.strftime` format string; if not set, renders the same as `datetime.isoformat()`
+        :param converter: `time.localtime` or `time.gmtime`, same as `logging.Formatter.converter`
+        """
+        self.datefmt = datefmt
+        self.converter = converter
+
+        # (second, rendered text before the fraction, text after the fraction, tz name, utc offset in seconds)
+        self._cached: Tuple[int, str, str, str, int] = (-1, '', '', '', 0)
+
+    def _split(self, created: float) -> Tuple[int, int]:
+        """
+        a `datefmt` can't show the fraction, so it's truncated instead, same as `time.strftime`
+
+        :return: (whole seconds, microseconds)
+        """
+        if self.datefmt is not None:
+            return math.floor(created), 0
+        return split_timestamp(created)
+
+    def _get(self, second: int) -> Tuple[int, str, str, str, int]:
+        _cached = self._cached
+        if _cached[0] == second:
+            return _cached
+
+        _struct_time = self.converter(second)
+        _offset = _struct_time.tm_gmtoff or 0
+        _tz_name = _struct_time.tm_zone or format_utc_offset(_offset)
+        if self.datefmt is not None:
+            _cached = (second, time.strftime(self.datefmt, _struct_time), '', _tz_name, _offset)
+        else:
+            _cached = (second,
+                       time.strftime('%Y-%m-%dT%H:%M:%S', _struct_time),
+                       format_utc_offset(_offset),
+                       _tz_name,
+                       _offset)
+        self._cached = _cached
+        return _cached
+
+    def render(self, created: float) -> str:
+        """
+        :param created: unix timestamp, e.g. `LogRecord.created`
+        """
+        return self.render_with_tz(created)[0]
+
+    def render_with_tz(self, created: float) -> Tuple[str, str, int]:
+        """
+        :return: (rendered timestamp, tz name, utc offset in seconds)
+        """
+        _second, _microseconds = self._split(created)
+        _, _prefix, _suffix, _tz_name, _offset = self._get(_second)
+        if self.datefmt is not None:
+            return _prefix, _tz_name, _offset
+        if _microseconds:
+            return f'{_prefix}.{_microseconds:06d}{_suffix}', _tz_name, _offset
+        return f'{_prefix}{_suffix}', _tz_name, _offset
+
+    def tz_name(self, created: float) -> str:
+        return self._get(self._split(created)[0])[3]
+
+    def utc_offset_seconds(self, created: float) -> int:
+        """
+        negative west of UTC
+        """
+        return self._get(self._split(created)[0])[4]
@@ -4,17 +4,21 @@ from typing import Optional
 from opentelemetry import trace
 from opentelemetry.sdk.resources import Resource
 from opentelemetry.sdk.resources import SERVICE_NAME
-from opentelemetry.sdk.trace import ReadableSpan
 from opentelemetry.sdk.trace import Tracer
 from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.sdk.trace.export import ConsoleSpanExporter
 
 from opentelemetry_wrapper.config import __service_name__
+from opentelemetry_wrapper.utils.aggregation import get_span_aggregator
+from opentelemetry_wrapper.utils.span_exporter import get_span_exporter_from_env
+from opentelemetry_wrapper.utils.span_pipeline import create_span_pipeline
+from opentelemetry_wrapper.utils.span_pipeline import get_span_pipeline
+from opentelemetry_wrapper.utils.span_store import get_span_store_processor
+from opentelemetry_wrapper.utils.tail_buffer import get_tail_buffer_processor
+from opentelemetry_wrapper.utils.tail_sampling import get_tail_sampling_processor
 
 
 @lru_cache  # only run once
-def init_tracer():
+def _init_tracer_provider() -> None:
     if __service_name__:
         tp = TracerProvider(resource=Resource.create({SERVICE_NAME: __service_name__}))
     else:
@@ -23,15 +27,68 @@ def init_tracer():
     # noinspection PyProtectedMember
     trace._set_tracer_provider(tp, log=False)  # try to set, but don't warn otherwise
     if trace.get_tracer_provider() is tp:  # if we succeeded in setting it, set it up
-        def format_span(span: ReadableSpan) -> str:
-            return f'{span.to_json(indent=None)}\n'
+        # the aggregator must come first, so it can flush summary spans to the exporter when shutting down
+        _aggregator = get_span_aggregator()
+        tp.add_span_processor(_aggregator)
+        _aggregator.enabled = True
+        tp.add_span_processor(get_tail_buffer_processor())
+        tp.add_span_processor(get_span_store_processor())  # sees every span, whether or not it's sampled
+        # tail sampling sits in front of the span pipeline, so only the traces it keeps get exported
+        _tail_sampler = get_tail_sampling_processor()
+        _tail_sampler.downstream = create_span_pipeline(get_span_exporter_from_env())
+        tp.add_span_processor(_tail_sampler)
 
-        tp.add_span_processor(BatchSpanProcessor(ConsoleSpanExporter(formatter=format_span)))
+
+def init_tracer(*,
+                max_queue_size: Optional[int] = None,
+                max_export_batch_size: Optional[int] = None,
+                schedule_delay_millis: Optional[float] = None,
+                export_timeout_millis: Optional[float] = None,
+                stats_interval: Optional[float] = None,
+                ) -> None:
+    """
+    sets up the global tracer provider (only once, and only if nobody else has set one)
+    passing any of the tuning params re-tunes the span pipeline, and the others keep their current values
+    (see `utils/span_pipeline.py`, where `get_span_pipeline().reset()` goes back to the defaults)
+    (this already runs when the wrapper is imported, so the defaults can also be set by the SDK's `OTEL_BSP_*` env vars)
+
+    :param max_queue_size: max spans waiting to be exported before spans are dropped
+    :param max_export_batch_size: max spans per export
+    :param schedule_delay_millis: max wait between exports
+    :param export_timeout_millis: max time per export
+    :param stats_interval: seconds between logging the span pipeline's stats
+    """
+    _init_tracer_provider()
+
+    _pipeline = get_span_pipeline()
+    if _pipeline is not None and any(_param is not None for _param in (max_queue_size,
+                                                                       max_export_batch_size,
+                                                                       schedule_delay_millis,
+                                                                       export_timeout_millis,
+                                                                       stats_interval)):
+        _pipeline.configure(max_queue_size=max_queue_size,
+                            max_export_batch_size=max_export_batch_size,
+                            schedule_delay_millis=schedule_delay_millis,
+                            export_timeout_millis=export_timeout_millis,
+                            stats_interval=stats_interval)
 
 
 def get_tracer(instrumenting_module_name: str,
                instrumenting_library_version: Optional[str] = None,
+               *,
+               max_queue_size: Optional[int] = None,
+               max_export_batch_size: Optional[int] = None,
+               schedule_delay_millis: Optional[float] = None,
+               export_timeout_millis: Optional[float] = None,
+               stats_interval: Optional[float] = None,
                ) -> Tracer:
-    init_tracer()
+    """
+    the tuning params are passed to `init_tracer`
+    """
+    init_tracer(max_queue_size=max_queue_size,
+                max_export_batch_size=max_export_batch_size,
+                schedule_delay_millis=schedule_delay_millis,
+                export_timeout_millis=export_timeout_millis,
+                stats_interval=stats_interval)
     return trace.get_tracer(instrumenting_module_name=instrumenting_module_name,
                             instrumenting_library_version=instrumenting_library_version)